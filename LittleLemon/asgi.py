@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'LittleLemon.settings')
+# Under ASGI the hot read endpoints are served by the native async views in LittleLemonAPI/async_views.py
+os.environ.setdefault('LITTLELEMON_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import importlib.util
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +46,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover everything below; see LittleLemonAPI/metrics.py
+    'LittleLemonAPI.metrics.RequestMetricsMiddleware',
+    # Before anything else touches the response body; see LittleLemonAPI/compression.py
+    'LittleLemonAPI.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -51,6 +57,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Routes the views' reads to the read replicas, if any; see LittleLemonAPI/replicas.py
+    'LittleLemonAPI.replicas.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'LittleLemon.urls'
@@ -77,11 +85,219 @@ WSGI_APPLICATION = 'LittleLemon.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# DATABASE_PROFILE selects one of the profiles below:
+# sqlite (default) - Django's defaults, fine for development
+# sqlite-wal - SQLite tuned for concurrent use: WAL lets readers run alongside the writer, BEGIN IMMEDIATE
+#   takes the write lock up front (instead of failing to upgrade a read lock mid-transaction) and
+#   busy_timeout makes writers queue for the lock rather than erroring out
+# postgres - PostgreSQL with a psycopg connection pool per process (POSTGRES_POOL=0 uses persistent
+#   connections instead, e.g. behind pgbouncer) and health checks before reusing a connection
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+# SQLITE_PATH lets tools such as the benchmarks point a server at a scratch database
+SQLITE_PATH = os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3')
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    # With WAL, NORMAL only syncs at checkpoints; a power loss can drop the last commits but never corrupts
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=%d' % int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+    'PRAGMA cache_size=-20000',  # KiB, i.e. 20 MB of page cache per connection
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA temp_store=MEMORY',
+]
+POSTGRES_POOL = os.environ.get('POSTGRES_POOL', '1') == '1'
+
+DATABASE_PROFILES = {
+    'sqlite': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': SQLITE_PATH,
+    },
+    'sqlite-wal': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': SQLITE_PATH,
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 600)),
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': ';'.join(SQLITE_PRAGMAS),
+        },
+    },
+    'postgres': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'littlelemon'),
+        'USER': os.environ.get('POSTGRES_USER', ''),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', ''),
+        'PORT': os.environ.get('POSTGRES_PORT', ''),
+        # A pool hands connections back at the end of each request, so they must not also be persistent
+        'CONN_MAX_AGE': 0 if POSTGRES_POOL else int(os.environ.get('DATABASE_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'pool': {
+                'min_size': int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 2)),
+                'max_size': int(os.environ.get('POSTGRES_POOL_MAX_SIZE', 20)),
+                'timeout': 10,
+            },
+        } if POSTGRES_POOL else {},
+    },
+}
+
 DATABASES = {
+    'default': DATABASE_PROFILES[DATABASE_PROFILE],
+}
+
+# Read replicas (LittleLemonAPI/replicas.py): DATABASE_REPLICAS lists them, comma separated - database files
+# for the sqlite profiles (opened read-only; `manage.py shell -c "from LittleLemonAPI.replicas import
+# sync_sqlite_replicas; sync_sqlite_replicas()"` copies the primary over them), hosts for postgres. They
+# become the replica1, replica2, ... aliases. GETs read from them, except for REPLICA_PIN_SECONDS after the
+# user's own writes, which needs those pins shared by every process: REPLICA_PIN_CACHE_ALIAS names the cache
+# they are kept in, by default a file-based one shared by the workers on this machine (with several machines,
+# name a Redis-backed cache). A per-process locmem cache is refused.
+REPLICA_LOCATIONS = [location for location in os.environ.get('DATABASE_REPLICAS', '').split(',') if location]
+for number, location in enumerate(REPLICA_LOCATIONS, 1):
+    if DATABASE_PROFILE == 'postgres':
+        DATABASES[f'replica{number}'] = {**DATABASES['default'], 'HOST': location}
+    else:
+        DATABASES[f'replica{number}'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': f'file:{location}?mode=ro',
+            'OPTIONS': {'uri': True},
+        }
+    # Tests read the primary through them
+    DATABASES[f'replica{number}']['TEST'] = {'MIRROR': 'default'}
+DATABASE_REPLICAS = [f'replica{number}' for number in range(1, len(REPLICA_LOCATIONS) + 1)]
+DATABASE_ROUTERS = ['LittleLemonAPI.replicas.ReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 5))
+REPLICA_PIN_CACHE_ALIAS = os.environ.get('REPLICA_PIN_CACHE_ALIAS', 'replica-pins')
+REPLICA_HEALTH_CHECK_INTERVAL = 5
+
+# `manage.py test` keeps the file caches and SQLite stores below in a scratch directory
+TEST_RUNNER = 'LittleLemon.test_runner.TestRunner'
+
+
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# The menu responses are cached in their own cache. MENU_CACHE_BACKEND selects where:
+# file (default, shared by the workers on one machine), redis (any Redis-compatible server, shared by every
+# machine; needs redis-py from the Pipfile's [redis] packages) or locmem (per process, so only for a single
+# process such as runserver: other workers would keep serving the menu and ETags from before a write)
+
+MENU_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'littlelemon-menu',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('MENU_CACHE_LOCATION', str(BASE_DIR / '.cache' / 'menu')),
+    },
+    'redis': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('MENU_CACHE_LOCATION', 'redis://127.0.0.1:6379/0'),
+    },
+}
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'menu': MENU_CACHE_BACKENDS[os.environ.get('MENU_CACHE_BACKEND', 'file')],
+    # Authenticated tokens and their revocations (TOKEN_CACHE_ALIAS)
+    'auth-tokens': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('TOKEN_CACHE_LOCATION', str(BASE_DIR / '.cache' / 'auth-tokens')),
+    },
+    # Read-your-writes pins of the read replicas (REPLICA_PIN_CACHE_ALIAS)
+    'replica-pins': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('REPLICA_PIN_CACHE_LOCATION', str(BASE_DIR / '.cache' / 'replica-pins')),
+    },
+}
+
+MENU_CACHE_ALIAS = 'menu'
+# Seconds a cached menu page is kept; a menu write makes it stale immediately regardless
+MENU_CACHE_TIMEOUT = 300
+# Only with MENU_CACHE_BACKEND = locmem: a process then doesn't see the menu writes of the others, so its search
+# index (LittleLemonAPI/search.py) is rebuilt after this many seconds to pick them up
+SEARCH_INDEX_MAX_AGE = 300
+
+# Authenticated tokens are remembered per process for TOKEN_CACHE_TTL seconds, behind a shared tier named
+# by TOKEN_CACHE_ALIAS that every hit is checked against, so a revocation (logout, deactivation, password
+# change) reaches every process immediately. By default that is a file-based cache shared by the workers on
+# this machine; with several machines, name a Redis-backed one. An empty TOKEN_CACHE_ALIAS leaves only the
+# per-process tier, which is for a single process: other workers would accept a revoked token until the TTL.
+TOKEN_CACHE_ALIAS = os.environ.get('TOKEN_CACHE_ALIAS', 'auth-tokens') or None
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_MAX_ENTRIES = 10000
+
+# Responses above COMPRESSION_MIN_SIZE bytes are compressed with brotli (when installed) or gzip
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_GZIP_LEVEL = 5
+COMPRESSION_BROTLI_QUALITY = 4
+
+# Background jobs (LittleLemonAPI/jobs.py), run by `manage.py run_jobs`. A failed batch is retried after
+# JOB_RETRY_DELAY seconds, doubling every attempt, up to JOB_MAX_ATTEMPTS attempts. A batch not finished
+# within JOB_LEASE seconds (e.g. its worker died) is run again by another worker.
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', 1))
+JOB_BATCH_SIZE = 50
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 10
+JOB_LEASE = 300
+JOB_POLL_INTERVAL = 1.0
+
+# Order notifications are sent by the job worker. The console backend prints them; set EMAIL_BACKEND
+# (and EMAIL_HOST etc.) for a real mail server.
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'orders@littlelemon.example')
+
+# Where the cart endpoints keep carts (LittleLemonAPI/cart_store.py): database (the Cart table), local (a
+# dict per process, for a single worker) or sqlite (a file shared by the workers on one machine). With local
+# or sqlite, carts are written behind to the Cart table every CART_FLUSH_INTERVAL seconds and at checkout.
+CART_STORE = os.environ.get('CART_STORE', 'database')
+CART_SQLITE_PATH = os.environ.get('CART_SQLITE_PATH', str(BASE_DIR / '.cache' / 'carts.sqlite3'))
+CART_FLUSH_INTERVAL = 5
+
+# Order archival (LittleLemonAPI/archive.py, `manage.py archive_orders`): delivered orders dated more than
+# ORDER_ARCHIVE_AFTER_DAYS ago move to the archive tables, ORDER_ARCHIVE_BATCH_SIZE orders per transaction
+ORDER_ARCHIVE_AFTER_DAYS = int(os.environ.get('ORDER_ARCHIVE_AFTER_DAYS', 365))
+ORDER_ARCHIVE_BATCH_SIZE = 500
+
+# Order event streams (GET /api/orders/events/, LittleLemonAPI/events.py). ORDER_EVENTS_BROKER is local
+# (one process: a single ASGI worker) or database (events go through the OrderEvent table, for several
+# workers or machines). A client that reconnects gets the events it missed, up to ORDER_EVENTS_RETENTION
+# seconds old with the database broker or the last ORDER_EVENTS_BUFFER events with the local one.
+ORDER_EVENTS_BROKER = os.environ.get('ORDER_EVENTS_BROKER', 'local')
+ORDER_EVENTS_BUFFER = 10000
+ORDER_EVENTS_RETENTION = 24 * 3600
+ORDER_EVENTS_POLL_INTERVAL = 0.5
+ORDER_EVENTS_HEARTBEAT = 15
+
+# Rate limiting (LittleLemonAPI/throttling.py): a token bucket per client and route. THROTTLE_RATES gives
+# 'rate/burst' (requests per second / requests) per role and route; '*' covers the role's other routes,
+# which share one bucket. THROTTLE_STORE selects where the buckets live: sqlite (default, a file shared by
+# the workers on one machine), redis (any Redis-compatible server, shared by every machine) or local (per
+# process, so with N workers a client gets N times the limit)
+THROTTLE_ENABLED = os.environ.get('THROTTLE_ENABLED', '1') == '1'
+THROTTLE_STORE = os.environ.get('THROTTLE_STORE', 'sqlite')
+THROTTLE_SQLITE_PATH = os.environ.get('THROTTLE_SQLITE_PATH', str(BASE_DIR / '.cache' / 'throttle.sqlite3'))
+THROTTLE_REDIS_URL = os.environ.get('THROTTLE_REDIS_URL', 'redis://127.0.0.1:6379/1')
+THROTTLE_RATES = {
+    'anonymous': {
+        '*': '5/50',
+        # Routes are URL patterns as matched (see metrics.route_of), hence djoser's regexes: sign-ups and logins
+        '/api/users/$': '0.1/5',
+        '/api/token/login/?$': '0.2/10',
+    },
+    'Customer': {
+        '*': '20/200',
+        '/api/orders/': '2/30',
+        '/api/cart/menu-items/': '10/100',
+    },
+    'Delivery Crew': {
+        '*': '20/200',
+        '/api/orders/': '10/100',
+    },
+    'Manager': {
+        '*': '50/500',
+    },
 }
 
 
@@ -126,15 +342,43 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Per-request metrics: a Server-Timing header on every response and per-route histograms at /metrics.
+# SLOW_REQUEST_MS turns on a warning log (LittleLemonAPI.slow_requests) with the SQL of requests slower
+# than that many milliseconds.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+# /metrics only answers scrapers sending "Authorization: Bearer <METRICS_TOKEN>"; unset, it isn't served
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+SLOW_REQUEST_MS = int(os.environ['SLOW_REQUEST_MS']) if os.environ.get('SLOW_REQUEST_MS') else None
+
+# Serve the hot read endpoints with the native async views. asgi.py turns this on; under WSGI the
+# regular sync views are used.
+ASYNC_READ_VIEWS = os.environ.get('LITTLELEMON_ASYNC_VIEWS') == '1'
+
+# API_PROFILE=production serves only the machine formats: the browsable API (and the HTML content
+# negotiation it needs) is left out of the renderers. MessagePack is offered when msgpack is installed;
+# JSON is rendered and parsed with orjson when that is installed (see LittleLemonAPI/renderers.py).
+API_PROFILE = os.environ.get('API_PROFILE', 'development')
+MSGPACK_INSTALLED = importlib.util.find_spec('msgpack') is not None
+
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.BrowsableAPIRenderer',
+        'LittleLemonAPI.renderers.FastJSONRenderer',
+        *(['LittleLemonAPI.renderers.MessagePackRenderer'] if MSGPACK_INSTALLED else []),
+        *(['rest_framework.renderers.BrowsableAPIRenderer'] if API_PROFILE != 'production' else []),
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'LittleLemonAPI.renderers.FastJSONParser',
+        *(['LittleLemonAPI.renderers.MessagePackParser'] if MSGPACK_INSTALLED else []),
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'LittleLemonAPI.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-    )
+    ),
+    'DEFAULT_THROTTLE_CLASSES': [
+        'LittleLemonAPI.throttling.TokenBucketThrottle',
+    ],
 }
 # Djoser refers to a REST implementation for Django authentication that
 # provides a set of RESTful APIs to handle basic actions such as
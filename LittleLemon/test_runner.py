@@ -0,0 +1,31 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+# The file-based caches and the SQLite throttle and cart stores live under BASE_DIR/.cache, shared with any
+# server started from the same checkout. The tests clear and fill them, so they get a scratch directory instead.
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.scratch = tempfile.TemporaryDirectory(prefix='littlelemon-tests-')
+        caches = {
+            alias: {**config, 'LOCATION': os.path.join(self.scratch.name, alias)}
+            if config['BACKEND'].endswith('.FileBasedCache') else config
+            for alias, config in settings.CACHES.items()
+        }
+        self.scratch_settings = override_settings(
+            CACHES=caches,
+            THROTTLE_SQLITE_PATH=os.path.join(self.scratch.name, 'throttle.sqlite3'),
+            CART_SQLITE_PATH=os.path.join(self.scratch.name, 'carts.sqlite3'),
+        )
+        self.scratch_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.scratch_settings.disable()
+        self.scratch.cleanup()
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1,166 @@
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import metrics
+from .fast_serializers import serialize_list
+from .models import ArchivedOrder, ArchivedOrderItem, ArchiveRun, Order, OrderItem
+from .serializers import ArchivedOrderItemSerializer, ArchivedOrderSerializer
+
+# Order history archival. `manage.py archive_orders` moves delivered orders dated more than
+# ORDER_ARCHIVE_AFTER_DAYS days ago, with their items, from Order / OrderItem into ArchivedOrder /
+# ArchivedOrderItem, ORDER_ARCHIVE_BATCH_SIZE orders per transaction, so the order listings and lookups only
+# ever scan recent and open orders. Archived orders keep their ids and are still readable:
+# GET /api/orders/<orderId>/ falls back to the archive, and GET /api/orders/?start=&end= includes archived
+# orders of that date range. They stay in the sales rollups (archiving isn't a deletion) and can't be
+# changed any more.
+
+logger = logging.getLogger(__name__)
+
+
+def archive_after_days():
+    return getattr(settings, 'ORDER_ARCHIVE_AFTER_DAYS', 365)
+
+
+def archive_cutoff(days=None):
+    # Delivered orders dated before this are archived
+    return timezone.localdate() - datetime.timedelta(days=archive_after_days() if days is None else days)
+
+
+def archivable(cutoff):
+    return Order.objects.filter(status=True, date__lt=cutoff)
+
+
+def archive_orders(days=None, batch_size=None, max_batches=None):
+    # Moves the archivable orders; returns {'orders': n, 'items': n, 'batches': n}
+    cutoff = archive_cutoff(days)
+    batch_size = batch_size or getattr(settings, 'ORDER_ARCHIVE_BATCH_SIZE', 500)
+    moved = {'orders': 0, 'items': 0, 'batches': 0}
+    while max_batches is None or moved['batches'] < max_batches:
+        with transaction.atomic():
+            orders, items = archive_batch(cutoff, batch_size)
+        if not orders:
+            break
+        moved['orders'] += orders
+        moved['items'] += items
+        moved['batches'] += 1
+    logger.info('Archived %(orders)d orders (%(items)d items) in %(batches)d batches', moved)
+    record_run(moved)
+    return moved
+
+
+def record_run(moved):
+    # Keeps running totals of the archive tables in the run records, so they are only counted by the first run
+    previous = last_run()
+    if previous is None:
+        archived_orders, archived_order_items = ArchivedOrder.objects.count(), ArchivedOrderItem.objects.count()
+    else:
+        archived_orders = previous.archived_orders + moved['orders']
+        archived_order_items = previous.archived_order_items + moved['items']
+    ArchiveRun.objects.create(**moved, archived_orders=archived_orders, archived_order_items=archived_order_items)
+
+
+def last_run():
+    return ArchiveRun.objects.order_by('-pk').first()
+
+
+def archive_batch(cutoff, batch_size):
+    # One transaction's worth: copies up to batch_size orders and their items, then deletes them from the hot
+    # tables. The orders are locked, so an order changed meanwhile (e.g. marked undelivered) is either
+    # archived before the change or not at all.
+    orders = list(archivable(cutoff).select_for_update().order_by('pk').values_list(
+        'pk', 'user_id', 'delivery_crew_id', 'status', 'total', 'date')[:batch_size])
+    if not orders:
+        return 0, 0
+    order_ids = [order[0] for order in orders]
+    items = list(OrderItem.objects.filter(order_id__in=order_ids).values_list(
+        'pk', 'order_id', 'menuitem_id', 'quantity', 'unit_price', 'price'))
+    ArchivedOrder.objects.bulk_create(
+        ArchivedOrder(id=pk, user_id=user_id, delivery_crew_id=crew_id, status=status, total=total, date=date)
+        for pk, user_id, crew_id, status, total, date in orders
+    )
+    ArchivedOrderItem.objects.bulk_create(
+        ArchivedOrderItem(id=pk, order_id=order_id, menuitem_id=menuitem_id, quantity=quantity,
+                          unit_price=unit_price, price=price)
+        for pk, order_id, menuitem_id, quantity, unit_price, price in items
+    )
+    delete_rows(OrderItem, 'order', order_ids)
+    delete_rows(Order, 'id', order_ids)
+    return len(orders), len(items)
+
+
+def delete_rows(model, field, values):
+    # DELETE ... WHERE field IN (values). QuerySet.delete() would load every order to send pre_delete, whose
+    # receiver takes deleted orders out of the sales rollups; archived sales still count.
+    quote = connection.ops.quote_name
+    column = model._meta.get_field(field).column
+    placeholders = ', '.join(['%s'] * len(values))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {quote(model._meta.db_table)} WHERE {quote(column)} IN ({placeholders})',
+                       values)
+
+
+# archive_orders runs in its own process, so /metrics reads its latest run record (one lookup by primary key)
+@metrics.gauge('littlelemon_archived_orders_total', 'Orders moved into the archive tables (archive.py)', 'counter')
+def archived_order_total():
+    run = last_run()
+    return run.archived_orders if run is not None else 0
+
+
+@metrics.gauge('littlelemon_archived_order_items_total', 'Order items moved into the archive tables', 'counter')
+def archived_order_item_total():
+    run = last_run()
+    return run.archived_order_items if run is not None else 0
+
+
+@metrics.gauge('littlelemon_archive_last_run_orders', 'Orders moved by the latest archive_orders run')
+def last_run_orders():
+    run = last_run()
+    return run.orders if run is not None else 0
+
+
+@metrics.gauge('littlelemon_archive_last_run_order_items', 'Order items moved by the latest archive_orders run')
+def last_run_order_items():
+    run = last_run()
+    return run.items if run is not None else 0
+
+
+@metrics.gauge('littlelemon_archive_last_run_timestamp_seconds', 'When the latest archive_orders run finished')
+def last_run_finished():
+    run = last_run()
+    return run.finished.timestamp() if run is not None else 0
+
+
+def table_sizes():
+    return {
+        'orders': Order.objects.count(),
+        'order_items': OrderItem.objects.count(),
+        'archived_orders': ArchivedOrder.objects.count(),
+        'archived_order_items': ArchivedOrderItem.objects.count(),
+    }
+
+
+# Read paths
+
+def archived_order_items(pk, **visible):
+    # The serialized items of archived order pk, if it exists and matches visible (e.g. user=...); else None
+    if not ArchivedOrder.objects.filter(pk=pk, **visible).exists():
+        return None
+    metrics.increment('littlelemon_archive_reads_total')
+    return serialize_list(ArchivedOrderItem.objects.filter(order_id=pk).order_by('pk'), ArchivedOrderItemSerializer)
+
+
+def archived_orders(start, end, **visible):
+    # The serialized archived orders dated between start and end (inclusive, either may be None)
+    queryset = ArchivedOrder.objects.filter(**visible)
+    if start is not None:
+        queryset = queryset.filter(date__gte=start)
+    if end is not None:
+        queryset = queryset.filter(date__lte=end)
+    data = serialize_list(queryset.order_by('pk'), ArchivedOrderSerializer)
+    if data:
+        metrics.increment('littlelemon_archive_reads_total')
+    return data
@@ -0,0 +1,275 @@
+import functools
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.exceptions import APIException, MethodNotAllowed, NotAuthenticated, NotFound, PermissionDenied
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import exception_handler
+
+from . import events, views
+from .authentication import TOKEN_KEYWORD, aauthenticate
+from .cart import user_cart
+from .cart_store import LocalCartStore, get_cart_store
+from .fast_serializers import aserialize_list, apaginated_list
+from .filters import filter_menu_items
+from .menu_cache import acache_menu_response
+from .metrics import measure
+from .models import MenuItem, Order
+from .pagination import MenuItemPagination
+from .permissions import IsManager
+from .roles import DELIVERY_CREW, MANAGER, aget_roles
+from .serializers import CartSerializer, MenuItemSerializer, OrderSerializer
+from .streaming import STREAM_QUERY_PARAM
+from .throttling import athrottle
+
+# Native async versions of the hottest read endpoints, used when the project is served through
+# LittleLemon/asgi.py (see ASYNC_READ_VIEWS in settings). GET requests for JSON (or MessagePack) are
+# answered on the event loop with the async ORM and async authentication; every other request (writes, the
+# browsable API, ?format=, ?stream=true) goes to the regular sync DRF view, so the API behaves exactly the same.
+
+
+class UseSyncView(Exception):
+    # Raised by a handler to hand the request over to the sync view
+    pass
+
+
+def handles(request):
+    if request.method != 'GET' or 'format' in request.GET or STREAM_QUERY_PARAM in request.GET:
+        return False
+    # Anything asking for HTML gets the browsable API from the sync view
+    return 'text/html' not in request.headers.get('Accept', '')
+
+
+def async_read_view(sync_view, token=True, session=True):
+    # Wraps an async handler taking a DRF Request and returning an unrendered Response.
+    # token/session choose the authentication, like the sync view's authentication_classes.
+    def decorator(handler):
+        run_sync_view = sync_to_async(sync_view)
+
+        @functools.wraps(handler)
+        async def view(request, *args, **kwargs):
+            if not handles(request):
+                return await run_sync_view(request, *args, **kwargs)
+            drf_request = Request(request)
+            try:
+                negotiate(drf_request)
+                drf_request.user = await aauthenticate(request, token=token, session=session)
+                await athrottle(drf_request)
+                response = await handler(drf_request, *args, **kwargs)
+            except UseSyncView:
+                return await run_sync_view(request, *args, **kwargs)
+            except APIException as exc:
+                response = handle_exception(exc)
+            return render(drf_request, response)
+
+        # DRF views are csrf exempt too; session authentication only matters for unsafe methods
+        view.csrf_exempt = True
+        return view
+
+    return decorator
+
+
+def handle_exception(exc):
+    # What APIView.handle_exception does; every view here accepts tokens, so a 401 says how to authenticate
+    if exc.status_code == 401:
+        exc.auth_header = TOKEN_KEYWORD
+    return exception_handler(exc, {})
+
+
+def renderers():
+    # The sync views' renderers, except the browsable API that handles() leaves to them
+    return [renderer() for renderer in api_settings.DEFAULT_RENDERER_CLASSES if renderer.format != 'api']
+
+
+def negotiate(request):
+    # Picks the renderer from the Accept header like APIView.perform_content_negotiation (406 if none fits)
+    request.accepted_renderer, request.accepted_media_type = DefaultContentNegotiation().select_renderer(
+        request, renderers())
+
+
+def render(request, response):
+    # Errors raised before or during negotiation are rendered with the first renderer, like DRF does
+    response.accepted_renderer = getattr(request, 'accepted_renderer', None) or renderers()[0]
+    response.accepted_media_type = getattr(request, 'accepted_media_type', None) or \
+        response.accepted_renderer.media_type
+    response.renderer_context = {'request': request, 'response': response}
+    patch_vary_headers(response, ['Accept'])
+    with measure('render'):
+        return response.render()
+
+
+async def check_role(request, role, message):
+    # What a DRF permission class does when it fails: 401 for anonymous users, 403 otherwise
+    if role not in await aget_roles(request.user):
+        if not request.user.is_authenticated:
+            raise NotAuthenticated()
+        raise PermissionDenied(message)
+
+
+@async_read_view(views.return_user)
+async def return_user(request):
+    if not request.user.is_authenticated:
+        raise UseSyncView
+    return Response({'username': request.user.username, 'email': request.user.email})
+
+
+@async_read_view(views.get_post_menu_items, session=False)
+@acache_menu_response
+async def get_post_menu_items(request):
+    queryset = filter_menu_items(MenuItem.objects.all(), request.query_params)
+    paginator = MenuItemPagination()
+    return await apaginated_list(paginator, queryset, request, MenuItemSerializer)
+
+
+@async_read_view(views.edit_single_menu_item)
+async def edit_single_menu_item(request, menu_item):
+    await check_role(request, MANAGER, IsManager.message)
+    return await single_menu_item(request, menu_item=menu_item)
+
+
+@acache_menu_response
+async def single_menu_item(request, menu_item):
+    try:
+        menu_item_object = await MenuItem.objects.aget(title=menu_item)
+    except MenuItem.DoesNotExist:
+        raise NotFound('No MenuItem matches the given query.')
+    serializer = MenuItemSerializer(menu_item_object)
+    return Response(serializer.data)
+
+
+@async_read_view(views.edit_cart)
+async def edit_cart(request):
+    if not request.user.is_authenticated:
+        raise UseSyncView
+    store = get_cart_store()
+    if store is not None:
+        # The local store is a dict behind a lock; the SQLite one may wait on its file lock, off the event loop
+        if isinstance(store, LocalCartStore):
+            items = store.get(request.user.pk)
+        else:
+            items = await sync_to_async(store.get)(request.user.pk)
+        if items is None:
+            # Not in the store yet: the sync view loads it from the Cart table
+            raise UseSyncView
+        return Response(items)
+    return Response(await aserialize_list(user_cart(request.user), CartSerializer))
+
+
+@async_read_view(views.manage_orders)
+async def manage_orders(request):
+    user = request.user
+    if not user.is_authenticated or 'start' in request.query_params or 'end' in request.query_params:
+        # Date ranges include the order archive, which only the sync view reads
+        raise UseSyncView
+    roles = await aget_roles(user)
+    if MANAGER in roles:
+        order = Order.objects.all()
+    elif DELIVERY_CREW in roles:
+        order = Order.objects.filter(delivery_crew=user)
+    else:
+        order = Order.objects.filter(user=user)
+    return Response(await aserialize_list(views.orders_with_items(order).order_by('pk'), OrderSerializer))
+
+
+# Server-sent events (text/event-stream) for the orders the user sees in /api/orders/: `order.placed`,
+# `order.assigned` and `order.delivered`, each with the order's id, status, delivery crew, total and date.
+# Only served under LittleLemon/asgi.py, where an idle connection costs a coroutine rather than a worker thread;
+# under WSGI the endpoint answers 501.
+EVENT_PREFIX = 'order.'
+
+
+def sse(event_id=None, kind=None, data=None, comment=None):
+    lines = []
+    if comment is not None:
+        lines.append(f': {comment}')
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if kind is not None:
+        lines.append(f'event: {kind}')
+    if data is not None:
+        lines.append('data: ' + json.dumps(data, separators=(',', ':')))
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+def last_event_id(request):
+    # Sent by EventSource when it reconnects; ?last_event_id= for clients that can't set headers
+    value = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+class StreamingNeedsASGI(APIException):
+    status_code = 501
+    default_detail = 'Order event streams are only served under ASGI (LittleLemon/asgi.py).'
+    default_code = 'asgi_required'
+
+
+async def order_events(request):
+    drf_request = Request(request)
+    try:
+        if request.method != 'GET':
+            raise MethodNotAllowed(request.method)
+        if not isinstance(request, ASGIRequest):
+            # Under WSGI Django collects the whole body of an async stream before sending any of it, and this
+            # one never ends: each client would hold a worker forever without receiving anything
+            raise StreamingNeedsASGI()
+        drf_request.user = await aauthenticate(request)
+        if not drf_request.user.is_authenticated:
+            raise NotAuthenticated()
+        await athrottle(drf_request)
+    except APIException as exc:
+        return render(drf_request, handle_exception(exc))
+    user = drf_request.user
+    roles = await aget_roles(user)
+    stream = stream_events(events.get_broker(), user.pk, DELIVERY_CREW in roles, MANAGER in roles,
+                           last_event_id(request))
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stops nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+order_events.csrf_exempt = True
+
+
+async def stream_events(broker, user_id, crew, manager, last_id):
+    # Subscribes once the body is being sent, so a response that never is (the client went away first) leaves
+    # no subscription behind. Subscribed before the backlog is read, so nothing published in between is lost;
+    # the live events the backlog already had are skipped.
+    subscription = broker.subscribe(user_id, crew=crew, manager=manager)
+    try:
+        yield f'retry: {events.setting("ORDER_EVENTS_RETRY_MS")}\n\n'.encode()
+        sent = 0
+        if last_id is not None:
+            backlog, complete = await broker.backlog(subscription, last_id)
+            if not complete:
+                yield sse(kind=events.RESET, data={})
+            for event in backlog:
+                yield sse(event.id, EVENT_PREFIX + event.kind, event.data)
+            sent = backlog[-1].id if backlog else 0
+        heartbeat = events.setting('ORDER_EVENTS_HEARTBEAT')
+        while True:
+            pending = await subscription.next(heartbeat)
+            if subscription.overflow:
+                # Too slow a reader: the client reconnects and resumes, or reloads the orders
+                yield sse(kind=events.RESET, data={})
+                return
+            if not pending:
+                # Keeps proxies from closing an idle connection
+                yield sse(comment='keepalive')
+                continue
+            chunk = b''.join(sse(event.id, EVENT_PREFIX + event.kind, event.data)
+                             for event in pending if event.id > sent)
+            if chunk:
+                yield chunk
+    finally:
+        broker.unsubscribe(subscription)
@@ -0,0 +1,266 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import caches
+from django.db import router
+from rest_framework import HTTP_HEADER_ENCODING
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from .roles import REQUEST_ATTRIBUTE, aget_roles, get_roles
+
+# Cache of token key -> (user, roles), so authenticating a request doesn't join authtoken_token and
+# auth_user every time. Each process keeps an LRU of entries for TOKEN_CACHE_TTL seconds, in front of the
+# shared TOKEN_CACHE_ALIAS tier (file-based by default, or Redis) that other processes fill from, and that
+# holds a generation number per user which every hit is checked against, so a revocation in one process is
+# seen by all of them on their next request. Without a shared tier, revocations only reach this process.
+# The receivers in signals.py revoke on token deletion (djoser's token logout), on any save of the user
+# (deactivation, password change) and on group changes.
+_entries = OrderedDict()  # sha256(key) -> (expires_at, entry)
+_user_keys = {}  # user id -> set of digests, for revoking everything a user holds
+_lock = threading.Lock()
+# Bumped on every invalidation so a lookup that raced with a revocation doesn't store a stale entry
+_generation = 0
+
+# The password hash is never cached (nor sent to the shared tier); it is deferred on the rebuilt user
+# and loaded on access, and a save() of the user only writes the fields that were loaded
+USER_FIELDS = tuple(f.attname for f in User._meta.concrete_fields if f.attname != 'password')
+SHARED_PREFIX = 'auth-token'
+SHARED_EPOCH_KEY = f'{SHARED_PREFIX}:epoch'
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    # TokenAuthentication backed by the token cache: same Authorization: Token <key> header, same errors
+    def authenticate_credentials(self, key):
+        cached = cached_token(key)
+        if cached is not None:
+            return cached
+        generation = _generation
+        user, token = super().authenticate_credentials(key)
+        store_token(token, user, get_roles(user), generation)
+        return user, token
+
+
+def token_digest(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_shared_cache():
+    alias = getattr(settings, 'TOKEN_CACHE_ALIAS', 'auth-tokens')
+    return caches[alias] if alias else None
+
+
+def shared_generation_keys(user_id):
+    # A user's entries are valid while both the global epoch and the user's own generation are unchanged
+    return [SHARED_EPOCH_KEY, f'{SHARED_PREFIX}:user:{user_id}']
+
+
+def cached_token(key):
+    # Returns (user, token) for a cached key, or None
+    digest = token_digest(key)
+    entry = local_entry(digest)
+    shared = get_shared_cache()
+    if shared is None:
+        return None if entry is None else rebuild(key, entry)
+    from_shared = entry is None
+    if from_shared:
+        entry = shared.get(f'{SHARED_PREFIX}:{digest}')
+        if entry is None:
+            return None
+    keys = shared_generation_keys(entry[0])
+    found = shared.get_many(keys)
+    return check_shared_entry(key, digest, entry, tuple(found.get(k) for k in keys), from_shared)
+
+
+async def acached_token(key):
+    # cached_token for async views
+    digest = token_digest(key)
+    entry = local_entry(digest)
+    shared = get_shared_cache()
+    if shared is None:
+        return None if entry is None else rebuild(key, entry)
+    from_shared = entry is None
+    if from_shared:
+        entry = await shared.aget(f'{SHARED_PREFIX}:{digest}')
+        if entry is None:
+            return None
+    keys = shared_generation_keys(entry[0])
+    found = await shared.aget_many(keys)
+    return check_shared_entry(key, digest, entry, tuple(found.get(k) for k in keys), from_shared)
+
+
+def local_entry(digest):
+    with _lock:
+        item = _entries.get(digest)
+        if item is None:
+            return None
+        if item[0] <= time.monotonic():
+            forget(digest)
+            return None
+        _entries.move_to_end(digest)
+        return item[1]
+
+
+def check_shared_entry(key, digest, entry, generation, from_shared):
+    if entry[4] != generation:
+        # Revoked by some process (or the generation keys were evicted)
+        with _lock:
+            forget(digest)
+        return None
+    if from_shared:
+        remember(digest, entry, _generation)
+    return rebuild(key, entry)
+
+
+def rebuild(key, entry):
+    # A fresh user and token per request; the cached roles become the request's roles
+    user_id, values, roles, created, _ = entry
+    db = router.db_for_read(User)
+    user = User.from_db(db, USER_FIELDS, values)
+    setattr(user, REQUEST_ATTRIBUTE, roles)
+    token = Token.from_db(router.db_for_read(Token), ['key', 'user_id', 'created'], [key, user_id, created])
+    token.user = user
+    return user, token
+
+
+def make_entry(token, user, roles):
+    return (user.pk, tuple(getattr(user, field) for field in USER_FIELDS), roles, token.created, None)
+
+
+def store_token(token, user, roles, generation):
+    digest = token_digest(token.key)
+    entry = make_entry(token, user, roles)
+    shared = get_shared_cache()
+    if shared is not None:
+        keys = shared_generation_keys(user.pk)
+        found = shared.get_many(keys)
+        if len(found) < len(keys):
+            for key in keys:
+                shared.add(key, time.time_ns(), None)
+            found = shared.get_many(keys)
+        entry = entry[:4] + (tuple(found.get(k) for k in keys),)
+        shared.set(f'{SHARED_PREFIX}:{digest}', entry, token_cache_ttl())
+    remember(digest, entry, generation)
+
+
+async def astore_token(token, user, roles, generation):
+    # store_token for async views
+    digest = token_digest(token.key)
+    entry = make_entry(token, user, roles)
+    shared = get_shared_cache()
+    if shared is not None:
+        keys = shared_generation_keys(user.pk)
+        found = await shared.aget_many(keys)
+        if len(found) < len(keys):
+            for key in keys:
+                await shared.aadd(key, time.time_ns(), None)
+            found = await shared.aget_many(keys)
+        entry = entry[:4] + (tuple(found.get(k) for k in keys),)
+        await shared.aset(f'{SHARED_PREFIX}:{digest}', entry, token_cache_ttl())
+    remember(digest, entry, generation)
+
+
+def token_cache_ttl():
+    return getattr(settings, 'TOKEN_CACHE_TTL', 60)
+
+
+def remember(digest, entry, generation):
+    with _lock:
+        if generation != _generation:
+            return
+        forget(digest)
+        if len(_entries) >= getattr(settings, 'TOKEN_CACHE_MAX_ENTRIES', 10000):
+            # Least recently used first
+            forget(next(iter(_entries)))
+        _entries[digest] = (time.monotonic() + token_cache_ttl(), entry)
+        _user_keys.setdefault(entry[0], set()).add(digest)
+
+
+def forget(digest):
+    # Callers hold _lock
+    item = _entries.pop(digest, None)
+    if item is not None:
+        digests = _user_keys.get(item[1][0])
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del _user_keys[item[1][0]]
+
+
+def invalidate_tokens(user_ids=None):
+    # Revokes the cached tokens of the given user ids, or of everyone when user_ids is None
+    global _generation
+    with _lock:
+        _generation += 1
+        if user_ids is None:
+            _entries.clear()
+            _user_keys.clear()
+        else:
+            for user_id in user_ids:
+                for digest in list(_user_keys.get(user_id, ())):
+                    forget(digest)
+    shared = get_shared_cache()
+    if shared is not None:
+        if user_ids is None:
+            shared.set(SHARED_EPOCH_KEY, time.time_ns(), None)
+        else:
+            shared.set_many({shared_generation_keys(user_id)[1]: time.time_ns() for user_id in user_ids}, None)
+
+
+# The async views in async_views.py can't use DRF's authentication classes (they query the database
+# synchronously), so this mirrors TokenAuthentication and SessionAuthentication with the async ORM:
+# the same Authorization: Token <key> header, the same error messages, the same fallback order.
+TOKEN_KEYWORD = 'Token'
+
+
+async def aauthenticate(request, token=True, session=True):
+    # Returns the authenticated user, or AnonymousUser. Raises AuthenticationFailed for a bad token.
+    if token:
+        user = await aauthenticate_token(request)
+        if user is not None:
+            return user
+    if session:
+        user = await asession_user(request)
+        # SessionAuthentication ignores inactive users
+        if user is not None and user.is_authenticated and user.is_active:
+            return user
+    return AnonymousUser()
+
+
+async def asession_user(request):
+    # The session's user as set up by AuthenticationMiddleware, or None without the middleware
+    if hasattr(request, 'auser'):
+        return await request.auser()
+    return None
+
+
+async def aauthenticate_token(request):
+    auth = request.headers.get('Authorization', '').encode(HTTP_HEADER_ENCODING).split()
+    if not auth or auth[0].lower() != TOKEN_KEYWORD.lower().encode():
+        return None
+    if len(auth) == 1:
+        raise AuthenticationFailed('Invalid token header. No credentials provided.')
+    if len(auth) > 2:
+        raise AuthenticationFailed('Invalid token header. Token string should not contain spaces.')
+    try:
+        key = auth[1].decode()
+    except UnicodeError:
+        raise AuthenticationFailed('Invalid token header. Token string should not contain invalid characters.')
+
+    cached = await acached_token(key)
+    if cached is not None:
+        return cached[0]
+    generation = _generation
+    try:
+        token = await Token.objects.select_related('user').aget(key=key)
+    except Token.DoesNotExist:
+        raise AuthenticationFailed('Invalid token.')
+    if not token.user.is_active:
+        raise AuthenticationFailed('User inactive or deleted.')
+    await astore_token(token, token.user, await aget_roles(token.user), generation)
+    return token.user
@@ -0,0 +1,445 @@
+import asyncio
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User, Group
+from django.db import connection
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, \
+    teardown_test_environment
+from rest_framework.authtoken.models import Token
+
+from .models import Cart, Category, MenuItem, Order, OrderItem
+from .roles import CUSTOMER, DELIVERY_CREW, MANAGER
+
+# Shared helpers for the bench_* management commands. Benchmarks run against a throwaway test
+# database (the same one `manage.py test` would create), so they never touch real data.
+
+
+@contextmanager
+def benchmark_database(keepdb=False):
+    # Also sets up the test environment, so requests to 'testserver' are allowed
+    setup_test_environment(debug=False)
+    old_config = setup_databases(verbosity=0, interactive=False, keepdb=keepdb, aliases={'default'})
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0, keepdb=keepdb)
+        teardown_test_environment()
+
+
+def get_user(username, role=None):
+    user, created = User.objects.get_or_create(username=username)
+    if created and role:
+        Group.objects.get_or_create(name=role)[0].user_set.add(user)
+    return user
+
+
+def benchmark_users():
+    return {
+        MANAGER: get_user('bench-manager', MANAGER),
+        DELIVERY_CREW: get_user('bench-crew', DELIVERY_CREW),
+        CUSTOMER: get_user('bench-customer', CUSTOMER),
+    }
+
+
+def seed_menu_items(count, categories=10):
+    # Makes sure at least `count` menu items exist and returns their ids
+    category_ids = [
+        Category.objects.get_or_create(slug=f'category-{i}', title=f'Category {i}')[0].pk for i in range(categories)
+    ]
+    existing = MenuItem.objects.count()
+    MenuItem.objects.bulk_create(
+        MenuItem(title=f'Bench item {i}', price=Decimal(1 + i % 50) + Decimal('0.99'), featured=i % 10 == 0,
+                 category_id=category_ids[i % categories])
+        for i in range(existing, count)
+    )
+    return list(MenuItem.objects.order_by('pk').values_list('pk', flat=True)[:count])
+
+
+def seed_orders(count, items_per_order=3, customer=None, crew=None):
+    # Adds orders (with items_per_order items each) until at least `count` orders exist
+    users = benchmark_users()
+    customer = customer or users[CUSTOMER]
+    crew = crew or users[DELIVERY_CREW]
+    menu_item_ids = seed_menu_items(max(items_per_order, 20))
+    missing = count - Order.objects.count()
+    for start in range(0, max(missing, 0), 5000):
+        orders = Order.objects.bulk_create(
+            Order(user=customer, delivery_crew=crew, status=i % 2 == 0, total=Decimal('9.00') * items_per_order,
+                  date=datetime.date(2024, 1, 1) + datetime.timedelta(days=i % 365))
+            for i in range(start, min(start + 5000, missing))
+        )
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, menuitem_id=menu_item_ids[(order.pk + j) % len(menu_item_ids)], quantity=1,
+                      unit_price=Decimal('9.00'), price=Decimal('9.00'))
+            for order in orders for j in range(items_per_order)
+        )
+
+
+def seed_cart_rows(count, per_user=100):
+    # Makes sure at least `count` cart rows exist, filling the carts of bench-cart-<n> customers
+    menu_item_ids = seed_menu_items(per_user)
+    i = 0
+    while (missing := count - Cart.objects.count()) > 0:
+        user = get_user(f'bench-cart-{i}', CUSTOMER)
+        Cart.objects.bulk_create((
+            Cart(user=user, menuitem_id=pk, quantity=2, unit_price=Decimal('4.50'), price=Decimal('9.00'))
+            for pk in menu_item_ids[:missing]
+        ), ignore_conflicts=True)
+        i += 1
+
+
+def seed_read_scenario(menu_items=1000, orders=200, cart_items=5):
+    # Data for the read benchmarks; returns {'tokens': {role: key}, 'menu_item': title}
+    users = benchmark_users()
+    menu_item_ids = seed_menu_items(menu_items)
+    seed_orders(orders)
+    customer = users[CUSTOMER]
+    Cart.objects.filter(user=customer).delete()
+    Cart.objects.bulk_create(
+        Cart(user=customer, menuitem_id=pk, quantity=1, unit_price=Decimal('1.99'), price=Decimal('1.99'))
+        for pk in menu_item_ids[:cart_items]
+    )
+    return {
+        'tokens': {role: Token.objects.get_or_create(user=user)[0].key for role, user in users.items()},
+        'menu_item': MenuItem.objects.get(pk=menu_item_ids[0]).title,
+    }
+
+
+def seed_write_scenario(customers=32, menu_items=50):
+    # Data for the write benchmarks: customers with tokens (and empty carts) and the menu item titles
+    # they order; returns {'tokens': [key, ...], 'menu_items': [title, ...]}
+    menu_item_ids = seed_menu_items(menu_items)
+    tokens = []
+    for i in range(customers):
+        user = get_user(f'bench-writer-{i}', CUSTOMER)
+        user.cart_set.all().delete()
+        tokens.append(Token.objects.get_or_create(user=user)[0].key)
+    return {
+        'tokens': tokens,
+        'menu_items': list(MenuItem.objects.filter(pk__in=menu_item_ids).values_list('title', flat=True)),
+    }
+
+
+# Realistic data at scale, for the load benchmarks (and for trying the API against a big database).
+# Everything is inserted with bulk_create in batches, so a million menu items take seconds, not hours.
+# Seeding is additive: it tops each table up to the requested size and can be re-run safely.
+CATEGORY_NAMES = ['Starters', 'Salads', 'Mains', 'Grill', 'Pasta', 'Seafood', 'Vegetarian', 'Sides', 'Desserts',
+                  'Drinks']
+DISH_NAMES = ['Bruschetta', 'Greek Salad', 'Lemon Dessert', 'Grilled Fish', 'Moussaka', 'Falafel', 'Hummus',
+              'Souvlaki', 'Baklava', 'Spanakopita', 'Lamb Kofta', 'Calamari', 'Tabbouleh', 'Risotto', 'Gyro']
+DISH_STYLES = ['Classic', 'House', 'Spicy', 'Vegan', 'Family', 'Small', 'Large', "Chef's"]
+# Orders and carts pick from the first POPULAR_ITEMS menu items, like real orders cluster on a few dishes
+POPULAR_ITEMS = 500
+
+
+def seed_data(managers=2, delivery_crew=10, customers=1000, categories=20, menu_items=10000, orders=10000,
+              items_per_order=3, cart_items=2, batch_size=5000, seed=0):
+    # Returns {'counts': {...}, 'tokens': {role: [key, ...]}, 'categories': [...], 'menu_items': [...]}
+    rng = random.Random(seed)
+    user_ids = {
+        MANAGER: seed_users(MANAGER, managers, batch_size),
+        DELIVERY_CREW: seed_users(DELIVERY_CREW, delivery_crew, batch_size),
+        CUSTOMER: seed_users(CUSTOMER, customers, batch_size),
+    }
+    seed_categories(categories)
+    seed_catalog(menu_items, batch_size, rng)
+    popular = list(MenuItem.objects.order_by('pk').values_list('pk', 'price', 'title')[:POPULAR_ITEMS])
+    if popular:
+        seed_scale_orders(orders, user_ids[CUSTOMER], user_ids[DELIVERY_CREW], popular,
+                          min(items_per_order, len(popular)), batch_size, rng)
+        seed_carts(user_ids[CUSTOMER], popular, min(cart_items, len(popular)), batch_size, rng)
+    return {
+        'counts': {
+            'users': User.objects.count(),
+            'categories': Category.objects.count(),
+            'menu_items': MenuItem.objects.count(),
+            'orders': Order.objects.count(),
+            'order_items': OrderItem.objects.count(),
+            'cart_items': Cart.objects.count(),
+        },
+        'tokens': {
+            role: list(Token.objects.filter(user_id__in=ids).order_by('user_id').values_list('key', flat=True))
+            for role, ids in user_ids.items()
+        },
+        'categories': list(Category.objects.order_by('pk').values_list('title', flat=True)[:categories]),
+        'menu_items': [title for _, _, title in popular],
+    }
+
+
+def seed_users(role, count, batch_size):
+    # Users named seed-<role>-<n> in the role's group, each with a token; returns their ids
+    group = Group.objects.get_or_create(name=role)[0]
+    prefix = f'seed-{role.lower().replace(" ", "-")}-'
+    existing = User.objects.filter(username__startswith=prefix).count()
+    # One unusable password for everyone: hashing a real one per user would dominate the seeding time
+    password = make_password(None)
+    for start in range(existing, count, batch_size):
+        users = User.objects.bulk_create(
+            User(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com', password=password)
+            for i in range(start, min(start + batch_size, count))
+        )
+        User.groups.through.objects.bulk_create(
+            [User.groups.through(user_id=user.pk, group_id=group.pk) for user in users], ignore_conflicts=True)
+        Token.objects.bulk_create(Token(key=Token.generate_key(), user_id=user.pk) for user in users)
+    return list(User.objects.filter(username__startswith=prefix).order_by('pk').values_list('pk', flat=True)[:count])
+
+
+def seed_categories(count):
+    existing = Category.objects.count()
+    Category.objects.bulk_create((
+        Category(slug=f'{CATEGORY_NAMES[i % len(CATEGORY_NAMES)].lower()}-{i}',
+                 title=f'{CATEGORY_NAMES[i % len(CATEGORY_NAMES)]} {i // len(CATEGORY_NAMES) + 1}')
+        for i in range(existing, count)
+    ), ignore_conflicts=True)
+
+
+def seed_catalog(count, batch_size, rng):
+    category_ids = list(Category.objects.values_list('pk', flat=True))
+    existing = MenuItem.objects.count()
+    for start in range(existing, count, batch_size):
+        MenuItem.objects.bulk_create((
+            MenuItem(title=f'{rng.choice(DISH_STYLES)} {DISH_NAMES[i % len(DISH_NAMES)]} {i}',
+                     price=Decimal(rng.randrange(250, 4000)) / 100, featured=rng.random() < 0.05,
+                     category_id=rng.choice(category_ids))
+            for i in range(start, min(start + batch_size, count))
+        ), ignore_conflicts=True)
+
+
+def seed_scale_orders(count, customer_ids, crew_ids, popular, items_per_order, batch_size, rng):
+    today = datetime.date.today()
+    missing = count - Order.objects.count()
+    for start in range(0, max(missing, 0), batch_size):
+        picks = [rng.sample(popular, items_per_order) for _ in range(min(batch_size, missing - start))]
+        ages = [rng.randrange(365) for _ in picks]
+        orders = Order.objects.bulk_create(
+            # Most older orders have been delivered; roughly a third of the recent ones await a crew member
+            Order(user_id=rng.choice(customer_ids),
+                  delivery_crew_id=rng.choice(crew_ids) if crew_ids and (age > 1 or rng.random() < 0.7) else None,
+                  status=age > 1, date=today - datetime.timedelta(days=age),
+                  total=sum(price for _, price, _ in items))
+            for items, age in zip(picks, ages)
+        )
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, menuitem_id=pk, quantity=1, unit_price=price, price=price)
+            for order, items in zip(orders, picks) for pk, price, _ in items
+        )
+
+
+def seed_carts(customer_ids, popular, cart_items, batch_size, rng):
+    # Only empty carts are filled, so re-running the seeder doesn't grow them
+    filled = set(Cart.objects.values_list('user_id', flat=True).distinct())
+    rows = (
+        Cart(user_id=user_id, menuitem_id=pk, quantity=1, unit_price=price, price=price)
+        for user_id in customer_ids if user_id not in filled for pk, price, _ in rng.sample(popular, cart_items)
+    )
+    while batch := [row for _, row in zip(range(batch_size), rows)]:
+        Cart.objects.bulk_create(batch)
+
+
+def count_scenario_queries(path, limit=20):
+    # Replays the first `limit` requests of every scenario in the JSON file {scenario: [[method, path,
+    # headers, body], ...]} in-process and returns the mean number of SQL queries per request
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    setup_test_environment(debug=False)
+    client = Client()
+    with open(path) as f:
+        scenarios = json.load(f)
+    counts = {}
+    for name, requests in scenarios.items():
+        total = 0
+        for method, url, headers, body in requests[:limit]:
+            headers = dict(headers)
+            content_type = headers.pop('Content-Type', 'application/octet-stream')
+            with CaptureQueriesContext(connection) as queries:
+                client.generic(method, url, body or '', content_type=content_type, headers=headers)
+            total += len(queries)
+        counts[name] = total / max(min(len(requests), limit), 1)
+    teardown_test_environment()
+    return counts
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Timer:
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.started
+
+
+def percentile(samples, percent):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def write_report(command, headers, rows, as_json=False):
+    # Prints rows as an aligned table, or as JSON lines that are easy to diff between commits
+    if as_json:
+        for row in rows:
+            command.stdout.write(json.dumps(dict(zip(headers, row)), default=str))
+        return
+    cells = [[str(cell) for cell in headers]] + [
+        [f'{cell:.3f}' if isinstance(cell, float) else str(cell) for cell in row] for row in rows
+    ]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(headers))]
+    for row in cells:
+        command.stdout.write('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+# Load generation against a real server. The client is a small asyncio HTTP/1.1 keep-alive client, so
+# one process can hold many concurrent connections without the client becoming the bottleneck.
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def manage_py(*args, env=None, capture=False):
+    # Runs a manage.py command in a subprocess (e.g. against the scratch database given by SQLITE_PATH)
+    return subprocess.run(
+        [sys.executable, str(settings.BASE_DIR / 'manage.py'), *args],
+        env={**os.environ, **(env or {})}, check=True, text=True,
+        stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
+    ).stdout
+
+
+@contextmanager
+def server(args, env=None, port=None, timeout=30):
+    # Starts a server process (e.g. uvicorn) and waits until it accepts connections; yields the process
+    process = subprocess.Popen(args, env={**os.environ, **(env or {})}, cwd=settings.BASE_DIR,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f'server did not start: {" ".join(args)}')
+                time.sleep(0.1)
+        yield process
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def read_response(reader):
+    # Reads one HTTP/1.1 response; returns (status, body size, whether the server keeps the connection)
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    size = 0
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            chunk_size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(chunk_size + 2)
+            size += chunk_size
+            if chunk_size == 0:
+                break
+    elif 'content-length' in headers:
+        size = int(headers['content-length'])
+        await reader.readexactly(size)
+    return status, size, headers.get('connection', '').lower() != 'close'
+
+
+async def load_worker(host, port, requests, offset, deadline, results):
+    reader = writer = None
+    index = offset
+    while time.perf_counter() < deadline:
+        method, path, headers, body = requests[index % len(requests)]
+        index += 1
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {host}', *(f'{k}: {v}' for k, v in headers.items())]
+        if body is not None:
+            lines.append(f'Content-Length: {len(body)}')
+        payload = ('\r\n'.join(lines) + '\r\n\r\n').encode() + (body or b'')
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(payload)
+            status, _, keep_alive = await read_response(reader)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            results['errors'] += 1
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+        results['latencies'].append(time.perf_counter() - started)
+        results['statuses'][status] = results['statuses'].get(status, 0) + 1
+        # A 429 (or any other refusal) is not throughput
+        if not 200 <= status < 300:
+            results['errors'] += 1
+        if not keep_alive:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+def run_load(port, requests, concurrency, duration, host='127.0.0.1'):
+    # Replays requests [(method, path, headers, body), ...] round-robin from `concurrency` connections
+    # for `duration` seconds and returns throughput and latency percentiles (milliseconds). Only 2xx responses
+    # count towards rps; the others are errors, like failed connections.
+    results = {'latencies': [], 'errors': 0, 'statuses': {}}
+
+    async def main():
+        deadline = time.perf_counter() + duration
+        # Workers start spread out over the list, so they don't all replay the same requests in step
+        await asyncio.gather(*(
+            load_worker(host, port, requests, i * len(requests) // concurrency, deadline, results)
+            for i in range(concurrency)
+        ))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - started
+    latencies = results['latencies']
+    succeeded = sum(count for status, count in results['statuses'].items() if 200 <= status < 300)
+    return {
+        'requests': len(latencies),
+        'errors': results['errors'],
+        'rps': succeeded / elapsed,
+        'elapsed': elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'statuses': results['statuses'],
+    }
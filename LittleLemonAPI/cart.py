@@ -0,0 +1,83 @@
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, SmallIntegerField, Value, When
+from rest_framework.exceptions import ValidationError
+
+from .models import Cart, MenuItem
+
+# What the cart and order columns hold: quantities are smallint, prices (a line's and the order total)
+# numeric(6, 2). PostgreSQL rejects anything bigger with a DataError, so carts are kept within them.
+MAX_QUANTITY = 32767
+MAX_PRICE = Decimal('9999.99')
+
+
+class CartLimitExceeded(ValidationError):
+    # 400, with a message like the cart views' other errors
+    default_detail = {'message': f'A cart holds at most {MAX_QUANTITY} of an item, and at most {MAX_PRICE} '
+                                 'per item and in total'}
+    default_code = 'cart_limit'
+
+
+def check_limits(lines):
+    # lines: [(quantity, price), ...] of the whole cart after a change
+    if any(quantity > MAX_QUANTITY or price > MAX_PRICE for quantity, price in lines) or \
+            sum(price for _, price in lines) > MAX_PRICE:
+        raise CartLimitExceeded()
+
+
+def user_cart(user):
+    # CartSerializer nests the full menu item, so load it in the same query
+    return Cart.objects.filter(user=user).select_related('menuitem').order_by('pk')
+
+
+def add_items(user, entries):
+    # Adds [{'menuitem': <title>, 'quantity': <n>}, ...] to the user's cart in a fixed number of queries.
+    # Items already in the cart get their quantity incremented. Returns the titles that don't exist;
+    # nothing is written unless every title resolved. Raises CartLimitExceeded, writing nothing, when the
+    # cart would outgrow MAX_QUANTITY or MAX_PRICE.
+    quantities = {}
+    for entry in entries:
+        quantities[entry['menuitem']] = quantities.get(entry['menuitem'], 0) + entry['quantity']
+
+    # One query resolves every title
+    rows = MenuItem.objects.filter(title__in=quantities).values_list('title', 'pk', 'price')
+    menu_items = {title: pk for title, pk, _ in rows}
+    prices = {pk: price for _, pk, price in rows}
+    unknown = [title for title in quantities if title not in menu_items]
+    if unknown:
+        return unknown
+
+    increments = {menu_items[title]: quantity for title, quantity in quantities.items()}
+    with transaction.atomic():
+        # Make sure a row exists for every item (existing rows are left alone), then increment all of
+        # them in one UPDATE. The increment is computed by the database from the current value, so two
+        # requests adding the same item at the same time both count.
+        Cart.objects.bulk_create(
+            [Cart(user=user, menuitem_id=pk, quantity=0, unit_price=prices[pk], price=0) for pk in increments],
+            ignore_conflicts=True,
+        )
+        # Lock the user's cart rows and check the new quantities and prices before the UPDATE, which
+        # would fail on PostgreSQL if they overflowed
+        lines = []
+        for pk, quantity, price in Cart.objects.select_for_update().filter(user=user).values_list(
+                'menuitem_id', 'quantity', 'price'):
+            if pk in increments:
+                quantity += increments[pk]
+                price = quantity * prices[pk]
+            lines.append((quantity, price))
+        check_limits(lines)
+        increment = Case(
+            *(When(menuitem_id=pk, then=Value(quantity)) for pk, quantity in increments.items()),
+            output_field=SmallIntegerField(),
+        )
+        unit_price = Case(
+            *(When(menuitem_id=pk, then=Value(prices[pk])) for pk in increments),
+            output_field=DecimalField(max_digits=6, decimal_places=2),
+        )
+        Cart.objects.filter(user=user, menuitem_id__in=increments).update(
+            quantity=F('quantity') + increment,
+            unit_price=unit_price,
+            price=(F('quantity') + increment) * unit_price,
+        )
+    return []
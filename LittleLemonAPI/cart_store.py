@@ -0,0 +1,369 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+from django.db.models import F
+
+from .cart import check_limits
+from .fast_serializers import serialize_list
+from .models import Cart, MenuItem
+from .serializers import CartSerializer, MenuItemSerializer
+
+# Write-behind carts. Carts take the most writes of anything in the API and most never become orders, so
+# with CART_STORE = local or sqlite the cart endpoints keep each user's cart in a key-value store instead of
+# the Cart table:
+# - local: a dict in this process. For a single worker; a restart loses what wasn't flushed yet.
+# - sqlite: one SQLite file shared by the workers on a machine, which survives restarts.
+# The default, database, keeps using the Cart table directly (cart.py).
+#
+# A stored cart is the list the endpoint returns, so reading it takes no query. Adding items takes one read
+# of MenuItem, to resolve the titles and snapshot their current price, and no write. The Cart table still
+# gets every cart, behind the store: checkout orders the stored cart and empties it (orders.checkout), and
+# every CART_FLUSH_INTERVAL seconds a background thread writes the carts changed since the last flush (so
+# does `manage.py flush_carts`). A cart missing from the store is loaded from the Cart table.
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal('0.01')
+
+
+class LocalCartStore:
+    def __init__(self):
+        self.carts = {}  # user id -> (items, version, dirty, updated)
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            cart = self.carts.get(user_id)
+        return None if cart is None else cart[0]
+
+    def load(self, user_id, items):
+        # Adds a cart read from the Cart table, unless the store got one meanwhile; returns the stored items
+        with self.lock:
+            if user_id not in self.carts:
+                self.carts[user_id] = (items, 0, False, time.time())
+            return self.carts[user_id][0]
+
+    def update(self, user_id, function):
+        # Replaces a stored cart with function(items) atomically; returns (old items, new items), or None when
+        # the cart isn't stored (any more)
+        with self.lock:
+            cart = self.carts.get(user_id)
+            if cart is None:
+                return None
+            items, version, _, _ = cart
+            new = function(items)
+            self.carts[user_id] = (new, version + 1, True, time.time())
+        return items, new
+
+    def version(self, user_id):
+        # The stored cart's version (bumped by every change), or None
+        with self.lock:
+            cart = self.carts.get(user_id)
+        return None if cart is None else cart[1]
+
+    def dirty(self, limit):
+        # [(user id, version, items)] of carts changed since they were last flushed
+        with self.lock:
+            return [(user_id, version, items) for user_id, (items, version, dirty, _) in self.carts.items()
+                    if dirty][:limit]
+
+    def flushed(self, user_id, version):
+        # Marks a cart clean, unless it changed again since `version` was read
+        with self.lock:
+            cart = self.carts.get(user_id)
+            if cart is not None and cart[1] == version:
+                self.carts[user_id] = (cart[0], version, False, cart[3])
+
+    def forget_idle(self, before):
+        # Clean carts not changed since `before` are in the Cart table; the store doesn't need them
+        with self.lock:
+            self.carts = {user_id: cart for user_id, cart in self.carts.items() if cart[2] or cart[3] >= before}
+
+    def reset(self):
+        with self.lock:
+            self.carts.clear()
+
+
+class SQLiteCartStore:
+    # Every worker process opens the file itself; WAL lets them share it, and updates run in an IMMEDIATE
+    # transaction, so two workers changing the same cart at once take turns
+    def __init__(self, path):
+        self.path = str(path)
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # A crash may lose the last few writes, but not corrupt the file
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS carts (user_id INTEGER PRIMARY KEY, items TEXT NOT NULL, '
+                               'version INTEGER NOT NULL, dirty INTEGER NOT NULL, updated REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS carts_dirty ON carts (user_id) WHERE dirty')
+            self.local.connection = connection
+        return connection
+
+    def get(self, user_id):
+        row = self.connection().execute('SELECT items FROM carts WHERE user_id = ?', (user_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def load(self, user_id, items):
+        connection = self.connection()
+        connection.execute('INSERT INTO carts VALUES (?, ?, 0, 0, ?) ON CONFLICT DO NOTHING',
+                           (user_id, json.dumps(items), time.time()))
+        return self.get(user_id)
+
+    def update(self, user_id, function):
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT items, version FROM carts WHERE user_id = ?', (user_id,)).fetchone()
+            if row is None:
+                connection.execute('ROLLBACK')
+                return None
+            items, version = json.loads(row[0]), row[1]
+            new = function(items)
+            connection.execute('UPDATE carts SET items = ?, version = ?, dirty = 1, updated = ? WHERE user_id = ?',
+                               (json.dumps(new), version + 1, time.time(), user_id))
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return items, new
+
+    def version(self, user_id):
+        row = self.connection().execute('SELECT version FROM carts WHERE user_id = ?', (user_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def dirty(self, limit):
+        rows = self.connection().execute('SELECT user_id, version, items FROM carts WHERE dirty LIMIT ?', (limit,))
+        return [(user_id, version, json.loads(items)) for user_id, version, items in rows]
+
+    def flushed(self, user_id, version):
+        self.connection().execute('UPDATE carts SET dirty = 0 WHERE user_id = ? AND version = ?', (user_id, version))
+
+    def forget_idle(self, before):
+        self.connection().execute('DELETE FROM carts WHERE NOT dirty AND updated < ?', (before,))
+
+    def reset(self):
+        self.connection().execute('DELETE FROM carts')
+
+
+_store = None
+_store_lock = threading.Lock()
+_flusher = None
+
+
+def get_cart_store():
+    # The configured store, or None when the carts live in the Cart table
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_store(getattr(settings, 'CART_STORE', 'database'))
+    return _store or None
+
+
+def create_store(name):
+    if name == 'database':
+        # Falsy but not None, so the setting is only read once
+        return False
+    if name == 'local':
+        return LocalCartStore()
+    if name == 'sqlite':
+        return SQLiteCartStore(settings.CART_SQLITE_PATH)
+    raise ImproperlyConfigured(f'Unknown CART_STORE {name!r}: use database, local or sqlite')
+
+
+def reset_cart_store():
+    # Drops every stored cart (flushed or not), and the store itself so a changed CART_STORE takes effect
+    global _store, _flusher
+    if _flusher is not None:
+        _flusher.stop.set()
+        _flusher = None
+    if _store:
+        _store.reset()
+    _store = None
+
+
+# Reading and changing carts
+
+def cart_items(store, user):
+    # The user's cart as CartSerializer would return it, loading it from the Cart table if needed
+    items = store.get(user.pk)
+    if items is None:
+        items = store.load(user.pk, serialize_list(Cart.objects.filter(user=user).select_related('menuitem')
+                                                   .order_by('pk'), CartSerializer))
+    return items
+
+
+def add_to_cart(store, user, entries):
+    # Adds [{'menuitem': <title>, 'quantity': <n>}, ...] like cart.add_items: items already in the cart get
+    # their quantity incremented and their current price. Returns (unknown titles, cart); nothing changes
+    # unless every title resolved. Raises CartLimitExceeded, changing nothing, like cart.add_items.
+    quantities = {}
+    for entry in entries:
+        quantities[entry['menuitem']] = quantities.get(entry['menuitem'], 0) + entry['quantity']
+    menu_items = menu_items_by_title(quantities)
+    unknown = [title for title in quantities if title not in menu_items]
+    if unknown:
+        return unknown, None
+
+    def add(items):
+        items = [dict(item) for item in items]
+        by_menu_item = {item['menuitem']['id']: item for item in items}
+        next_id = max((item['id'] for item in items), default=0) + 1
+        for title, quantity in quantities.items():
+            menu_item = menu_items[title]
+            item = by_menu_item.get(menu_item['id'])
+            if item is None:
+                item = {'id': next_id, 'menuitem': menu_item, 'quantity': 0, 'unit_price': None, 'price': None,
+                        'user': user.pk}
+                next_id += 1
+                items.append(item)
+            item['menuitem'] = menu_item
+            item['quantity'] += quantity
+            item['unit_price'] = menu_item['price']
+            item['price'] = str((Decimal(menu_item['price']) * item['quantity']).quantize(CENT))
+        check_limits([(item['quantity'], Decimal(item['price'])) for item in items])
+        return items
+
+    _, items = change_cart(store, user, add)
+    return [], items
+
+
+def empty_cart(store, user):
+    change_cart(store, user, lambda items: [])
+
+
+def take_cart(store, user):
+    # Empties the cart for checkout and returns what it held. A concurrent checkout finds it empty.
+    items, _ = change_cart(store, user, lambda items: [])
+    return items
+
+
+def restore_cart(store, user, taken):
+    # Puts back the items of a checkout that failed, merged with anything added since
+    def restore(items):
+        added = {item['menuitem']['id'] for item in items}
+        restored = [item for item in taken if item['menuitem']['id'] not in added]
+        next_id = max((item['id'] for item in restored), default=0) + 1
+        return restored + [{**item, 'id': next_id + i} for i, item in enumerate(items)]
+
+    change_cart(store, user, restore)
+
+
+def change_cart(store, user, function):
+    # store.update() on the user's cart, loading it first. The flusher may forget the cart between the load
+    # and the update; update() then finds no cart, which was clean, so loading it again gets the same items.
+    while True:
+        cart_items(store, user)
+        changed = store.update(user.pk, function)
+        if changed is not None:
+            started()
+            return changed
+
+
+def menu_items_by_title(titles):
+    # {title: MenuItemSerializer data} for the titles that exist. Read from MenuItem (one indexed query) rather
+    # than the menu cache: that one is per process by default, and a price snapshotted from another worker's
+    # stale copy would be charged at checkout.
+    return {data['title']: data for data in serialize_list(MenuItem.objects.filter(title__in=titles),
+                                                          MenuItemSerializer)}
+
+
+# Writing carts behind to the Cart table
+
+def flush_carts(store=None, batch_size=500):
+    # Writes every cart changed since the last flush to the Cart table; returns the number of carts
+    store = store or get_cart_store()
+    if not store:
+        return 0
+    flushed = 0
+    while carts := store.dirty(batch_size):
+        write_carts(store, carts)
+        for user_id, version, _ in carts:
+            store.flushed(user_id, version)
+        flushed += len(carts)
+        if len(carts) < batch_size:
+            break
+    store.forget_idle(time.time() - getattr(settings, 'CART_STORE_IDLE_SECONDS', 3600))
+    return flushed
+
+
+def lock_users(user_ids):
+    # Locks the users' rows with a no-op UPDATE, which takes the row locks on PostgreSQL/MySQL and the write
+    # lock on SQLite. The flusher and checkout both take it before touching a user's Cart rows.
+    User.objects.filter(pk__in=user_ids).update(last_login=F('last_login'))
+
+
+def write_carts(store, carts):
+    # Replaces the Cart rows of a batch of users with their stored carts, in a fixed number of queries.
+    # Carts changed since they were read from the store are skipped: a checkout may have ordered them
+    # meanwhile, and the next flush writes them anyway. Checking under the users' lock means a checkout that
+    # takes the cart after the check waits for this transaction and then deletes what it wrote.
+    # Items whose menu item (or user) was deleted meanwhile are dropped, as the cascade would have.
+    with transaction.atomic():
+        lock_users([user_id for user_id, _, _ in carts])
+        carts = [(user_id, version, items) for user_id, version, items in carts if store.version(user_id) == version]
+        user_ids = [user_id for user_id, _, _ in carts]
+        menu_item_ids = {item['menuitem']['id'] for _, _, items in carts for item in items}
+        Cart.objects.filter(user_id__in=user_ids).delete()
+        users = set(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+        menu_items = set(MenuItem.objects.filter(pk__in=menu_item_ids).values_list('pk', flat=True))
+        Cart.objects.bulk_create(
+            Cart(user_id=user_id, menuitem_id=item['menuitem']['id'], quantity=item['quantity'],
+                 unit_price=Decimal(item['unit_price']), price=Decimal(item['price']))
+            for user_id, _, items in carts if user_id in users
+            for item in items if item['menuitem']['id'] in menu_items
+        )
+
+
+class Flusher(threading.Thread):
+    # Calls flush_carts every CART_FLUSH_INTERVAL seconds, and once more when the process exits
+    def __init__(self, store, interval):
+        super().__init__(name='cart-flusher', daemon=True)
+        self.store = store
+        self.interval = interval
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        if self.stop.is_set():
+            return
+        try:
+            flush_carts(self.store)
+        except Exception:
+            logger.exception('Flushing carts failed')
+        finally:
+            close_old_connections()
+
+
+def started():
+    # Starts the flusher on the first cart change (CART_FLUSH_INTERVAL = 0 leaves flushing to checkout and
+    # `manage.py flush_carts`)
+    global _flusher
+    interval = getattr(settings, 'CART_FLUSH_INTERVAL', 5)
+    if _flusher is not None or not interval:
+        return
+    with _store_lock:
+        if _flusher is None:
+            _flusher = Flusher(get_cart_store(), interval)
+            _flusher.start()
+            atexit.register(_flusher.flush)
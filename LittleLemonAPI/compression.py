@@ -0,0 +1,129 @@
+import gzip
+import re
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# Response compression, negotiated through Accept-Encoding: brotli when the client takes it and the brotli
+# (or brotlicffi) package is installed, gzip otherwise. Only API payloads (JSON, MessagePack, text) above
+# COMPRESSION_MIN_SIZE bytes are compressed: below that the saving doesn't pay for the CPU time. Streamed
+# responses (?stream=true) are compressed chunk by chunk. Levels are kept low (COMPRESSION_GZIP_LEVEL,
+# COMPRESSION_BROTLI_QUALITY): most of the size reduction for a fraction of the time of the maximum levels.
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/msgpack', 'text/')
+# Event streams must reach the client event by event, which compressing proxies and clients don't all do
+INCOMPRESSIBLE_TYPES = ('text/event-stream',)
+ACCEPT_ENCODING_RE = re.compile(r'\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?\s*')
+
+
+def accepted_encodings(header):
+    # {coding: quality} from an Accept-Encoding header
+    encodings = {}
+    for part in header.split(','):
+        match = ACCEPT_ENCODING_RE.fullmatch(part)
+        if match:
+            try:
+                encodings[match[1].lower()] = float(match[2]) if match[2] else 1.0
+            except ValueError:
+                continue
+    return encodings
+
+
+def choose_encoding(header):
+    # 'br', 'gzip' or None. Brotli wins unless the client explicitly prefers gzip.
+    encodings = accepted_encodings(header)
+    wildcard = encodings.get('*', 0)
+    available = ('br', 'gzip') if brotli is not None else ('gzip',)
+    qualities = [(encodings.get(coding, wildcard), coding) for coding in available]
+    quality, coding = max(qualities, key=lambda entry: entry[0])
+    return coding if quality > 0 else None
+
+
+def gzip_level():
+    return getattr(settings, 'COMPRESSION_GZIP_LEVEL', 5)
+
+
+def brotli_quality():
+    return getattr(settings, 'COMPRESSION_BROTLI_QUALITY', 4)
+
+
+def compress(content, coding):
+    if coding == 'br':
+        return brotli.compress(content, quality=brotli_quality())
+    return gzip.compress(content, compresslevel=gzip_level(), mtime=0)
+
+
+def compressor(coding):
+    # (feed, finish) for compressing a stream
+    if coding == 'br':
+        stream = brotli.Compressor(quality=brotli_quality())
+        # Flushing after every chunk, so every chunk can be decoded as soon as it arrives
+        return lambda chunk: stream.process(chunk) + stream.flush(), stream.finish
+    # wbits 31: a gzip header and trailer around the deflate stream
+    stream = zlib.compressobj(gzip_level(), zlib.DEFLATED, 31)
+    return lambda chunk: stream.compress(chunk) + stream.flush(zlib.Z_SYNC_FLUSH), stream.flush
+
+
+def compress_sequence(chunks, coding):
+    feed, finish = compressor(coding)
+    for chunk in chunks:
+        data = feed(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+async def acompress_sequence(chunks, coding):
+    feed, finish = compressor(coding)
+    async for chunk in chunks:
+        data = feed(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    # Goes right after RequestMetricsMiddleware, so it compresses the final response of everything below it
+
+    def process_response(self, request, response):
+        content_type = response.get('Content-Type', '')
+        if response.has_header('Content-Encoding') or not content_type.startswith(COMPRESSIBLE_TYPES) or \
+                content_type.startswith(INCOMPRESSIBLE_TYPES):
+            return response
+        if not response.streaming and len(response.content) < getattr(settings, 'COMPRESSION_MIN_SIZE', 1024):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        coding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+        if coding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = acompress_sequence(response.streaming_content, coding)
+            else:
+                response.streaming_content = compress_sequence(response.streaming_content, coding)
+            del response.headers['Content-Length']
+        else:
+            compressed = compress(response.content, coding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        # The compressed bytes differ, but the representation is the same: strong ETags become weak ones,
+        # which If-None-Match (menu_cache.etag_matches) compares the same way
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = coding
+        return response
@@ -0,0 +1,106 @@
+import heapq
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Q, Value, When
+
+from .models import Order
+from .notifications import notify, order_events
+from .rollups import change
+from .roles import DELIVERY_CREW
+
+# Bulk delivery dispatch. An assignment only applies if the order is still in the state the manager saw:
+# unassigned (or assigned to expected_delivery_crew) and, when given, at expected_status. Two managers
+# dispatching the same orders at once therefore never overwrite each other: the second one gets those
+# orders back as conflicts, with their current crew and status.
+
+
+def crew_members(user_ids=None):
+    # The ids of the Delivery Crew members, optionally limited to user_ids
+    queryset = User.objects.filter(groups__name=DELIVERY_CREW)
+    if user_ids is not None:
+        queryset = queryset.filter(pk__in=user_ids)
+    return set(queryset.values_list('pk', flat=True))
+
+
+def dispatch(assignments):
+    # assignments: [{'order', 'delivery_crew', 'status', 'expected_delivery_crew', 'expected_status'}, ...]
+    # where status and expected_status may be None (keep / don't check). Runs in one transaction and a fixed
+    # number of queries whatever the number of orders. Returns {'applied', 'conflicts', 'not_found'}.
+    assignments = {assignment['order']: assignment for assignment in assignments}
+    with transaction.atomic():
+        # Lock the rows with a no-op UPDATE before reading them (row locks on PostgreSQL/MySQL, the write
+        # lock on SQLite), like checkout does, so the state read below can't change until we commit
+        Order.objects.filter(pk__in=assignments).update(status=F('status'))
+        current = {pk: (crew, status, date, total) for pk, crew, status, date, total in
+                   Order.objects.filter(pk__in=assignments).values_list('pk', 'delivery_crew_id', 'status', 'date',
+                                                                        'total')}
+
+        applied, conflicts = [], []
+        for pk, assignment in assignments.items():
+            if pk not in current:
+                continue
+            crew, status, _, _ = current[pk]
+            if crew != assignment['expected_delivery_crew'] or \
+                    assignment['expected_status'] not in (None, status):
+                conflicts.append({'order': pk, 'delivery_crew': crew, 'status': status})
+                continue
+            new_status = status if assignment['status'] is None else assignment['status']
+            applied.append({'order': pk, 'delivery_crew': assignment['delivery_crew'], 'status': new_status})
+
+        if applied:
+            # One UPDATE for every applied order. The WHERE clause repeats the expected states (one
+            # pk IN (...) term per distinct expected state), so the statement is conditional on its own too.
+            groups = {}
+            for entry in applied:
+                assignment = assignments[entry['order']]
+                key = (assignment['expected_delivery_crew'], assignment['expected_status'])
+                groups.setdefault(key, []).append(entry['order'])
+            expected = Q()
+            for (crew, status), pks in groups.items():
+                condition = Q(pk__in=pks, delivery_crew_id=crew) if crew is not None \
+                    else Q(pk__in=pks, delivery_crew__isnull=True)
+                if status is not None:
+                    condition &= Q(status=status)
+                expected |= condition
+            Order.objects.filter(expected).update(
+                delivery_crew_id=Case(*(When(pk=entry['order'], then=Value(entry['delivery_crew']))
+                                        for entry in applied), output_field=IntegerField()),
+                status=Case(*(When(pk=entry['order'], then=Value(entry['status'])) for entry in applied),
+                            default=F('status')),
+            )
+            # Orders that were delivered (or reopened) move between the sales rollups
+            moved = [(entry['order'], *current[entry['order']][1:]) for entry in applied
+                     if entry['status'] != current[entry['order']][1]]
+            change(removed=[(pk, date, status, total) for pk, status, date, total in moved],
+                   added=[(pk, date, not status, total) for pk, status, date, total in moved])
+            notify([event for entry in applied for event in order_events(
+                entry['order'], current[entry['order']][0], entry['delivery_crew'], current[entry['order']][1],
+                entry['status'])])
+    not_found = [pk for pk in assignments if pk not in current]
+    return {'applied': applied, 'conflicts': conflicts, 'not_found': not_found}
+
+
+def balance(order_ids=None, limit=100):
+    # Assigns open unassigned orders (the given ones, or the oldest `limit`) to the Delivery Crew members
+    # with the fewest open orders, one order at a time. Returns dispatch()'s report, or None without any
+    # Delivery Crew to assign to.
+    crew = User.objects.filter(groups__name=DELIVERY_CREW).annotate(
+        open_orders=Count('delivery_crew', filter=Q(delivery_crew__status=False))
+    ).values_list('pk', 'open_orders')
+    queue = [(open_orders, pk) for pk, open_orders in crew]
+    if not queue:
+        return None
+    if order_ids is None:
+        order_ids = Order.objects.filter(delivery_crew__isnull=True, status=False) \
+            .order_by('date', 'pk').values_list('pk', flat=True)[:limit]
+
+    heapq.heapify(queue)
+    assignments = []
+    for pk in order_ids:
+        open_orders, crew_id = heapq.heappop(queue)
+        # Given orders that were assigned or delivered meanwhile come back as conflicts
+        assignments.append({'order': pk, 'delivery_crew': crew_id, 'status': None,
+                            'expected_delivery_crew': None, 'expected_status': False})
+        heapq.heappush(queue, (open_orders + 1, crew_id))
+    return dispatch(assignments)
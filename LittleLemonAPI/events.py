@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from .models import Order, OrderEvent
+
+# Live order events for GET /api/orders/events/ (a server-sent event stream, see async_views.order_events),
+# so clients don't have to poll /api/orders/ for changes. notifications.notify() publishes an event whenever
+# an order is placed, assigned or delivered, to its customer, its delivery crew member and the managers.
+#
+# Every event has an increasing id, sent as the SSE id. A client that reconnects with Last-Event-ID gets
+# the events it missed; when they are no longer known (too old, or from another process with the local
+# broker) it gets a `reset` event and should reload /api/orders/ instead.
+#
+# ORDER_EVENTS_BROKER selects how events travel:
+# - local: within this process only, from a ring buffer of the last ORDER_EVENTS_BUFFER events. Enough for
+#   a single ASGI worker.
+# - database: events are also written to the OrderEvent table in the order's transaction. Each process
+#   polls it every ORDER_EVENTS_POLL_INTERVAL seconds (one query per process, not per connection) for the
+#   events published by other processes, and reconnecting clients resume from it whichever process they
+#   reach.
+# Either way events published by this process reach its own subscribers as soon as the order commits.
+
+logger = logging.getLogger(__name__)
+
+RESET = 'reset'
+
+
+def setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+DEFAULTS = {
+    'ORDER_EVENTS_HEARTBEAT': 15,
+    'ORDER_EVENTS_RETRY_MS': 3000,
+    'ORDER_EVENTS_BUFFER': 10000,
+    'ORDER_EVENTS_POLL_INTERVAL': 0.5,
+    # Events committed out of id order (concurrent transactions on PostgreSQL/MySQL) are still picked up
+    # when they commit within this many seconds of being written
+    'ORDER_EVENTS_REORDER_WINDOW': 5,
+    'ORDER_EVENTS_RETENTION': 24 * 3600,
+    'ORDER_EVENTS_BACKLOG_LIMIT': 1000,
+    # A connection that falls this many events behind gets a reset and is closed
+    'ORDER_EVENTS_MAX_PENDING': 1000,
+}
+
+
+class Event:
+    __slots__ = ('id', 'kind', 'user_id', 'crew_id', 'data')
+
+    def __init__(self, id, kind, user_id, crew_id, data):
+        self.id = id
+        self.kind = kind
+        self.user_id = user_id
+        self.crew_id = crew_id
+        self.data = data
+
+
+class Subscription:
+    # One stream connection: who it is for and the events waiting to be sent. Lives on the event loop of
+    # its connection; brokers hand it events with loop.call_soon_threadsafe.
+    def __init__(self, user_id, crew, manager, loop):
+        self.user_id = user_id
+        self.crew = crew
+        self.manager = manager
+        self.loop = loop
+        self.pending = []
+        self.ready = asyncio.Event()
+        self.overflow = False
+
+    def sees(self, event):
+        return self.manager or event.user_id == self.user_id or (self.crew and event.crew_id == self.user_id)
+
+    def push(self, events):
+        self.pending.extend(events)
+        if len(self.pending) > setting('ORDER_EVENTS_MAX_PENDING'):
+            self.overflow = True
+        self.ready.set()
+
+    async def next(self, timeout):
+        # The events that arrived since the last call, or [] after timeout seconds without any
+        if not self.pending:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        events, self.pending = self.pending, []
+        return events
+
+
+class LocalBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffer = deque(maxlen=setting('ORDER_EVENTS_BUFFER'))
+        # Start from the clock so ids keep increasing across restarts, and a Last-Event-ID from before one
+        # is recognised as unknown rather than taken for a recent event
+        self.next_id = time.time_ns() // 1000
+        self.by_user = {}  # user id -> {subscription, ...}
+        self.managers = set()
+
+    # Publishing (from request threads)
+
+    def publish(self, events):
+        # Call inside the transaction changing the orders; subscribers get the events once it commits
+        transaction.on_commit(lambda: self.deliver(self.number(events)))
+
+    def number(self, events):
+        with self.lock:
+            for event in events:
+                event.id = self.next_id
+                self.next_id += 1
+        return events
+
+    def deliver(self, events):
+        targets = {}
+        with self.lock:
+            self.buffer.extend(events)
+            for event in events:
+                subscriptions = self.managers | self.by_user.get(event.user_id, set())
+                if event.crew_id is not None:
+                    subscriptions |= {subscription for subscription in self.by_user.get(event.crew_id, ())
+                                      if subscription.crew}
+                for subscription in subscriptions:
+                    targets.setdefault(subscription, []).append(event)
+        for subscription, subscribed_events in targets.items():
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.push, subscribed_events)
+            except RuntimeError:
+                # Its event loop has closed (the worker is shutting down or reloading) without unsubscribing.
+                # This runs after the order committed, so it must not fail the request that published.
+                self.unsubscribe(subscription)
+
+    # Subscribing (on the event loop)
+
+    def subscribe(self, user_id, crew=False, manager=False):
+        subscription = Subscription(user_id, crew, manager, asyncio.get_running_loop())
+        with self.lock:
+            if manager:
+                self.managers.add(subscription)
+            else:
+                self.by_user.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.managers.discard(subscription)
+            subscriptions = self.by_user.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.by_user[subscription.user_id]
+
+    def subscriber_count(self):
+        with self.lock:
+            return len(self.managers) + sum(len(subscriptions) for subscriptions in self.by_user.values())
+
+    async def backlog(self, subscription, last_id):
+        # (events after last_id that subscription sees, whether that is all of them)
+        with self.lock:
+            first = self.buffer[0].id if self.buffer else self.next_id
+            complete = first <= last_id + 1 and last_id < self.next_id
+            events = [event for event in self.buffer if event.id > last_id and subscription.sees(event)]
+        return events, complete
+
+
+class DatabaseBroker(LocalBroker):
+    def __init__(self):
+        super().__init__()
+        self.cursor = None
+        # ids already delivered -> when, so the poller doesn't deliver this process's events twice
+        self.seen = {}
+        self.pollers = {}  # event loop -> poller task
+        self.pruned = 0.0
+
+    def publish(self, events):
+        rows = OrderEvent.objects.bulk_create(
+            OrderEvent(kind=event.kind, order_id=event.data['order'], user_id=event.user_id,
+                       delivery_crew_id=event.crew_id, data=event.data)
+            for event in events
+        )
+        for event, row in zip(events, rows):
+            event.id = row.pk
+        transaction.on_commit(lambda: self.deliver(events))
+
+    def deliver(self, events):
+        now = time.monotonic()
+        with self.lock:
+            for event in events:
+                self.seen[event.id] = now
+        super().deliver(events)
+
+    def subscribe(self, user_id, crew=False, manager=False):
+        subscription = super().subscribe(user_id, crew, manager)
+        loop = subscription.loop
+        if loop not in self.pollers:
+            self.pollers[loop] = loop.create_task(self.poll(loop))
+        return subscription
+
+    async def poll(self, loop):
+        # Delivers the events other processes wrote, while this loop has subscribers
+        try:
+            if self.cursor is None:
+                self.cursor = (await OrderEvent.objects.aaggregate(last=Max('pk')))['last'] or 0
+            while self.subscriber_count():
+                await asyncio.sleep(setting('ORDER_EVENTS_POLL_INTERVAL'))
+                try:
+                    await self.poll_once()
+                except Exception:
+                    logger.exception('Polling order events failed')
+        finally:
+            self.pollers.pop(loop, None)
+
+    async def poll_once(self):
+        window = setting('ORDER_EVENTS_REORDER_WINDOW')
+        rows = OrderEvent.objects.filter(
+            Q(pk__gt=self.cursor) | Q(created__gte=timezone.now() - timedelta(seconds=window))
+        ).order_by('pk').values_list('pk', 'kind', 'user_id', 'delivery_crew_id', 'data')
+        events = [Event(*row) async for row in rows]
+        now = time.monotonic()
+        with self.lock:
+            new = [event for event in events if event.id not in self.seen]
+            if events:
+                self.cursor = max(self.cursor, events[-1].id)
+            self.seen = {pk: when for pk, when in self.seen.items() if when > now - 2 * window}
+            self.seen.update((event.id, now) for event in new)
+        if new:
+            LocalBroker.deliver(self, new)
+        if time.monotonic() - self.pruned > 60:
+            self.pruned = time.monotonic()
+            cutoff = timezone.now() - timedelta(seconds=setting('ORDER_EVENTS_RETENTION'))
+            await OrderEvent.objects.filter(created__lt=cutoff).adelete()
+
+    async def backlog(self, subscription, last_id):
+        limit = setting('ORDER_EVENTS_BACKLOG_LIMIT')
+        rows = OrderEvent.objects.filter(pk__gt=last_id)
+        if not subscription.manager:
+            visible = Q(user_id=subscription.user_id)
+            if subscription.crew:
+                visible |= Q(delivery_crew_id=subscription.user_id)
+            rows = rows.filter(visible)
+        rows = rows.order_by('pk').values_list('pk', 'kind', 'user_id', 'delivery_crew_id', 'data')[:limit + 1]
+        events = [Event(*row) async for row in rows]
+        bounds = await OrderEvent.objects.aaggregate(first=Min('pk'), last=Max('pk'))
+        complete = len(events) <= limit and (bounds['first'] is None or bounds['first'] <= last_id + 1) and \
+            last_id <= (bounds['last'] or 0)
+        return events[:limit], complete
+
+
+BROKERS = {'local': LocalBroker, 'database': DatabaseBroker}
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                name = getattr(settings, 'ORDER_EVENTS_BROKER', 'local')
+                if name not in BROKERS:
+                    raise ImproperlyConfigured(f'Unknown ORDER_EVENTS_BROKER {name!r}: use local or database')
+                _broker = BROKERS[name]()
+    return _broker
+
+
+def reset_broker():
+    global _broker
+    _broker = None
+
+
+def publish(events):
+    # events: [{'order': pk, 'event': kind}, ...] as given to notifications.notify(). The orders are read
+    # here, in the caller's transaction, so the events carry the state being committed.
+    states = Order.objects.filter(pk__in={event['order'] for event in events}).values_list(
+        'pk', 'user_id', 'delivery_crew_id', 'status', 'total', 'date')
+    states = {state[0]: state for state in states}
+    published = []
+    for event in events:
+        if event['order'] not in states:
+            continue
+        pk, user_id, crew_id, status, total, date = states[event['order']]
+        data = {'order': pk, 'status': status, 'delivery_crew': crew_id, 'total': str(total),
+                'date': date.isoformat()}
+        published.append(Event(None, event['event'], user_id, crew_id, data))
+    if published:
+        get_broker().publish(published)
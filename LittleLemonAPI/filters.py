@@ -0,0 +1,47 @@
+from decimal import Decimal, InvalidOperation
+
+from rest_framework.exceptions import ValidationError
+
+TRUE_VALUES = ('true', '1', 'yes')
+FALSE_VALUES = ('false', '0', 'no')
+
+
+def filter_menu_items(queryset, query_params):
+    # Server-side filtering for the menu listing so clients don't have to download everything.
+    # ?category=<id or title>&featured=true|false&min_price=<decimal>&max_price=<decimal>
+    category = query_params.get('category')
+    if category:
+        if category.isdigit():
+            queryset = queryset.filter(category_id=int(category))
+        else:
+            queryset = queryset.filter(category__title=category)
+
+    featured = query_params.get('featured')
+    if featured is not None:
+        if featured.lower() in TRUE_VALUES:
+            queryset = queryset.filter(featured=True)
+        elif featured.lower() in FALSE_VALUES:
+            queryset = queryset.filter(featured=False)
+        else:
+            raise ValidationError({'featured': 'Must be true or false'})
+
+    min_price = parse_price(query_params, 'min_price')
+    if min_price is not None:
+        queryset = queryset.filter(price__gte=min_price)
+    max_price = parse_price(query_params, 'max_price')
+    if max_price is not None:
+        queryset = queryset.filter(price__lte=max_price)
+    return queryset
+
+
+def parse_price(query_params, name):
+    value = query_params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValidationError({name: 'Must be a decimal number'})
+    if not price.is_finite():
+        raise ValidationError({name: 'Must be a decimal number'})
+    return price
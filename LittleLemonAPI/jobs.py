@@ -0,0 +1,184 @@
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .models import Job
+
+# A background job queue in the application database, so it needs no broker. Work that doesn't have to
+# finish before the response (notifications and the like) is enqueued by the request and run by
+# `manage.py run_jobs`.
+#
+# enqueue() writes the jobs in the caller's transaction: workers see them exactly when the change that
+# needed them commits, and never for a change that rolled back. Workers claim due jobs of one name in
+# batches with a conditional UPDATE (a job can only be claimed by one worker at a time, on any database),
+# and delete them once the handler returns. A worker that dies mid-batch leaves its jobs to come due again
+# when the lease runs out, so every job runs at least once and handlers must be idempotent, unless they are
+# registered with atomic=True: their database writes then commit in one transaction with the deletion of
+# their jobs, so they take effect exactly once. A handler that raises retries the whole batch with
+# exponential backoff, up to JOB_MAX_ATTEMPTS times.
+
+logger = logging.getLogger(__name__)
+
+# name -> (handler, batch size or None for JOB_BATCH_SIZE, atomic)
+HANDLERS = {}
+
+
+def handler(name, batch_size=None, atomic=False):
+    # Registers a job handler. It is called with a list of up to batch_size payloads.
+    def decorator(function):
+        HANDLERS[name] = (function, batch_size, atomic)
+        return function
+
+    return decorator
+
+
+def enqueue(name, payloads, delay=0):
+    # Adds one job per payload (JSON-serializable), in one INSERT. Call it inside the transaction making
+    # the change the jobs are about.
+    if name not in HANDLERS:
+        raise ValueError(f'Unknown job {name!r}')
+    run_at = timezone.now() + timedelta(seconds=delay)
+    return Job.objects.bulk_create([Job(name=name, payload=payload, run_at=run_at) for payload in payloads])
+
+
+DEFAULTS = {
+    'JOB_BATCH_SIZE': 50,
+    'JOB_MAX_ATTEMPTS': 5,
+    # Seconds before the first retry, doubled for every further attempt (with +-25% jitter)
+    'JOB_RETRY_DELAY': 10,
+    # Seconds a claimed batch belongs to its worker; it should be well above the slowest batch
+    'JOB_LEASE': 300,
+    'JOB_POLL_INTERVAL': 1.0,
+}
+
+
+def setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def retry_delay(attempts):
+    return setting('JOB_RETRY_DELAY') * 2 ** (attempts - 1) * random.uniform(0.75, 1.25)
+
+
+class Worker:
+    def __init__(self, names=None, batch_size=None):
+        self.names = names
+        self.batch_size = batch_size
+        self.id = f'{socket.gethostname()}:{os.getpid()}'
+
+    def claim(self):
+        # (name, token, jobs) for a batch of due jobs of one name, or (None, None, []) when nothing is due
+        now = timezone.now()
+        due = Job.objects.filter(failed=False, run_at__lte=now)
+        if self.names:
+            due = due.filter(name__in=self.names)
+        name = due.order_by('run_at', 'pk').values_list('name', flat=True).first()
+        if name is None:
+            return None, None, []
+        batch_size = self.batch_size or HANDLERS.get(name, (None, None))[1] or setting('JOB_BATCH_SIZE')
+        pks = list(due.filter(name=name).order_by('run_at', 'pk').values_list('pk', flat=True)[:batch_size])
+        # Only the jobs still due are claimed: another worker may have taken some since the SELECT
+        token = f'{uuid.uuid4().hex[:16]}@{self.id}'[:64]
+        Job.objects.filter(pk__in=pks, failed=False, run_at__lte=now).update(
+            run_at=now + timedelta(seconds=setting('JOB_LEASE')), locked_by=token, attempts=F('attempts') + 1)
+        return name, token, list(Job.objects.filter(pk__in=pks, locked_by=token).order_by('run_at', 'pk'))
+
+    def run_batch(self, name, token, jobs):
+        # Returns True when the handler succeeded
+        function, _, atomic = HANDLERS.get(name, (None, None, False))
+        try:
+            if function is None:
+                raise LookupError(f'No handler registered for job {name!r}')
+            if atomic:
+                with transaction.atomic():
+                    function([job.payload for job in jobs])
+                    if self.finish(token, jobs) != len(jobs):
+                        # The lease ran out and another worker took (or finished) some of the jobs
+                        raise RuntimeError(f'Lost the lease on a batch of {name!r} jobs')
+            else:
+                function([job.payload for job in jobs])
+        except Exception:
+            logger.exception('Job %s failed (%d jobs)', name, len(jobs))
+            self.retry(token, jobs, traceback.format_exc(), permanent=function is None)
+            return False
+        if not atomic:
+            self.finish(token, jobs)
+        return True
+
+    def finish(self, token, jobs):
+        # Deletes the jobs still claimed with token; returns how many
+        return Job.objects.filter(pk__in=[job.pk for job in jobs], locked_by=token).delete()[0]
+
+    def retry(self, token, jobs, error, permanent=False):
+        # Jobs with attempts left come due again after the backoff; the others are marked failed
+        by_attempts = {}
+        for job in jobs:
+            by_attempts.setdefault(job.attempts, []).append(job.pk)
+        for attempts, pks in by_attempts.items():
+            claimed = Job.objects.filter(pk__in=pks, locked_by=token)
+            if permanent or attempts >= setting('JOB_MAX_ATTEMPTS'):
+                claimed.update(failed=True, last_error=error, locked_by='')
+            else:
+                claimed.update(run_at=timezone.now() + timedelta(seconds=retry_delay(attempts)), last_error=error,
+                               locked_by='')
+
+    def run_once(self):
+        # Runs one batch; returns the number of jobs in it (0 when nothing was due)
+        name, token, jobs = self.claim()
+        if jobs:
+            self.run_batch(name, token, jobs)
+        return len(jobs)
+
+    def run(self, stop, burst=False):
+        # Runs batches until stop (a threading.Event) is set, or with burst until nothing is due
+        while not stop.is_set():
+            if not self.run_once():
+                if burst:
+                    return
+                stop.wait(setting('JOB_POLL_INTERVAL'))
+
+
+def run_workers(concurrency=1, names=None, batch_size=None, burst=False, stop=None):
+    # Runs `concurrency` workers until stop is set: one in this thread, or several in threads with a
+    # database connection each
+    stop = stop or threading.Event()
+    if concurrency == 1:
+        Worker(names, batch_size).run(stop, burst)
+        return
+
+    def run():
+        try:
+            Worker(names, batch_size).run(stop, burst)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    # Joining with a timeout keeps the main thread responsive to signals, whose handler sets stop; the
+    # threads then finish their batches
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(0.5)
+
+
+def queue_stats():
+    # {name: {'due', 'scheduled', 'failed'}}; claimed jobs count as scheduled until their lease runs out
+    now = timezone.now()
+    rows = Job.objects.values('name').annotate(
+        due=Count('pk', filter=Q(failed=False, run_at__lte=now)),
+        scheduled=Count('pk', filter=Q(failed=False, run_at__gt=now)),
+        failed_jobs=Count('pk', filter=Q(failed=True)),
+    ).order_by('name')
+    return {row['name']: {'due': row['due'], 'scheduled': row['scheduled'], 'failed': row['failed_jobs']}
+            for row in rows}
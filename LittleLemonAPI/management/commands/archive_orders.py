@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from LittleLemonAPI.archive import archivable, archive_cutoff, archive_orders, table_sizes
+from LittleLemonAPI.benchmarks import Timer
+
+
+class Command(BaseCommand):
+    help = ('Moves delivered orders older than ORDER_ARCHIVE_AFTER_DAYS days (or --days), with their items, into '
+            'the order archive, one batch of orders per transaction. Meant to run daily, e.g. from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Archive delivered orders dated more than this many days ago')
+        parser.add_argument('--batch-size', type=int, help='Orders per transaction (ORDER_ARCHIVE_BATCH_SIZE)')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the orders that would be archived')
+
+    def handle(self, *args, days, batch_size, max_batches, dry_run, **options):
+        if dry_run:
+            cutoff = archive_cutoff(days)
+            self.stdout.write(f'{archivable(cutoff).count()} delivered orders dated before {cutoff} to archive')
+            return
+        with Timer() as timer:
+            moved = archive_orders(days, batch_size, max_batches)
+        self.stdout.write(f'Archived {moved["orders"]} orders ({moved["items"]} items) in {moved["batches"]} '
+                          f'batches in {timer.seconds:.1f}s')
+        self.stdout.write(', '.join(f'{table}: {rows}' for table, rows in table_sizes().items()))
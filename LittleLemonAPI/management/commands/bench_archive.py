@@ -0,0 +1,70 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from LittleLemonAPI.archive import archive_orders, table_sizes
+from LittleLemonAPI.benchmarks import Timer, benchmark_database, benchmark_users, percentile, seed_orders, \
+    write_report
+from LittleLemonAPI.models import ArchivedOrder, Order
+from LittleLemonAPI.roles import CUSTOMER, DELIVERY_CREW, MANAGER
+from LittleLemonAPI.views import manage_orders, manage_specific_order
+
+
+class Command(BaseCommand):
+    help = ('Times the order endpoints with a long delivered order history in the hot tables, then again after '
+            'archive_orders has moved it into the archive')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, nargs='+', default=[10000, 50000],
+                            help='Orders of history (dated 2024, half of them delivered)')
+        parser.add_argument('--requests', type=int, default=20, help='Timed requests per endpoint')
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, orders, requests, json, **options):
+        results = []
+        with benchmark_database():
+            users = benchmark_users()
+            for count in sorted(orders):
+                # seed_orders tops up to `count`, so every level starts from empty tables
+                Order.objects.all().delete()
+                ArchivedOrder.objects.all().delete()
+                seed_orders(count)
+                recent = Order.objects.create(user=users[CUSTOMER], delivery_crew=users[DELIVERY_CREW],
+                                              total=9, date=timezone.localdate())
+                scenarios = [
+                    ('customer list', manage_orders, '/api/orders/', {}, users[CUSTOMER], {}),
+                    ('crew list', manage_orders, '/api/orders/', {}, users[DELIVERY_CREW], {}),
+                    ('manager list', manage_orders, '/api/orders/', {}, users[MANAGER], {}),
+                    ('manager last 30 days', manage_orders, '/api/orders/',
+                     {'start': (timezone.localdate() - datetime.timedelta(days=30)).isoformat()},
+                     users[MANAGER], {}),
+                    ('customer order', manage_specific_order, f'/api/orders/{recent.pk}/', {}, users[CUSTOMER],
+                     {'orderId': recent.pk}),
+                ]
+                before = {name: measure(*scenario, requests) for name, *scenario in scenarios}
+                with Timer() as timer:
+                    moved = archive_orders()
+                self.stderr.write(f'{count} orders: archived {moved["orders"]} in {timer.seconds:.1f}s, '
+                                  f'{table_sizes()}')
+                for name, *scenario in scenarios:
+                    after = measure(*scenario, requests)
+                    results.append([count, name, *before[name], *after])
+        write_report(self, ['orders', 'endpoint', 'before_p50_ms', 'before_p99_ms', 'after_p50_ms',
+                            'after_p99_ms'], results, as_json=json)
+
+
+def measure(view, path, query, user, kwargs, requests):
+    # (p50 ms, p99 ms) of building and rendering the response, after one warm-up request
+    samples = []
+    for _ in range(requests + 1):
+        request = APIRequestFactory().get(path, query, HTTP_ACCEPT='application/json')
+        force_authenticate(request, user)
+        with Timer() as timer:
+            response = view(request, **kwargs)
+            response.render()
+        assert response.status_code == 200, response.content
+        samples.append(timer.seconds)
+    samples = samples[1:]
+    return percentile(samples, 50) * 1000, percentile(samples, 99) * 1000
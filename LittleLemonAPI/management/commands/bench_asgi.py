@@ -0,0 +1,81 @@
+import json
+import os
+import sys
+import tempfile
+from urllib.parse import quote
+
+from django.core.management.base import BaseCommand, CommandError
+
+from LittleLemonAPI.benchmarks import free_port, manage_py, run_load, server, write_report
+
+SERVERS = {
+    # The same uvicorn process model for all three, so only the request path differs
+    'wsgi': ['--interface', 'wsgi', 'LittleLemon.wsgi:application'],
+    'asgi-sync-views': ['LittleLemon.asgi:application'],
+    'asgi-async-views': ['LittleLemon.asgi:application'],
+}
+
+
+class Command(BaseCommand):
+    help = ('Compares throughput and latency of the hot read endpoints under uvicorn: the WSGI app, the ASGI app '
+            'with the sync views, and the ASGI app with the native async views. Needs uvicorn installed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64])
+        parser.add_argument('--duration', type=float, default=5.0, help='Seconds per concurrency level')
+        parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+        parser.add_argument('--menu-items', type=int, default=1000)
+        parser.add_argument('--orders', type=int, default=200)
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, concurrency, duration, servers, menu_items, orders, json, **options):
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            raise CommandError('bench_asgi needs uvicorn: pip install uvicorn')
+
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            env = {'SQLITE_PATH': os.path.join(directory, 'bench.sqlite3'), 'THROTTLE_ENABLED': '0'}
+            manage_py('migrate', env=env)
+            seeded = load_json(manage_py('shell', '-c', (
+                'import json; from LittleLemonAPI.benchmarks import seed_read_scenario; '
+                f'print(json.dumps(seed_read_scenario({menu_items}, {orders})))'
+            ), env=env, capture=True))
+            requests = read_requests(seeded)
+
+            for name in servers:
+                port = free_port()
+                server_env = {**env, 'LITTLELEMON_ASYNC_VIEWS': '1' if name == 'asgi-async-views' else '0'}
+                command = [sys.executable, '-m', 'uvicorn', *SERVERS[name], '--port', str(port), '--log-level', 'error',
+                           '--no-access-log']
+                with server(command, env=server_env, port=port):
+                    run_load(port, requests, 4, 1.0)  # warm up
+                    for level in concurrency:
+                        report = run_load(port, requests, level, duration)
+                        results.append([name, level, report['requests'], report['errors'], report['rps'],
+                                        report['p50_ms'], report['p99_ms']])
+                        self.stderr.write(f'{name} c={level}: {report["rps"]:.0f} req/s')
+        write_report(self, ['server', 'concurrency', 'requests', 'errors', 'rps', 'p50_ms', 'p99_ms'], results,
+                     as_json=json)
+
+
+def load_json(output):
+    # The last line of the shell output is the JSON printed by the seeding snippet
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def read_requests(seeded):
+    def get(path, role=None):
+        headers = {'Accept': 'application/json'}
+        if role:
+            headers['Authorization'] = f'Token {seeded["tokens"][role]}'
+        return 'GET', path, headers, None
+
+    return [
+        get('/api/menu-items/'),
+        get(f'/api/menu-items/{quote(seeded["menu_item"])}/', 'Manager'),
+        get('/api/cart/menu-items/', 'Customer'),
+        get('/api/orders/', 'Delivery Crew'),
+        get('/api/users/users/me/', 'Customer'),
+    ]
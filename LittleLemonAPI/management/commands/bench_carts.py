@@ -0,0 +1,82 @@
+import json as jsonlib
+import os
+import sys
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from LittleLemonAPI.benchmarks import free_port, manage_py, run_load, server, write_report
+
+from .bench_asgi import load_json
+
+STORES = ['database', 'local', 'sqlite']
+
+
+class Command(BaseCommand):
+    help = ('Measures cart throughput (adding items, reading and emptying carts, with an occasional checkout) '
+            'for each CART_STORE: the Cart table and the write-behind local and sqlite stores. Served by one '
+            'uvicorn worker, since the local store is per process. Needs uvicorn installed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stores', nargs='+', choices=STORES, default=STORES)
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+        parser.add_argument('--duration', type=float, default=5.0, help='Seconds per concurrency level')
+        parser.add_argument('--customers', type=int, default=64)
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, stores, concurrency, duration, customers, json, **options):
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            raise CommandError('bench_carts needs uvicorn: pip install uvicorn')
+
+        results = []
+        for store in stores:
+            with tempfile.TemporaryDirectory() as directory:
+                # The same customers hit the API over and over, which the rate limits would soon refuse
+                env = {'SQLITE_PATH': os.path.join(directory, 'bench.sqlite3'), 'CART_STORE': store,
+                       'CART_SQLITE_PATH': os.path.join(directory, 'carts.sqlite3'), 'THROTTLE_ENABLED': '0'}
+                manage_py('migrate', env=env)
+                seeded = load_json(manage_py('shell', '-c', (
+                    'import json; from LittleLemonAPI.benchmarks import seed_write_scenario; '
+                    f'print(json.dumps(seed_write_scenario({customers})))'
+                ), env=env, capture=True))
+                requests = cart_requests(seeded)
+
+                port = free_port()
+                command = [sys.executable, '-m', 'uvicorn', 'LittleLemon.asgi:application', '--port', str(port),
+                           '--log-level', 'error', '--no-access-log']
+                with server(command, env=env, port=port):
+                    run_load(port, requests, 2, 1.0)  # warm up
+                    for level in concurrency:
+                        report = run_load(port, requests, level, duration)
+                        # Checkouts finding an empty cart (400) would mean connections sharing carts
+                        results.append([store, level, report['requests'], report['errors'],
+                                        report['statuses'].get(400, 0), report['rps'], report['p50_ms'],
+                                        report['p99_ms']])
+                        self.stderr.write(f'{store} c={level}: {report["rps"]:.0f} req/s, '
+                                          f'{report["errors"]} errors')
+        write_report(self, ['store', 'concurrency', 'requests', 'errors', 'empty_checkouts', 'rps', 'p50_ms', 'p99_ms'], results,
+                     as_json=json)
+
+
+def cart_requests(seeded):
+    # Cart churn: each customer in turn adds one item, adds a batch, reads the cart and abandons it, four
+    # times over, the last time checking out instead. run_load starts the connections spread over the list, so
+    # at any time they work on different customers' carts and contend for the store, not for one cart.
+    titles = seeded['menu_items']
+    requests = []
+    for i, token in enumerate(seeded['tokens']):
+        headers = {'Accept': 'application/json', 'Content-Type': 'application/json',
+                   'Authorization': f'Token {token}'}
+        for round in range(4):
+            single = {'menuitem': titles[(i + round) % len(titles)], 'quantity': 1}
+            batch = [{'menuitem': titles[(i + round + j) % len(titles)], 'quantity': 2} for j in range(1, 4)]
+            requests += [
+                ('POST', '/api/cart/menu-items/', headers, jsonlib.dumps(single).encode()),
+                ('POST', '/api/cart/menu-items/', headers, jsonlib.dumps(batch).encode()),
+                ('GET', '/api/cart/menu-items/', headers, None),
+                ('POST', '/api/orders/', headers, b'') if round == 3 else
+                ('DELETE', '/api/cart/menu-items/', headers, None),
+            ]
+    return requests
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from LittleLemonAPI.benchmarks import free_port, manage_py, percentile, read_response, server, write_report
+
+# seed_read_scenario's order is assigned to bench-crew: seeded['crew'] starts with the other crew member and is
+# rotated by every update, so each update really changes the assignment
+SEED = (
+    'import json; from LittleLemonAPI.benchmarks import get_user, seed_read_scenario; '
+    'from LittleLemonAPI.models import Order; '
+    'seeded = seed_read_scenario(10, 1); '
+    'seeded["order"] = Order.objects.get().pk; '
+    'seeded["crew"] = [get_user(name, "Delivery Crew").pk for name in ("bench-crew-2", "bench-crew")]; '
+    'print(json.dumps(seeded))'
+)
+
+
+class Command(BaseCommand):
+    help = ('Opens idle order event streams (GET /api/orders/events/) against one uvicorn worker: time to connect, '
+            'server memory per connection, and how long an order update takes to reach every stream. '
+            'Needs uvicorn installed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, nargs='+', default=[100, 1000, 5000])
+        parser.add_argument('--updates', type=int, default=5, help='Order updates fanned out per level')
+        parser.add_argument('--broker', choices=['local', 'database'], default='local')
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, connections, updates, broker, json, **options):
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            raise CommandError('bench_events needs uvicorn: pip install uvicorn')
+
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            env = {'SQLITE_PATH': os.path.join(directory, 'bench.sqlite3')}
+            manage_py('migrate', env=env)
+            seeded = load_json(manage_py('shell', '-c', SEED, env=env, capture=True))
+            # Every stream connects with the same token, which the rate limits would soon refuse
+            env.update(ORDER_EVENTS_BROKER=broker, THROTTLE_ENABLED='0')
+            for count in sorted(connections):
+                port = free_port()
+                command = [sys.executable, '-m', 'uvicorn', 'LittleLemon.asgi:application', '--port', str(port),
+                           '--log-level', 'error', '--no-access-log']
+                with server(command, env=env, port=port) as process:
+                    report = asyncio.run(measure(port, process.pid, seeded, count, updates))
+                results.append([broker, count, report['connect_p50_ms'], report['connect_p99_ms'],
+                                report['rss_mb'], report['kb_per_connection'], report['fanout_p50_ms'],
+                                report['fanout_max_ms']])
+                self.stderr.write(f'{count} streams: {report["kb_per_connection"]:.1f} KB each, '
+                                  f'fan-out {report["fanout_max_ms"]:.1f} ms')
+        write_report(self, ['broker', 'streams', 'connect_p50_ms', 'connect_p99_ms', 'server_rss_mb',
+                            'kb_per_stream', 'fanout_p50_ms', 'fanout_max_ms'], results, as_json=json)
+
+
+def load_json(output):
+    # The last line of the shell output is the JSON printed by the seeding snippet
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def rss_kb(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    raise RuntimeError('no VmRSS: bench_events needs Linux')
+
+
+def request(path, token, method, body=None):
+    lines = [f'{method} {path} HTTP/1.1', 'Host: 127.0.0.1', f'Authorization: Token {token}',
+             'Accept: application/json']
+    if body is not None:
+        lines += ['Content-Type: application/json', f'Content-Length: {len(body)}']
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + (body or b'')
+
+
+async def call(port, token, method, path, body=None):
+    # One request on its own connection (an idle one would hit uvicorn's keep-alive timeout meanwhile)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(request(path, token, method, body))
+    status, _, _ = await read_response(reader)
+    writer.close()
+    if status != 200:
+        raise RuntimeError(f'{method} {path} failed: {status}')
+
+
+async def open_stream(port, token):
+    # Returns (reader, writer, seconds until the stream's first bytes arrived)
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(request('/api/orders/events/', token, 'GET'))
+    await reader.readuntil(b'retry: ')
+    return reader, writer, time.perf_counter() - started
+
+
+async def measure(port, pid, seeded, count, updates):
+    manager = seeded['tokens']['Manager']
+    # Warms the server up (imports, database connection) before the baseline
+    await call(port, manager, 'GET', '/api/orders/')
+    baseline = rss_kb(pid)
+
+    streams = []
+    for start in range(0, count, 100):
+        streams += await asyncio.gather(*(open_stream(port, manager) for _ in range(start, min(start + 100, count))))
+    await asyncio.sleep(1)
+    rss = rss_kb(pid)
+
+    fanout = []
+    for _ in range(updates):
+        # Reassigning the order is an `order.assigned` event for every stream (they are all the manager's)
+        body = json.dumps({'delivery_crew': seeded['crew'][0]}).encode()
+        seeded['crew'].reverse()
+        waiting = [asyncio.create_task(stream_reader.readuntil(b'event: order.assigned'))
+                   for stream_reader, _, _ in streams]
+        started = time.perf_counter()
+        await call(port, manager, 'PATCH', f'/api/orders/{seeded["order"]}/', body)
+        await asyncio.gather(*waiting)
+        fanout.append(time.perf_counter() - started)
+
+    for _, stream_writer, _ in streams:
+        stream_writer.close()
+    connect = [seconds for _, _, seconds in streams]
+    return {
+        'connect_p50_ms': percentile(connect, 50) * 1000,
+        'connect_p99_ms': percentile(connect, 99) * 1000,
+        'rss_mb': rss / 1024,
+        'kb_per_connection': (rss - baseline) / count,
+        'fanout_p50_ms': percentile(fanout, 50) * 1000,
+        'fanout_max_ms': max(fanout) * 1000,
+    }
@@ -0,0 +1,82 @@
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from LittleLemonAPI import jobs
+from LittleLemonAPI.benchmarks import Timer, benchmark_database, get_user, percentile, seed_menu_items, \
+    write_report
+from LittleLemonAPI.models import Cart, Job
+from LittleLemonAPI.notifications import send_order_notifications
+from LittleLemonAPI.orders import checkout
+from LittleLemonAPI.roles import CUSTOMER
+
+# Stand-in for a mail server: the delays are set by the command's options
+MAIL_DELAYS = {'connect': 0.05, 'message': 0.005}
+
+
+class SlowEmailBackend(BaseEmailBackend):
+    def send_messages(self, messages):
+        time.sleep(MAIL_DELAYS['connect'] + MAIL_DELAYS['message'] * len(messages))
+        return len(messages)
+
+
+class Command(BaseCommand):
+    help = ('Measures checkout latency with the order email sent inside the request against enqueued for the job '
+            'worker (jobs.py), with a simulated slow mail server, and the worker throughput per batch size')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=300)
+        parser.add_argument('--cart-items', type=int, default=5)
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100])
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+        parser.add_argument('--connect-ms', type=float, default=50, help='Simulated mail connection time')
+        parser.add_argument('--message-ms', type=float, default=5, help='Simulated time per email')
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, checkouts, cart_items, batch_sizes, concurrency, connect_ms, message_ms, json,
+               **options):
+        MAIL_DELAYS.update(connect=connect_ms / 1000, message=message_ms / 1000)
+        latencies = []
+        throughput = []
+        with benchmark_database(), \
+                override_settings(EMAIL_BACKEND=f'{__name__}.SlowEmailBackend', JOB_POLL_INTERVAL=0.01):
+            menu_item_ids = seed_menu_items(cart_items)
+            customers = [get_user(f'bench-jobs-{i}', CUSTOMER) for i in range(checkouts)]
+            User.objects.filter(pk__in=[user.pk for user in customers]).update(email='customer@example.com')
+            for mode in ('inline', 'queued'):
+                samples = []
+                for user in customers:
+                    fill_cart(user, menu_item_ids)
+                    started = time.perf_counter()
+                    order = checkout(user)
+                    if mode == 'inline':
+                        # What sending the email in the request would cost
+                        send_order_notifications([{'events': [{'order': order.pk, 'event': 'placed'}]}])
+                    samples.append((time.perf_counter() - started) * 1000)
+                latencies.append([mode, percentile(samples, 50), percentile(samples, 95), percentile(samples, 99)])
+                self.stderr.write(f'checkout {mode}: p99 {percentile(samples, 99):.1f} ms')
+
+            # Both modes left one job per checkout (inline just also sent the email itself)
+            payloads = list(Job.objects.values_list('payload', flat=True))
+            for batch_size in batch_sizes:
+                for threads in concurrency:
+                    Job.objects.all().delete()
+                    jobs.enqueue('order_notifications', payloads)
+                    with Timer() as timer:
+                        jobs.run_workers(threads, batch_size=batch_size, burst=True)
+                    throughput.append([batch_size, threads, len(payloads) / timer.seconds])
+                    self.stderr.write(f'batch {batch_size} x {threads}: {len(payloads) / timer.seconds:.0f} jobs/s')
+        write_report(self, ['checkout', 'p50_ms', 'p95_ms', 'p99_ms'], latencies, as_json=json)
+        self.stdout.write('')
+        write_report(self, ['batch_size', 'threads', 'jobs_per_s'], throughput, as_json=json)
+
+
+def fill_cart(user, menu_item_ids):
+    Cart.objects.bulk_create(
+        Cart(user=user, menuitem_id=pk, quantity=1, unit_price=Decimal('4.50'), price=Decimal('4.50'))
+        for pk in menu_item_ids
+    )
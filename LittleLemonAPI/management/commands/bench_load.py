@@ -0,0 +1,131 @@
+import json as jsonlib
+import os
+import sys
+import tempfile
+from urllib.parse import urlencode
+
+from django.core.management.base import BaseCommand, CommandError
+
+from LittleLemonAPI.benchmarks import free_port, git_revision, manage_py, run_load, server, write_report
+from LittleLemonAPI.roles import CUSTOMER, DELIVERY_CREW, MANAGER
+
+from .bench_asgi import SERVERS, load_json
+
+SCENARIOS = ['browse-menu', 'add-to-cart', 'checkout', 'manager-orders', 'crew-orders']
+HEADERS = ['scenario', 'concurrency', 'requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request']
+
+
+class Command(BaseCommand):
+    help = ('Seeds a scratch database (see seed_data), serves it with uvicorn and replays the browse-menu, '
+            'add-to-cart, checkout, manager-orders and crew-orders scenarios against it. Reports throughput, '
+            'p50/p95/p99 latency and SQL queries per request; --output writes the report as JSON to diff '
+            'between commits. Needs uvicorn installed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16])
+        parser.add_argument('--duration', type=float, default=5.0, help='Seconds per scenario and concurrency level')
+        parser.add_argument('--server', dest='server_name', choices=list(SERVERS), default='wsgi')
+        parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes')
+        parser.add_argument('--database', help='SQLite file to seed and keep (default: a temporary file)')
+        parser.add_argument('--customers', type=int, default=1000)
+        parser.add_argument('--menu-items', type=int, default=10000)
+        parser.add_argument('--orders', type=int, default=2000)
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, scenarios, concurrency, duration, server_name, workers, database, customers, menu_items,
+               orders, output, json, **options):
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            raise CommandError('bench_load needs uvicorn: pip install uvicorn')
+
+        with tempfile.TemporaryDirectory() as directory:
+            env = {
+                'SQLITE_PATH': os.path.abspath(database) if database else os.path.join(directory, 'bench.sqlite3'),
+                'LITTLELEMON_ASYNC_VIEWS': '1' if server_name == 'asgi-async-views' else '0',
+                # The load comes from a few clients; rate limiting would answer most of it with 429
+                'THROTTLE_ENABLED': '0',
+            }
+            manage_py('migrate', env=env)
+            self.stderr.write('Seeding...')
+            seeded = load_json(manage_py('seed_data', '--json', '--customers', str(customers), '--menu-items',
+                                         str(menu_items), '--orders', str(orders), env=env, capture=True))
+            requests = {name: scenario_requests(name, seeded) for name in scenarios}
+
+            # Queries per request are counted in-process against the same database, before the load runs
+            requests_path = os.path.join(directory, 'requests.json')
+            with open(requests_path, 'w') as f:
+                jsonlib.dump(requests, f)
+            queries = load_json(manage_py('shell', '-c', (
+                'import json; from LittleLemonAPI.benchmarks import count_scenario_queries; '
+                f'print(json.dumps(count_scenario_queries({requests_path!r})))'
+            ), env=env, capture=True))
+
+            results = []
+            port = free_port()
+            command = [sys.executable, '-m', 'uvicorn', *SERVERS[server_name], '--port', str(port), '--workers',
+                       str(workers), '--log-level', 'error', '--no-access-log']
+            with server(command, env=env, port=port):
+                for name in scenarios:
+                    replay = [(method, path, headers, body.encode() if body is not None else None)
+                              for method, path, headers, body in requests[name]]
+                    run_load(port, replay, 2, 1.0)  # warm up
+                    for level in concurrency:
+                        report = run_load(port, replay, level, duration)
+                        results.append([name, level, report['requests'], report['errors'], report['rps'],
+                                        report['p50_ms'], report['p95_ms'], report['p99_ms'], queries[name]])
+                        self.stderr.write(f'{name} c={level}: {report["rps"]:.0f} req/s, '
+                                          f'p99 {report["p99_ms"]:.1f} ms')
+
+        write_report(self, HEADERS, results, as_json=json)
+        if output:
+            with open(output, 'w') as f:
+                jsonlib.dump({
+                    'revision': git_revision(),
+                    'server': server_name,
+                    'workers': workers,
+                    'database_profile': os.environ.get('DATABASE_PROFILE', 'sqlite'),
+                    'scale': seeded['counts'],
+                    'duration': duration,
+                    'results': [dict(zip(HEADERS, row)) for row in results],
+                }, f, indent=2)
+
+
+def scenario_requests(name, seeded):
+    # [(method, path, headers, body), ...] for one scenario; the load runner replays them round-robin
+    tokens = seeded['tokens']
+    titles = seeded['menu_items']
+
+    def headers(token, body=False):
+        headers = {'Accept': 'application/json', 'Authorization': f'Token {token}'}
+        if body:
+            headers['Content-Type'] = 'application/json'
+        return headers
+
+    if name == 'browse-menu':
+        # The first page and the common filters and orderings, as customers browsing the menu send them
+        queries = [{}, {'page_size': 50}, {'ordering': 'price'}, {'ordering': '-price', 'page_size': 100},
+                   {'featured': 'true'}, {'min_price': 5, 'max_price': 15}]
+        queries += [{'category': title} for title in seeded['categories'][:5]]
+        return [('GET', f'/api/menu-items/?{urlencode(query)}' if query else '/api/menu-items/',
+                 headers(tokens[CUSTOMER][i % len(tokens[CUSTOMER])]), None) for i, query in enumerate(queries)]
+    if name == 'add-to-cart':
+        # Spread over many customers and items, so carts grow slowly however long the run
+        return [('POST', '/api/cart/menu-items/', headers(token, body=True),
+                 jsonlib.dumps({'menuitem': titles[i % len(titles)], 'quantity': 1}))
+                for i, token in enumerate(tokens[CUSTOMER])]
+    if name == 'checkout':
+        # Each customer fills the cart and checks out; the pairs are replayed in order
+        requests = []
+        for i, token in enumerate(tokens[CUSTOMER]):
+            items = [{'menuitem': titles[(i + j) % len(titles)], 'quantity': 1} for j in range(3)]
+            requests.append(('POST', '/api/cart/menu-items/', headers(token, body=True), jsonlib.dumps(items)))
+            requests.append(('POST', '/api/orders/', headers(token), None))
+        return requests
+    if name == 'manager-orders':
+        return [('GET', '/api/orders/', headers(token), None) for token in tokens[MANAGER]]
+    if name == 'crew-orders':
+        return [('GET', '/api/orders/', headers(token), None) for token in tokens[DELIVERY_CREW]]
+    raise ValueError(name)
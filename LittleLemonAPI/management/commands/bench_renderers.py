@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from LittleLemonAPI import compression, renderers
+from LittleLemonAPI.benchmarks import Timer, benchmark_database, seed_menu_items, seed_orders, write_report
+from LittleLemonAPI.fast_serializers import fast_serializer
+from LittleLemonAPI.models import MenuItem, Order
+from LittleLemonAPI.serializers import MenuItemSerializer, OrderSerializer
+
+PAYLOADS = {
+    'menu-items': (MenuItemSerializer, lambda: MenuItem.objects.order_by('pk'), seed_menu_items),
+    'orders': (OrderSerializer, lambda: Order.objects.order_by('pk'), seed_orders),
+}
+
+
+class Command(BaseCommand):
+    help = ('Compares the response formats (renderers.py) and compressions (compression.py) on the menu and order '
+            'list payloads: time to encode and compress, and bytes on the wire')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000])
+        parser.add_argument('--repeat', type=int, default=5, help='Encodings per measurement; the fastest counts')
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, rows, repeat, json, **options):
+        formats = {'json (drf)': JSONRenderer(), 'json (fast)': renderers.FastJSONRenderer()}
+        if renderers.orjson is None:
+            self.stderr.write('orjson is not installed: json (fast) falls back to the DRF encoder')
+        if renderers.msgpack is not None:
+            formats['msgpack'] = renderers.MessagePackRenderer()
+        else:
+            self.stderr.write('msgpack is not installed: skipping MessagePack')
+        encodings = ['identity', 'gzip'] + (['br'] if compression.brotli is not None else [])
+        results = []
+        with benchmark_database():
+            for count in sorted(rows):
+                for name, (serializer_class, queryset, seed) in PAYLOADS.items():
+                    seed(count)
+                    data = fast_serializer(serializer_class).serialize(queryset()[:count])
+                    for format_name, renderer in formats.items():
+                        content, render_ms = fastest(repeat, lambda: renderer.render(data))
+                        for encoding in encodings:
+                            if encoding == 'identity':
+                                body, compress_ms = content, 0.0
+                            else:
+                                body, compress_ms = fastest(repeat, lambda: compression.compress(content, encoding))
+                            results.append([name, count, format_name, encoding, render_ms, compress_ms,
+                                            render_ms + compress_ms, len(body)])
+                self.stderr.write(f'{count} rows done')
+        write_report(self, ['payload', 'rows', 'format', 'encoding', 'render_ms', 'compress_ms', 'total_ms', 'bytes'],
+                     results, as_json=json)
+
+
+def fastest(repeat, run):
+    # (result, milliseconds of the fastest of `repeat` runs)
+    best = None
+    for _ in range(repeat):
+        with Timer() as timer:
+            result = run()
+        best = timer.seconds if best is None else min(best, timer.seconds)
+    return result, best * 1000
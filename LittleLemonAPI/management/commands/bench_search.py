@@ -0,0 +1,76 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from LittleLemonAPI.benchmarks import DISH_NAMES, DISH_STYLES, Timer, benchmark_database, percentile, \
+    seed_catalog, seed_categories, write_report
+from LittleLemonAPI.menu_cache import get_menu_version
+from LittleLemonAPI.models import MenuItem
+from LittleLemonAPI.search import index
+
+LIMIT = 10
+# Autocomplete latency target from the index at TARGET_ITEMS or more items
+TARGET_ITEMS = 100000
+TARGET_MS = 1.0
+
+
+class Command(BaseCommand):
+    help = ('Measures menu autocomplete latency from the search index (search.py) against a LIKE \'%%q%%\' title '
+            'scan, as the menu grows. Queries are prefixes of seeded dish names, some with a typo.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--queries', type=int, default=2000)
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+        parser.add_argument('--target-ms', type=float, default=TARGET_MS,
+                            help=f'Fail when the index p95 or p99 goes over this at {TARGET_ITEMS} items or more')
+
+    def handle(self, *args, items, queries, json, target_ms, **options):
+        rng = random.Random(0)
+        samples = sample_queries(rng, queries)
+        results = []
+        with benchmark_database():
+            seed_categories(20)
+            for count in sorted(items):
+                seed_catalog(count, 5000, rng)
+                with Timer() as build:
+                    index.rebuild(get_menu_version())
+                indexed = time_queries(samples, lambda q: index.search(q, LIMIT))
+                # LIKE finds nothing for the typos, after scanning the whole table
+                scanned = time_queries(samples[:200],
+                                       lambda q: list(MenuItem.objects.filter(title__icontains=q)
+                                                      .values_list('pk', 'title')[:LIMIT]))
+                for method, latencies in (('index', indexed), ('like', scanned)):
+                    results.append([method, count, build.seconds if method == 'index' else 0.0,
+                                    percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99)])
+                self.stderr.write(f'{count} items: index p99 {percentile(indexed, 99):.3f} ms')
+        write_report(self, ['method', 'items', 'build_s', 'p50_ms', 'p95_ms', 'p99_ms'], results, as_json=json)
+        missed = [f'{count} items: p95 {p95:.3f} ms, p99 {p99:.3f} ms' for method, count, _, _, p95, p99 in results
+                  if method == 'index' and count >= TARGET_ITEMS and max(p95, p99) > target_ms]
+        if missed:
+            raise CommandError(f'Index autocomplete over the {target_ms} ms target: ' + '; '.join(missed))
+
+
+def sample_queries(rng, count):
+    # (query, has a typo) pairs like a user typing: a style and/or a dish name, cut off after a few characters
+    samples = []
+    for _ in range(count):
+        words = [rng.choice(DISH_NAMES)] if rng.random() < 0.7 else [rng.choice(DISH_STYLES), rng.choice(DISH_NAMES)]
+        text = ' '.join(words)
+        query = text[:rng.randrange(2, len(text) + 1)].rstrip()
+        typo = len(query) > 5 and rng.random() < 0.3
+        if typo:
+            i = rng.randrange(1, len(query) - 1)
+            query = query[:i] + query[i + 1] + query[i] + query[i + 2:]
+        samples.append((query, typo))
+    return samples
+
+
+def time_queries(samples, run):
+    latencies = []
+    for query, _ in samples:
+        started = time.perf_counter()
+        run(query)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
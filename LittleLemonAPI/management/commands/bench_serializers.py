@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from LittleLemonAPI.benchmarks import Timer, benchmark_database, seed_cart_rows, seed_menu_items, seed_orders, \
+    write_report
+from LittleLemonAPI.fast_serializers import fast_serializer
+from LittleLemonAPI.models import Cart, MenuItem, Order
+from LittleLemonAPI.serializers import CartSerializer, MenuItemSerializer, OrderSerializer
+from LittleLemonAPI.views import orders_with_items
+
+LISTS = {
+    'menu-items': (MenuItemSerializer, lambda: MenuItem.objects.order_by('pk'), seed_menu_items),
+    'cart': (CartSerializer, lambda: Cart.objects.select_related('menuitem').order_by('pk'), seed_cart_rows),
+    'orders': (OrderSerializer, lambda: orders_with_items(Order.objects.order_by('pk')), seed_orders),
+}
+
+
+class Command(BaseCommand):
+    help = ('Compares the regular serializers with the fast read-only path (fast_serializers.py) on the list '
+            'endpoints: objects per second from query to rendered JSON, and whether the bytes are identical')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--lists', nargs='+', choices=list(LISTS), default=list(LISTS))
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, rows, lists, json, **options):
+        results = []
+        renderer = JSONRenderer()
+        with benchmark_database():
+            for count in sorted(rows):
+                for name in lists:
+                    serializer_class, queryset, seed = LISTS[name]
+                    seed(count)
+                    with Timer() as regular:
+                        expected = renderer.render(serializer_class(queryset()[:count], many=True).data)
+                    with Timer() as fast:
+                        output = renderer.render(fast_serializer(serializer_class).serialize(queryset()[:count]))
+                    results.append([name, count, count / regular.seconds, count / fast.seconds,
+                                    regular.seconds / fast.seconds, output == expected])
+                    self.stderr.write(f'{name} {count}: {regular.seconds / fast.seconds:.1f}x')
+        write_report(self, ['list', 'rows', 'serializer_obj_per_s', 'fast_obj_per_s', 'speedup', 'identical'],
+                     results, as_json=json)
@@ -0,0 +1,53 @@
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from LittleLemonAPI.benchmarks import Timer, benchmark_database, benchmark_users, seed_menu_items, seed_orders, \
+    write_report
+from LittleLemonAPI.roles import MANAGER
+from LittleLemonAPI.views import get_post_menu_items, manage_orders
+
+
+class Command(BaseCommand):
+    help = 'Compares peak Python memory of buffered and ?stream=true list responses as the row count grows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 50000])
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, rows, json, **options):
+        results = []
+        with benchmark_database():
+            manager = benchmark_users()[MANAGER]
+            for count in sorted(rows):
+                seed_orders(count)
+                seed_menu_items(count)
+                for endpoint, view in (('/api/orders/', manage_orders), ('/api/menu-items/', get_post_menu_items)):
+                    for streamed in (False, True):
+                        # The menu listing is paginated, so its non-streamed baseline is one 100 item page
+                        mode = 'stream' if streamed else 'page' if view is get_post_menu_items else 'buffered'
+                        results.append([endpoint, count, mode, *measure(view, endpoint, manager, streamed)])
+        write_report(self, ['endpoint', 'rows', 'mode', 'peak_mib', 'seconds', 'bytes'], results, as_json=json)
+
+
+def measure(view, path, user, streamed):
+    # Builds and fully consumes the response twice: once timed, once under tracemalloc (which slows
+    # allocation down too much to time). Returns (peak MiB, seconds, body size).
+    with Timer() as timer:
+        size = consume(view, path, user, streamed)
+    tracemalloc.start()
+    consume(view, path, user, streamed)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20, timer.seconds, size
+
+
+def consume(view, path, user, streamed):
+    query = {'stream': 'true'} if streamed else {'page_size': 100}
+    request = APIRequestFactory().get(path, query, HTTP_ACCEPT='application/json')
+    force_authenticate(request, user)
+    response = view(request)
+    if streamed:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.render().content)
@@ -0,0 +1,99 @@
+import multiprocessing
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.urls import resolve
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from LittleLemonAPI import throttling
+from LittleLemonAPI.benchmarks import percentile, write_report
+from LittleLemonAPI.roles import CUSTOMER, REQUEST_ATTRIBUTE
+
+PATH = '/api/orders/'
+
+
+class Command(BaseCommand):
+    help = ('Measures what the rate limiting (throttling.py) adds to every request: microseconds per throttle '
+            'check for each bucket store, and checks per second with several processes sharing the SQLite store')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checks', type=int, default=50000)
+        parser.add_argument('--clients', type=int, default=1000, help='Distinct users the checks are spread over')
+        parser.add_argument('--stores', nargs='+', choices=['none', 'local', 'sqlite', 'redis'],
+                            default=['none', 'local', 'sqlite', 'redis'])
+        parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+        parser.add_argument('--redis-url', default='redis://127.0.0.1:6379/15')
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, checks, clients, stores, processes, redis_url, json, **options):
+        requests = build_requests(clients)
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/throttle.sqlite3'
+            for store in stores:
+                # Limits high enough that every check is allowed, which is the common, full-cost case
+                with override_settings(THROTTLE_ENABLED=store != 'none', THROTTLE_STORE=store,
+                                       THROTTLE_SQLITE_PATH=path, THROTTLE_REDIS_URL=redis_url,
+                                       THROTTLE_RATES={CUSTOMER: {'*': '1000000/1000000'}}):
+                    try:
+                        latencies = time_checks(requests, checks)
+                    except ImproperlyConfigured as exc:
+                        self.stderr.write(f'{store}: skipped ({exc})')
+                        continue
+                    except Exception as exc:
+                        self.stderr.write(f'{store}: skipped ({type(exc).__name__}: {exc})')
+                        continue
+                    finally:
+                        throttling.reset_store()
+                results.append([store, 1, checks / (sum(latencies) / 1e6), percentile(latencies, 50),
+                                percentile(latencies, 99)])
+                self.stderr.write(f'{store}: p50 {percentile(latencies, 50):.1f} us')
+            if 'sqlite' in stores:
+                for count in sorted(set(processes) - {1}):
+                    results.append(['sqlite', count, shared_checks(path, count, checks, clients), None, None])
+        write_report(self, ['store', 'processes', 'checks_per_s', 'p50_us', 'p99_us'], results, as_json=json)
+
+
+def build_requests(clients):
+    # Authenticated customer requests to PATH; the roles are preset so no check touches the database
+    factory = APIRequestFactory()
+    requests = []
+    for pk in range(1, clients + 1):
+        request = factory.get(PATH)
+        request.resolver_match = resolve(PATH)
+        user = User(pk=pk, username=f'bench-throttle-{pk}')
+        setattr(user, REQUEST_ATTRIBUTE, frozenset([CUSTOMER]))
+        request = Request(request)
+        request.user = user
+        requests.append(request)
+    return requests
+
+
+def time_checks(requests, checks):
+    # Microseconds per TokenBucketThrottle check, as DRF runs it for every request
+    latencies = []
+    for i in range(checks):
+        throttle = throttling.TokenBucketThrottle()
+        started = time.perf_counter()
+        throttle.allow_request(requests[i % len(requests)], None)
+        latencies.append((time.perf_counter() - started) * 1e6)
+    return latencies
+
+
+def shared_checks(path, processes, checks, clients):
+    # Total takes per second from `processes` processes hammering the same SQLite file at once
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        started = time.perf_counter()
+        pool.starmap(take_loop, [(path, checks // processes, clients, i) for i in range(processes)])
+        return checks / (time.perf_counter() - started)
+
+
+def take_loop(path, checks, clients, offset):
+    store = throttling.SQLiteStore(path)
+    for i in range(checks):
+        store.take(f'user:{(i + offset) % clients}|*', 1000000, 1000000, time.time())
@@ -0,0 +1,75 @@
+import json as jsonlib
+import os
+import sys
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from LittleLemonAPI.benchmarks import free_port, manage_py, run_load, server, write_report
+
+from .bench_asgi import load_json
+
+# Profiles without a scratch file of their own (postgres) use the database named by the POSTGRES_*
+# environment variables, so point POSTGRES_DB at a scratch database before benchmarking it
+PROFILES = ['sqlite', 'sqlite-wal', 'postgres']
+
+
+class Command(BaseCommand):
+    help = ('Measures write throughput of concurrent cart adds and checkouts (POST /api/cart/menu-items/ and '
+            'POST /api/orders/) under each DATABASE_PROFILE, served by uvicorn with several worker processes. '
+            'Needs uvicorn installed; the postgres profile also needs psycopg and a scratch database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=['sqlite', 'sqlite-wal'])
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+        parser.add_argument('--duration', type=float, default=5.0, help='Seconds per concurrency level')
+        parser.add_argument('--workers', type=int, default=4, help='uvicorn worker processes')
+        parser.add_argument('--customers', type=int, default=64)
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per result')
+
+    def handle(self, *args, profiles, concurrency, duration, workers, customers, json, **options):
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            raise CommandError('bench_writes needs uvicorn: pip install uvicorn')
+
+        results = []
+        for profile in profiles:
+            with tempfile.TemporaryDirectory() as directory:
+                env = {'DATABASE_PROFILE': profile, 'SQLITE_PATH': os.path.join(directory, 'bench.sqlite3'),
+                       'LITTLELEMON_ASYNC_VIEWS': '0', 'THROTTLE_ENABLED': '0'}
+                manage_py('migrate', env=env)
+                seeded = load_json(manage_py('shell', '-c', (
+                    'import json; from LittleLemonAPI.benchmarks import seed_write_scenario; '
+                    f'print(json.dumps(seed_write_scenario({customers})))'
+                ), env=env, capture=True))
+                requests = write_requests(seeded)
+
+                port = free_port()
+                command = [sys.executable, '-m', 'uvicorn', '--interface', 'wsgi', 'LittleLemon.wsgi:application',
+                           '--port', str(port), '--workers', str(workers), '--log-level', 'error', '--no-access-log']
+                with server(command, env=env, port=port):
+                    run_load(port, requests, 2, 1.0)  # warm up
+                    for level in concurrency:
+                        report = run_load(port, requests, level, duration)
+                        # Successful writes; an empty cart at checkout (400) doesn't count
+                        created = report['statuses'].get(201, 0)
+                        results.append([profile, level, report['requests'], report['errors'], report['rps'],
+                                        created / report['elapsed'], report['p50_ms'], report['p99_ms']])
+                        self.stderr.write(f'{profile} c={level}: {report["rps"]:.0f} req/s, '
+                                          f'{report["errors"]} errors')
+        write_report(self, ['profile', 'concurrency', 'requests', 'errors', 'rps', 'writes_per_s', 'p50_ms',
+                            'p99_ms'], results, as_json=json)
+
+
+def write_requests(seeded):
+    # Every customer adds a few items to their cart and checks out, over and over. Consecutive requests
+    # belong to different customers, so concurrent connections contend for the database, not for one cart.
+    titles = seeded['menu_items']
+    requests = []
+    for i, token in enumerate(seeded['tokens']):
+        headers = {'Accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': f'Token {token}'}
+        items = [{'menuitem': titles[(i + j) % len(titles)], 'quantity': 1} for j in range(3)]
+        requests.append(('POST', '/api/cart/menu-items/', headers, jsonlib.dumps(items).encode()))
+    checkouts = [('POST', '/api/orders/', request[2], b'') for request in requests]
+    return requests + checkouts
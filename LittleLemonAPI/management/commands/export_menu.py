@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from LittleLemonAPI.catalog import export_menu_items
+
+
+class Command(BaseCommand):
+    help = 'Writes every menu item as NDJSON or CSV, in the format import_menu reads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='Output file, or - for stdout (default)')
+        parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+
+    def handle(self, *args, path, format, **options):
+        if path == '-':
+            for chunk in export_menu_items(format):
+                self.stdout.write(chunk, ending='')
+            return
+        with open(path, 'w', encoding='utf-8', newline='') as output:
+            for chunk in export_menu_items(format):
+                output.write(chunk)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from LittleLemonAPI.benchmarks import Timer
+from LittleLemonAPI.cart_store import LocalCartStore, flush_carts, get_cart_store
+
+
+class Command(BaseCommand):
+    help = ('Writes the carts changed in the cart store (CART_STORE = sqlite) to the Cart table now, e.g. before '
+            'a deploy or from cron. The web processes also do it every CART_FLUSH_INTERVAL seconds.')
+
+    def handle(self, *args, **options):
+        store = get_cart_store()
+        if store is None:
+            raise CommandError('CART_STORE is database: carts are already in the Cart table')
+        if isinstance(store, LocalCartStore):
+            raise CommandError('CART_STORE is local: only the web process holding the carts can flush them')
+        with Timer() as timer:
+            carts = flush_carts(store)
+        self.stdout.write(f'Flushed {carts} carts in {timer.seconds:.1f}s')
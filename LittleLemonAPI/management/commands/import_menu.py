@@ -0,0 +1,34 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from LittleLemonAPI.catalog import DEFAULT_CHUNK_SIZE, import_menu_items
+
+
+class Command(BaseCommand):
+    help = 'Creates or updates (by title) menu items from an NDJSON or CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or - for stdin")
+        parser.add_argument('--format', choices=['ndjson', 'csv'],
+                            help='Defaults to csv for .csv files and ndjson otherwise')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, path, format, chunk_size, **options):
+        format = format or ('csv' if path.endswith('.csv') else 'ndjson')
+        started = time.perf_counter()
+        try:
+            stream = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+        except OSError as e:
+            raise CommandError(e)
+        with stream:
+            report = import_menu_items(stream, format, chunk_size=chunk_size)
+        elapsed = time.perf_counter() - started
+
+        for error in report['errors']:
+            self.stderr.write(f"line {error['line']}: {error['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {report['created']} and updated {report['updated']} menu items "
+            f"({report['error_count']} rows rejected) in {elapsed:.2f}s"
+        ))
@@ -0,0 +1,44 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from LittleLemonAPI.jobs import queue_stats, run_workers
+
+
+class Command(BaseCommand):
+    help = ('Runs the background jobs (jobs.py) until stopped with Ctrl+C or SIGTERM, which lets the running '
+            'batches finish. Start as many of these as needed, on any machine using the same database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=getattr(settings, 'JOB_WORKER_CONCURRENCY', 1),
+                            help='Worker threads in this process')
+        parser.add_argument('--batch-size', type=int, help="Jobs per batch, instead of each handler's own")
+        parser.add_argument('--names', nargs='+', help='Only run the jobs with these names')
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is due')
+        parser.add_argument('--stats', action='store_true', help='Print the number of jobs per name and state')
+
+    def handle(self, *args, concurrency, batch_size, names, burst, stats, **options):
+        if stats:
+            for name, counts in queue_stats().items():
+                self.stdout.write(f"{name}: {counts['due']} due, {counts['scheduled']} scheduled, "
+                                  f"{counts['failed']} failed")
+            return
+        stop = threading.Event()
+
+        def stopping(signum, frame):
+            # Ctrl+C and SIGTERM let the running batches finish; a second Ctrl+C interrupts them
+            if not stop.is_set():
+                self.stderr.write('Stopping after the running batches')
+            stop.set()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            handlers = {signum: signal.signal(signum, stopping) for signum in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            run_workers(concurrency, names, batch_size, burst, stop)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
@@ -0,0 +1,31 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from LittleLemonAPI.benchmarks import Timer
+from LittleLemonAPI.rollups import rebuild, verify
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds (or backfills) the sales rollups from the order history, or verifies them against a full '
+            'recomputation. verify exits with an error when they differ.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['rebuild', 'verify'])
+        parser.add_argument('--start', type=datetime.date.fromisoformat, help='First date (YYYY-MM-DD)')
+        parser.add_argument('--end', type=datetime.date.fromisoformat, help='Last date (YYYY-MM-DD)')
+
+    def handle(self, *args, action, start, end, **options):
+        with Timer() as timer:
+            if action == 'rebuild':
+                rows = rebuild(start, end)
+            else:
+                differences = verify(start, end)
+        if action == 'rebuild':
+            self.stdout.write(f'Rebuilt {rows} rollup rows in {timer.seconds:.1f}s')
+            return
+        for table, key, stored, expected in differences[:100]:
+            self.stdout.write(f'{table} {key}: stored {stored}, expected {expected}')
+        if differences:
+            raise CommandError(f'{len(differences)} rollup rows differ from the order history')
+        self.stdout.write(f'Rollups match the order history (checked in {timer.seconds:.1f}s)')
@@ -0,0 +1,45 @@
+import json as jsonlib
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from LittleLemonAPI.benchmarks import Timer, seed_data
+from LittleLemonAPI.menu_cache import menu_changed
+from LittleLemonAPI.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = ('Seeds the database with realistic data at the given scale: managers, delivery crew and customers '
+            '(with tokens), categories, menu items, orders and carts. Tables are topped up to the requested '
+            'sizes, so the command can be re-run to grow an existing data set.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--managers', type=int, default=2)
+        parser.add_argument('--delivery-crew', type=int, default=10)
+        parser.add_argument('--customers', type=int, default=1000)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--menu-items', type=int, default=10000)
+        parser.add_argument('--orders', type=int, default=10000)
+        parser.add_argument('--items-per-order', type=int, default=3)
+        parser.add_argument('--cart-items', type=int, default=2, help='Cart rows per customer')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, for reproducible data sets')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the counts, tokens and sample titles as JSON (used by bench_load)')
+
+    def handle(self, *args, json, **options):
+        options = {name: options[name] for name in (
+            'managers', 'delivery_crew', 'customers', 'categories', 'menu_items', 'orders', 'items_per_order',
+            'cart_items', 'batch_size', 'seed')}
+        with Timer() as timer, transaction.atomic():
+            seeded = seed_data(**options)
+            # The orders are bulk inserted too, so the sales rollups are recomputed
+            rebuild()
+        # bulk_create doesn't send post_save, so the cached menu is invalidated here
+        menu_changed()
+        if json:
+            self.stdout.write(jsonlib.dumps(seeded))
+            return
+        for table, count in seeded['counts'].items():
+            self.stdout.write(f'{table}: {count}')
+        self.stdout.write(f'Seeded in {timer.seconds:.1f}s')
@@ -0,0 +1,141 @@
+import functools
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .replicas import MENU_PIN, pin
+
+# Menu responses are cached under a version counter instead of being deleted one by one:
+# every write bumps the version, which makes all previously cached pages unreachable at once.
+VERSION_KEY = 'menu:version'
+
+
+def get_menu_cache():
+    return caches[getattr(settings, 'MENU_CACHE_ALIAS', 'default')]
+
+
+def get_menu_version(cache=None):
+    cache = cache or get_menu_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Start from the clock rather than 0 so an evicted counter never reuses an old version
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_menu_version():
+    # Returns the new version, or None when the counter had to be started again
+    cache = get_menu_cache()
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def menu_changed(bumped=None):
+    # Bump now so this process stops serving the old menu, and again after commit so a page that a
+    # concurrent request cached from the not-yet-committed state is discarded too. Until the read replicas
+    # have caught up, the menu is read from the primary, so the cache isn't refilled with the old menu.
+    # bumped, if given, is called with each version this produces.
+    def bump():
+        version = bump_menu_version()
+        if bumped is not None:
+            bumped(version)
+
+    bump()
+    transaction.on_commit(bump)
+    pin(MENU_PIN)
+
+
+def compute_etag(data):
+    content = json.dumps(data, cls=JSONEncoder, sort_keys=True, separators=(',', ':'))
+    return quote_etag(hashlib.blake2b(content.encode(), digest_size=16).hexdigest())
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    return '*' in etags or etag in (tag.removeprefix('W/') for tag in etags)
+
+
+def not_modified(etag):
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+
+def cache_key(request, version, args, kwargs):
+    url = request.build_absolute_uri(request.path)
+    query = sorted(request.query_params.lists())
+    key_source = json.dumps([url, query, args, sorted(kwargs.items())], default=str)
+    return f'menu:{version}:{hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()}'
+
+
+def cacheable(response):
+    # Errors and streamed responses are not cached
+    return response.status_code == status.HTTP_200_OK and isinstance(response, Response)
+
+
+def cached_response(request, cached):
+    etag, data = cached
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return Response(data, headers={'ETag': etag})
+
+
+def cache_menu_response(view):
+    # Caches successful GET responses of a menu view and answers If-None-Match with 304 Not Modified.
+    # Goes between @api_view and the view function so authentication and permissions still run first.
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return view(request, *args, **kwargs)
+
+        cache = get_menu_cache()
+        key = cache_key(request, get_menu_version(cache), args, kwargs)
+        cached = cache.get(key)
+        if cached is None:
+            response = view(request, *args, **kwargs)
+            if not cacheable(response):
+                return response
+            cached = (compute_etag(response.data), response.data)
+            cache.set(key, cached, getattr(settings, 'MENU_CACHE_TIMEOUT', 300))
+        return cached_response(request, cached)
+
+    return wrapper
+
+
+async def aget_menu_version(cache):
+    version = await cache.aget(VERSION_KEY)
+    if version is None:
+        await cache.aadd(VERSION_KEY, time.time_ns(), timeout=None)
+        version = await cache.aget(VERSION_KEY)
+    return version
+
+
+def acache_menu_response(handler):
+    # cache_menu_response for the async handlers in async_views.py
+    @functools.wraps(handler)
+    async def wrapper(request, *args, **kwargs):
+        cache = get_menu_cache()
+        key = cache_key(request, await aget_menu_version(cache), args, kwargs)
+        cached = await cache.aget(key)
+        if cached is None:
+            response = await handler(request, *args, **kwargs)
+            if not cacheable(response):
+                return response
+            cached = (compute_etag(response.data), response.data)
+            await cache.aset(key, cached, getattr(settings, 'MENU_CACHE_TIMEOUT', 300))
+        return cached_response(request, cached)
+
+    return wrapper
@@ -0,0 +1,290 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.utils.crypto import constant_time_compare
+
+# Per-request performance metrics. RequestMetricsMiddleware times every request and collects
+# - the number of SQL queries and the time spent in them (record_query, installed on every database
+#   connection by signals.py),
+# - serializer time (serializers.py) and render time, both excluding the SQL run inside them,
+# reports them in a Server-Timing header, adds them to per-route histograms served at /metrics in the
+# Prometheus text format (to scrapers with the METRICS_TOKEN bearer token) and, when SLOW_REQUEST_MS is
+# set, logs slow requests with their SQL. The histograms are per process: with several workers, scrape each
+# one (or sum them).
+logger = logging.getLogger('LittleLemonAPI.slow_requests')
+
+_current = contextvars.ContextVar('littlelemon_request_metrics', default=None)
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+# Slow request logs keep at most this many statements
+MAX_LOGGED_QUERIES = 100
+
+
+class RequestMetrics:
+    __slots__ = ('queries', 'db_time', 'serialize_time', 'render_time', 'phase', 'statements')
+
+    def __init__(self, keep_statements):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.render_time = 0.0
+        # The phase being measured, so nested measure() blocks aren't counted twice
+        self.phase = None
+        # (sql, seconds) of every query, only kept while the slow request log is on
+        self.statements = [] if keep_statements else None
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.queries += 1
+        metrics.db_time += elapsed
+        if metrics.statements is not None and len(metrics.statements) < MAX_LOGGED_QUERIES:
+            # Without params: they can hold secrets such as the token key being authenticated
+            metrics.statements.append((sql, elapsed))
+
+
+@contextmanager
+def measure(phase):
+    # Adds the time spent in the block, minus the SQL run in it, to phase ('serialize' or 'render').
+    # Nested blocks (a serializer inside a serializer) are only counted once.
+    metrics = _current.get()
+    if metrics is None or metrics.phase is not None:
+        yield
+        return
+    attribute = f'{phase}_time'
+    metrics.phase = phase
+    started, db_time = time.perf_counter(), metrics.db_time
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started - (metrics.db_time - db_time)
+        setattr(metrics, attribute, getattr(metrics, attribute) + elapsed)
+        metrics.phase = None
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus one for +Inf; cumulated when exported
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+# name -> (help, buckets); every histogram is labelled by route and method
+HISTOGRAMS = {
+    'littlelemon_request_duration_seconds': ('Time to handle the request', DURATION_BUCKETS),
+    'littlelemon_request_db_seconds': ('Time spent in SQL queries', DURATION_BUCKETS),
+    'littlelemon_request_serialize_seconds': ('Time spent in serializers, excluding SQL', DURATION_BUCKETS),
+    'littlelemon_request_render_seconds': ('Time spent rendering the response, excluding SQL', DURATION_BUCKETS),
+    'littlelemon_request_queries': ('SQL queries per request', QUERY_BUCKETS),
+}
+_histograms = {}  # (name, route, method) -> Histogram
+_responses = {}  # (route, method, status) -> count
+_lock = threading.Lock()
+
+# Counters of work done outside of the request histograms; name -> help. Only work done by the serving
+# processes can be counted here: a management command's increments die with its process.
+COUNTERS = {
+    'littlelemon_archive_reads_total': 'Order reads that were answered from the archive tables',
+}
+_counters = {}  # name -> value
+# Values read from the database on every scrape, for state changed by other processes (keep them to cheap
+# lookups); name -> (help, function, Prometheus type)
+GAUGES = {}
+
+
+def observe(route, method, status, total, metrics):
+    values = {
+        'littlelemon_request_duration_seconds': total,
+        'littlelemon_request_db_seconds': metrics.db_time,
+        'littlelemon_request_serialize_seconds': metrics.serialize_time,
+        'littlelemon_request_render_seconds': metrics.render_time,
+        'littlelemon_request_queries': metrics.queries,
+    }
+    with _lock:
+        for name, value in values.items():
+            key = (name, route, method)
+            histogram = _histograms.get(key)
+            if histogram is None:
+                histogram = _histograms[key] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+        key = (route, method, status)
+        _responses[key] = _responses.get(key, 0) + 1
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def gauge(name, help_text, metric_type='gauge'):
+    # Decorator registering function() as the value of gauge name; metric_type='counter' for a total another
+    # process keeps
+    def register(function):
+        GAUGES[name] = (help_text, function, metric_type)
+        return function
+    return register
+
+
+def counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _responses.clear()
+        _counters.clear()
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def export():
+    # The metrics in the Prometheus text exposition format
+    with _lock:
+        histograms = {key: (list(h.counts), h.sum) for key, h in _histograms.items()}
+        responses = dict(_responses)
+        counters = dict(_counters)
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for (metric, route, method), (counts, total) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            labels = f'route="{label(route)}",method="{method}"'
+            cumulative = 0
+            for bound, count in zip((*buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {total}')
+            lines.append(f'{name}_count{{{labels}}} {cumulative}')
+    lines += ['# HELP littlelemon_responses_total Responses by route, method and status',
+              '# TYPE littlelemon_responses_total counter']
+    for (route, method, status), count in sorted(responses.items()):
+        lines.append(f'littlelemon_responses_total{{route="{label(route)}",method="{method}",status="{status}"}} '
+                     f'{count}')
+    for name, help_text in COUNTERS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter', f'{name} {counters.get(name, 0)}']
+    for name, (help_text, function, metric_type) in GAUGES.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {function()}']
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not getattr(settings, 'METRICS_ENABLED', True) or not token:
+        raise Http404
+    if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        response = HttpResponse('Unauthorized\n', status=401, content_type='text/plain')
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    return HttpResponse(export(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def route_of(request):
+    # The URL pattern rather than the path, so /api/orders/1/ and /api/orders/2/ share a histogram
+    match = getattr(request, 'resolver_match', None)
+    return f'/{match.route}' if match is not None else 'unmatched'
+
+
+def server_timing(metrics, total):
+    return ', '.join([
+        f'db;dur={metrics.db_time * 1000:.2f};desc="{metrics.queries} queries"',
+        f'serialize;dur={metrics.serialize_time * 1000:.2f}',
+        f'render;dur={metrics.render_time * 1000:.2f}',
+        f'total;dur={total * 1000:.2f}',
+    ])
+
+
+class RequestMetricsMiddleware:
+    # Goes first in MIDDLEWARE, so the total covers the other middleware too
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.acall(request)
+        if not self.enabled(request):
+            return self.get_response(request)
+        metrics, token, started = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, started)
+
+    async def acall(self, request):
+        if not self.enabled(request):
+            return await self.get_response(request)
+        metrics, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, started)
+
+    def enabled(self, request):
+        return getattr(settings, 'METRICS_ENABLED', True) and request.path != '/metrics'
+
+    def start(self):
+        metrics = RequestMetrics(keep_statements=getattr(settings, 'SLOW_REQUEST_MS', None) is not None)
+        return metrics, _current.set(metrics), time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # Called right before a DRF Response is rendered; the callback runs right after
+        metrics = _current.get()
+        if metrics is not None:
+            started, db_time = time.perf_counter(), metrics.db_time
+
+            def rendered(response):
+                metrics.render_time += time.perf_counter() - started - (metrics.db_time - db_time)
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def finish(self, request, response, metrics, started):
+        total = time.perf_counter() - started
+        response['Server-Timing'] = server_timing(metrics, total)
+        observe(route_of(request), request.method, response.status_code, total, metrics)
+        threshold = getattr(settings, 'SLOW_REQUEST_MS', None)
+        if threshold is not None and total * 1000 >= threshold:
+            log_slow_request(request, response, metrics, total)
+        return response
+
+
+def log_slow_request(request, response, metrics, total):
+    statements = '\n'.join(f'  {seconds * 1000:.2f} ms  {sql}' for sql, seconds in metrics.statements)
+    logger.warning(
+        'Slow request: %s %s -> %s in %.1f ms (%d queries, %.1f ms in SQL)\n%s',
+        request.method, request.get_full_path(), response.status_code, total * 1000, metrics.queries,
+        metrics.db_time * 1000, statements,
+    )
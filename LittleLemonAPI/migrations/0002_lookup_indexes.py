@@ -0,0 +1,84 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def rename_duplicate_titles(apps, schema_editor):
+    # The old read-then-insert check could let duplicates through; keep the first row of each title and
+    # suffix the others with their id so the unique indexes can be created
+    for model_name in ('Category', 'MenuItem'):
+        model = apps.get_model('LittleLemonAPI', model_name)
+        duplicates = model.objects.values('title').annotate(count=Count('pk')).filter(count__gt=1)
+        for title in duplicates.values_list('title', flat=True):
+            for row in model.objects.filter(title=title).order_by('pk')[1:]:
+                row.title = free_title(model, title, row.pk)
+                row.save(update_fields=['title'])
+
+
+def free_title(model, title, pk):
+    # "<title> (<pk>)", with the title shortened to fit 255 characters, or "(<pk>-2)", "(<pk>-3)", ... when
+    # another row already has that title
+    attempt = 1
+    while True:
+        suffix = f' ({pk})' if attempt == 1 else f' ({pk}-{attempt})'
+        candidate = title[:255 - len(suffix)] + suffix
+        if not model.objects.filter(title=candidate).exists():
+            return candidate
+        attempt += 1
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('LittleLemonAPI', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_titles, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='category',
+            name='title',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='menuitem',
+            name='title',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'status', 'date'], name='order_user_status_date'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['delivery_crew', 'status', 'date'], name='order_crew_status_date'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cart',
+            unique_together={('user', 'menuitem')},
+        ),
+        migrations.AlterField(
+            model_name='cart',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='delivery_crew',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='delivery_crew', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='LittleLemonAPI.order'),
+        ),
+    ]
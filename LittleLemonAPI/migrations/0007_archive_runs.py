@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('LittleLemonAPI', '0006_order_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('finished', models.DateTimeField(auto_now_add=True)),
+                ('orders', models.IntegerField()),
+                ('items', models.IntegerField()),
+                ('batches', models.IntegerField()),
+                ('archived_orders', models.BigIntegerField()),
+                ('archived_order_items', models.BigIntegerField()),
+            ],
+        ),
+    ]
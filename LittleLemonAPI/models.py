@@ -6,13 +6,16 @@ from django.contrib.auth.models import User
 
 class Category(models.Model):
     slug = models.SlugField()
-    title = models.CharField(max_length=255, db_index=True)
+    # Categories are looked up by title (menu filters, the catalog import), so titles are unique
+    title = models.CharField(max_length=255, unique=True)
 
     def __str__(self):
         return self.title
 
 class MenuItem(models.Model):
-    title = models.CharField(max_length=255, db_index=True)
+    # Menu items are addressed by title in the URLs and the cart; the unique index also makes the
+    # database reject duplicate menu items, even when two managers create the same one at once
+    title = models.CharField(max_length=255, unique=True)
     price = models.DecimalField(max_digits=6, decimal_places=2, db_index=True)
     featured = models.BooleanField(db_index=True)
     category = models.ForeignKey(Category, on_delete=models.PROTECT)
@@ -22,7 +25,8 @@ class MenuItem(models.Model):
 
 class Cart(models.Model):
     # we use CASCADE here because if the User gets deleted we want their cart to also be deleted
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # (no index of its own: the unique (user, menuitem) index below starts with user)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     menuitem = models.ForeignKey(MenuItem, on_delete=models.CASCADE)
     quantity = models.SmallIntegerField()
     unit_price = models.DecimalField(max_digits=6, decimal_places=2)
@@ -32,20 +36,130 @@ class Cart(models.Model):
         return self.user.username
     class Meta:
         #  a user can have only one cart entry for a particular menu item
-        unique_together = ('menuitem', 'user')
+        # user first, so the same index serves "this user's cart"
+        unique_together = ('user', 'menuitem')
 
 class Order(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    delivery_crew = models.ForeignKey(User, on_delete=models.SET_NULL, related_name="delivery_crew", null=True)
+    # Orders are listed per customer or per delivery crew member, narrowed by status and date; the
+    # composite indexes in Meta cover those lookups (and the plain user / delivery_crew ones)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    delivery_crew = models.ForeignKey(User, on_delete=models.SET_NULL, related_name="delivery_crew", null=True,
+                                      db_index=False)
     status = models.BooleanField(db_index=True, default=0)
     total = models.DecimalField(max_digits=6, decimal_places=2)
     date = models.DateField(db_index=True)
 
     def __str__(self):
         return self.user.username
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'status', 'date'], name='order_user_status_date'),
+            models.Index(fields=['delivery_crew', 'status', 'date'], name='order_crew_status_date'),
+        ]
 
 class OrderItem(models.Model):
-    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    # (no index of its own: the unique (order, menuitem) index below starts with order)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, db_index=False)
+    menuitem = models.ForeignKey(MenuItem, on_delete=models.CASCADE)
+    quantity = models.SmallIntegerField()
+    unit_price = models.DecimalField(max_digits=6, decimal_places=2)
+    price = models.DecimalField(max_digits=6, decimal_places=2)
+
+    def __str__(self):
+        return self.menuitem.title
+    class Meta:
+        unique_together = ('order', 'menuitem')
+
+
+# Sales rollups, kept up to date by rollups.py as orders are placed, delivered and deleted, so reports read a
+# few rows per day instead of the whole order history. `delivered` is the order status.
+class DailySales(models.Model):
+    date = models.DateField()
+    delivered = models.BooleanField()
+    orders = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        # date first, so the same index serves the date range of a report
+        unique_together = ('date', 'delivered')
+
+class ItemSales(models.Model):
+    date = models.DateField()
+    menuitem = models.ForeignKey(MenuItem, on_delete=models.CASCADE)
+    delivered = models.BooleanField()
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('date', 'menuitem', 'delivered')
+
+
+# Background jobs (jobs.py). A job is written in the transaction of the change that needs it and run by
+# `manage.py run_jobs`; finished jobs are deleted, jobs that ran out of attempts stay with failed = True.
+# run_at is when the job is due: a worker claiming a job pushes it past its lease, a failure past the backoff.
+class Job(models.Model):
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    run_at = models.DateTimeField()
+    attempts = models.SmallIntegerField(default=0)
+    failed = models.BooleanField(default=False)
+    # The claim of the worker currently running the job
+    locked_by = models.CharField(max_length=64, blank=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.name} #{self.pk}'
+
+    class Meta:
+        # The workers' "what is due" query
+        indexes = [models.Index(fields=['failed', 'run_at'], name='job_due')]
+
+
+# Order events for the live stream (events.py) when ORDER_EVENTS_BROKER is 'database': written in the
+# transaction of the order change, read back by every process's poller and by reconnecting clients
+# (id > Last-Event-ID). order_id is not a foreign key so events outlive deleted orders.
+class OrderEvent(models.Model):
+    kind = models.CharField(max_length=20)
+    order_id = models.BigIntegerField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    delivery_crew = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', null=True, db_index=False)
+    data = models.JSONField(default=dict)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        # A reconnecting customer's or crew member's missed events
+        indexes = [
+            models.Index(fields=['user', 'id'], name='orderevent_user_id'),
+            models.Index(fields=['delivery_crew', 'id'], name='orderevent_crew_id'),
+        ]
+
+
+# Order history moved out of Order / OrderItem by archive.py: delivered orders older than
+# ORDER_ARCHIVE_AFTER_DAYS, so the hot tables only hold recent and open orders. Rows keep their original ids,
+# so an archived order is still found by its orderId; the columns are the same.
+class ArchivedOrder(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    delivery_crew = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='+', null=True, db_index=False)
+    status = models.BooleanField(default=0)
+    total = models.DecimalField(max_digits=6, decimal_places=2)
+    date = models.DateField(db_index=True)
+    archived = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.user.username
+
+    class Meta:
+        # Historical lookups are per customer or crew member and date range
+        indexes = [
+            models.Index(fields=['user', 'date'], name='archivedorder_user_date'),
+            models.Index(fields=['delivery_crew', 'date'], name='archivedorder_crew_date'),
+        ]
+
+class ArchivedOrderItem(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, db_index=False)
     menuitem = models.ForeignKey(MenuItem, on_delete=models.CASCADE)
     quantity = models.SmallIntegerField()
     unit_price = models.DecimalField(max_digits=6, decimal_places=2)
@@ -53,6 +167,17 @@ class OrderItem(models.Model):
 
     def __str__(self):
         return self.menuitem.title
+
     class Meta:
         unique_together = ('order', 'menuitem')
 
+
+# One row per archive_orders run (archive.py): what it moved, and the size of the archive tables after it,
+# so /metrics reads them from the latest run instead of counting the archive tables on every scrape
+class ArchiveRun(models.Model):
+    finished = models.DateTimeField(auto_now_add=True)
+    orders = models.IntegerField()
+    items = models.IntegerField()
+    batches = models.IntegerField()
+    archived_orders = models.BigIntegerField()
+    archived_order_items = models.BigIntegerField()
@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+from .events import publish as publish_order_events
+from .jobs import enqueue, handler
+from .models import Order
+
+# Order emails. Checkout and order updates only enqueue a job (jobs.py) in their transaction; the worker
+# sends the emails in batches over one mail connection, so a slow or unreachable mail server never shows
+# in the API's response times. Users without an email address are skipped.
+
+JOB = 'order_notifications'
+PLACED, ASSIGNED, DELIVERED = 'placed', 'assigned', 'delivered'
+
+MESSAGES = {
+    # event -> (recipient, subject, body)
+    PLACED: ('user', 'Order #{order.pk} received',
+             'Thank you for your order of ${order.total}. We will let you know when it has been delivered.'),
+    ASSIGNED: ('delivery_crew', 'Order #{order.pk} assigned to you',
+               'Order #{order.pk} (${order.total}) for {order.user.username} is yours to deliver.'),
+    DELIVERED: ('user', 'Order #{order.pk} delivered', 'Your order of ${order.total} has been delivered. Enjoy!'),
+}
+
+
+def order_events(pk, old_crew, new_crew, old_status, new_status):
+    # The notifications for an order update
+    events = []
+    if new_crew is not None and new_crew != old_crew:
+        events.append({'order': pk, 'event': ASSIGNED})
+    if new_status and not old_status:
+        events.append({'order': pk, 'event': DELIVERED})
+    return events
+
+
+def notify(events):
+    # events: [{'order': pk, 'event': PLACED, ASSIGNED or DELIVERED}, ...]. They go into one job, so a bulk
+    # dispatch still writes a single row. The same events go to the order event streams (events.py).
+    if events:
+        enqueue(JOB, [{'events': events}])
+        publish_order_events(events)
+
+
+@handler(JOB, batch_size=100)
+def send_order_notifications(payloads):
+    events = [event for payload in payloads for event in payload['events']]
+    orders = Order.objects.select_related('user', 'delivery_crew').in_bulk({event['order'] for event in events})
+    messages = []
+    for event in events:
+        order = orders.get(event['order'])
+        if order is None:
+            # Deleted since
+            continue
+        recipient, subject, body = MESSAGES[event['event']]
+        user = getattr(order, recipient)
+        if user is not None and user.email:
+            messages.append(EmailMessage(subject.format(order=order), body.format(order=order),
+                                         settings.DEFAULT_FROM_EMAIL, [user.email]))
+    if messages:
+        get_connection().send_messages(messages)
@@ -0,0 +1,81 @@
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .cart import MAX_PRICE, CartLimitExceeded
+from .cart_store import get_cart_store, lock_users, restore_cart, take_cart
+from .models import Cart, MenuItem, Order, OrderItem
+from .notifications import PLACED, notify
+from .rollups import change, order_state
+
+
+def checkout(user):
+    # Turns the user's cart into an order in one transaction and a fixed number of queries,
+    # whatever the size of the cart. Returns the new Order, or None for an empty cart.
+    store = get_cart_store()
+    if store is not None:
+        return checkout_stored_cart(user, store)
+    with transaction.atomic():
+        cart = Cart.objects.filter(user=user)
+        # Lock the cart rows with a no-op UPDATE before reading them. On PostgreSQL/MySQL this takes the
+        # row locks, on SQLite it takes the database write lock. A concurrent checkout by the same user
+        # blocks here until we commit and then finds the cart already empty, so a double-submit cannot
+        # create two orders.
+        if not cart.update(quantity=F('quantity')):
+            return None
+
+        rows = list(cart.values_list('pk', 'menuitem_id', 'quantity', 'unit_price', 'price'))
+        cart_ids = [row[0] for row in rows]
+        # Only the rows read above are ordered and removed: an item added to the cart while we were
+        # checking out stays in the cart instead of being deleted without being ordered
+        total = Cart.objects.filter(pk__in=cart_ids).aggregate(total=Sum('price'))['total']
+
+        Cart.objects.filter(pk__in=cart_ids).delete()
+        order = place_order(user, [row[1:] for row in rows], total)
+    return order
+
+
+def checkout_stored_cart(user, store):
+    # checkout() for a cart in the cart store (cart_store.py). The cart is taken out of the store first, so
+    # a concurrent checkout finds it empty and an item added meanwhile stays in the cart; if placing the
+    # order fails, the items go back.
+    taken = take_cart(store, user)
+    if not taken:
+        return None
+    try:
+        with transaction.atomic():
+            # The cart's copy in the Cart table, if it was flushed, is ordered now. The flusher may be writing an
+            # older copy of the cart: once it has the user's lock, it waits for its commit and deletes that too.
+            lock_users([user.pk])
+            Cart.objects.filter(user=user).delete()
+            # Items whose menu item was deleted since they were added are dropped, as the cascade would have
+            menu_items = set(MenuItem.objects.filter(pk__in=[item['menuitem']['id'] for item in taken])
+                             .values_list('pk', flat=True))
+            rows = [(item['menuitem']['id'], item['quantity'], Decimal(item['unit_price']), Decimal(item['price']))
+                    for item in taken if item['menuitem']['id'] in menu_items]
+            if not rows:
+                return None
+            order = place_order(user, rows, sum(row[3] for row in rows))
+    except BaseException:
+        restore_cart(store, user, taken)
+        raise
+    return order
+
+
+def place_order(user, rows, total):
+    # Creates the order and its items from [(menuitem_id, quantity, unit_price, price), ...]; call it inside
+    # the checkout transaction
+    if total > MAX_PRICE:
+        # Concurrent additions of different items can take a cart past the limit each checked alone
+        raise CartLimitExceeded()
+    order = Order.objects.create(user=user, total=total, date=timezone.localdate())
+    OrderItem.objects.bulk_create(
+        OrderItem(order=order, menuitem_id=menuitem_id, quantity=quantity, unit_price=unit_price, price=price)
+        for menuitem_id, quantity, unit_price, price in rows
+    )
+    change(added=[order_state(order)])
+    # The confirmation email goes out from the job worker, once this transaction has committed
+    notify([{'order': order.pk, 'event': PLACED}])
+    return order
@@ -0,0 +1,131 @@
+import base64
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    # Cursor (keyset) pagination: instead of OFFSET, every page starts with a WHERE on the
+    # ordering column plus the primary key, so the database walks the index from where
+    # the last page ended and each page costs the same no matter how deep it is.
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    ordering_fields = ('id',)
+    default_ordering = 'id'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        # Same as paginate_queryset, fetching the page with the async ORM
+        return self.set_page([obj async for obj in self.page_queryset(queryset, request)])
+
+    def page_queryset(self, queryset, request):
+        # Returns the queryset for the requested page, with one extra row
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request)
+        field, descending = self.ordering.lstrip('-'), self.ordering.startswith('-')
+        self.field = 'pk' if field == 'id' else field
+
+        cursor = self.decode_cursor(request, queryset.model)
+        self.cursor = cursor
+        self.reverse = cursor is not None and cursor['reverse']
+        # Walking backwards (to the previous page) flips the ordering and the comparison
+        backwards = descending != self.reverse
+
+        order_by = ['-pk'] if backwards else ['pk']
+        if self.field != 'pk':
+            order_by.insert(0, f'-{self.field}' if backwards else self.field)
+        queryset = queryset.order_by(*order_by)
+        if cursor is not None:
+            queryset = queryset.filter(self.keyset_filter(cursor['value'], cursor['pk'], backwards))
+        # Fetch one extra row so we know whether another page follows without a COUNT(*)
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, results):
+        has_following = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_following
+        else:
+            self.has_next, self.has_previous = has_following, self.cursor is not None
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_ordering(self, request):
+        ordering = request.query_params.get(self.ordering_query_param, self.default_ordering)
+        if ordering.lstrip('-') not in self.ordering_fields:
+            return self.default_ordering
+        return ordering
+
+    def keyset_filter(self, value, pk, backwards):
+        lookup = 'lt' if backwards else 'gt'
+        if self.field == 'pk':
+            return Q(**{f'pk__{lookup}': pk})
+        return Q(**{f'{self.field}__{lookup}': value}) | Q(**{self.field: value, f'pk__{lookup}': pk})
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            # An empty backwards page can only happen if rows were deleted; restart from the top
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def encode_cursor(self, obj, reverse):
+        value = None if self.field == 'pk' else getattr(obj, self.field)
+        payload = {'o': self.ordering, 'v': None if value is None else str(value), 'p': obj.pk, 'r': int(reverse)}
+        token = base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, token)
+
+    def decode_cursor(self, request, model):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(token.encode()))
+            if payload['o'] != self.ordering:
+                raise ValueError('cursor belongs to a different ordering')
+            value = payload['v']
+            if self.field != 'pk':
+                value = model._meta.get_field(self.field).to_python(value)
+            return {'value': value, 'pk': int(payload['p']), 'reverse': bool(payload['r'])}
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+
+class MenuItemPagination(KeysetPagination):
+    # Every ordering here is backed by an index (id is the primary key, price and title have db_index=True)
+    ordering_fields = ('id', 'price', 'title')
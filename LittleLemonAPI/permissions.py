@@ -1,21 +1,23 @@
 from rest_framework import permissions
 
+from .roles import MANAGER, DELIVERY_CREW, CUSTOMER, has_role
+
 
 class IsManager(permissions.BasePermission):
     message = "User is not a manager"
 
     def has_permission(self, request, view):
-        return request.user.groups.filter(name='Manager').exists()
+        return has_role(request.user, MANAGER)
 
 
 class IsDeliveryCrew(permissions.BasePermission):
     message = "User is not a delivery crew member"
 
     def has_permission(self, request, view):
-        return request.user.groups.filter(name='Delivery Crew').exists()
+        return has_role(request.user, DELIVERY_CREW)
 
 class IsCustomer(permissions.BasePermission):
     message = "User is not a Customer"
 
     def has_permission(self, request, view):
-        return request.user.groups.filter(name='Customer').exists()
+        return has_role(request.user, CUSTOMER)
@@ -0,0 +1,198 @@
+import contextvars
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+# Read replicas. The views' GET and HEAD requests read this app's tables (menu, cart, orders, rollups) from
+# the DATABASE_REPLICAS aliases, round-robin over the ones passing a health check; everything else, and every
+# request that isn't safe, uses the primary. Users, tokens and groups always come from the primary, so a
+# fresh token or role change is never missed because of replication lag.
+#
+# Read-your-writes: a user's successful write (adding to the cart, checkout, an order update, ...) pins that
+# user's reads to the primary for REPLICA_PIN_SECONDS, which should cover the replicas' lag. Menu writes pin
+# all menu reads, so the menu cache is never refilled with a stale menu. Pins are kept in the
+# REPLICA_PIN_CACHE_ALIAS cache, which has to be shared by the processes (file-based or Redis): a pin in a
+# locmem cache would only hold for the requests the writing worker happens to get.
+
+logger = logging.getLogger(__name__)
+
+APP_LABEL = 'LittleLemonAPI'
+MENU_MODELS = {'menuitem', 'category'}
+MENU_PIN = 'menu'
+SAFE_METHODS = ('GET', 'HEAD')
+
+# The request being handled, while it is safe to read from a replica
+_request = contextvars.ContextVar('littlelemon_replica_request', default=None)
+
+
+def replica_aliases():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def pin_seconds():
+    return getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+
+
+def pin_cache():
+    alias = getattr(settings, 'REPLICA_PIN_CACHE_ALIAS', 'replica-pins')
+    cache = caches[alias]
+    if isinstance(cache, LocMemCache):
+        raise ImproperlyConfigured(f'REPLICA_PIN_CACHE_ALIAS {alias!r} is a per-process locmem cache: with '
+                                   'DATABASE_REPLICAS, pins need a cache shared by the workers')
+    return cache
+
+
+def pin(key):
+    # Sends the reads of `key` (a user id, or MENU_PIN) to the primary for the next REPLICA_PIN_SECONDS
+    if replica_aliases() and pin_seconds() > 0:
+        pin_cache().set(f'replica-pin:{key}', 1, pin_seconds())
+
+
+def pinned(key):
+    return pin_cache().get(f'replica-pin:{key}') is not None
+
+
+class ReplicaHealth:
+    # Which replicas answer. Each one is checked at most every REPLICA_HEALTH_CHECK_INTERVAL seconds; a
+    # replica failing a check gets no reads until it passes the next one.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = {}  # alias -> (when, healthy)
+        self.counter = itertools.count()
+
+    def choose(self):
+        # The next healthy replica, round-robin, or None
+        healthy = [alias for alias in replica_aliases() if self.healthy(alias)]
+        if not healthy:
+            return None
+        return healthy[next(self.counter) % len(healthy)]
+
+    def healthy(self, alias):
+        now = time.monotonic()
+        with self.lock:
+            checked = self.checked.get(alias)
+            if checked is not None and now - checked[0] < getattr(settings, 'REPLICA_HEALTH_CHECK_INTERVAL', 5):
+                return checked[1]
+            # Until the check below is done, other threads go by the last result
+            self.checked[alias] = (now, checked[1] if checked is not None else True)
+        healthy = check(alias)
+        with self.lock:
+            self.checked[alias] = (now, healthy)
+        return healthy
+
+    def reset(self):
+        with self.lock:
+            self.checked.clear()
+
+
+def check(alias):
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        return True
+    except DatabaseError:
+        logger.warning('Replica %s failed its health check', alias, exc_info=True)
+        connection.close()
+        return False
+
+
+health = ReplicaHealth()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        request = _request.get()
+        if request is None or model._meta.app_label != APP_LABEL:
+            return None
+        menu = model._meta.model_name in MENU_MODELS
+        # Decided once per request (and user: the user is only known once the view has authenticated it),
+        # so all of a request's reads see the same database
+        user = getattr(request, 'user', None)
+        user_id = user.pk if user is not None and user.is_authenticated else None
+        choice = request.__dict__.get('_replica_choice')
+        if choice is None or choice[0] != user_id:
+            alias = None if user_id is not None and pinned(user_id) else health.choose()
+            choice = request._replica_choice = (user_id, alias, alias is not None and pinned(MENU_PIN))
+        _, alias, menu_pinned = choice
+        if alias is None or (menu and menu_pinned):
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Replicas get the schema through replication
+        return db not in replica_aliases()
+
+
+class ReplicaMiddleware:
+    # Lets ReplicaRouter send the request's reads to a replica, and pins the user after a write
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.acall(request)
+        token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                _request.reset(token)
+        return self.finish(request, response)
+
+    async def acall(self, request):
+        token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            if token is not None:
+                _request.reset(token)
+        return self.finish(request, response)
+
+    def start(self, request):
+        if request.method in SAFE_METHODS and replica_aliases():
+            return _request.set(request)
+        return None
+
+    def finish(self, request, response):
+        # DRF sets request.user when it authenticates the token
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and response.status_code < 400 and user is not None and \
+                user.is_authenticated:
+            pin(user.pk)
+        return response
+
+
+def sync_sqlite_replicas(aliases=None):
+    # Copies the primary SQLite database over the replica files: how replication is simulated locally and
+    # in the tests. The replicas lag until this is called again.
+    source = connections[DEFAULT_DB_ALIAS]
+    source.ensure_connection()
+    for alias in aliases or replica_aliases():
+        connections[alias].close()
+        target = sqlite3.connect(connections[alias].settings_dict['NAME'].removeprefix('file:').split('?')[0])
+        try:
+            source.connection.backup(target)
+        finally:
+            target.close()
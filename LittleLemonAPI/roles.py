@@ -0,0 +1,140 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Group names used for authorization throughout the API
+MANAGER = 'Manager'
+DELIVERY_CREW = 'Delivery Crew'
+CUSTOMER = 'Customer'
+
+# Process-level cache of user id -> (expires_at, roles, version). Group membership changes are rare compared
+# to the number of permission checks, so each worker keeps the roles for a short TTL. The m2m_changed
+# receivers in signals.py drop entries as soon as membership changes in this process, and bump a version
+# per user in the token cache's shared tier (TOKEN_CACHE_ALIAS), which every lookup is checked against, so
+# the other processes stop using the old roles on their next request too.
+_cache = {}
+_lock = threading.Lock()
+# Bumped on every invalidation so a lookup that raced with a membership change doesn't store stale roles
+_generation = 0
+
+# The roles are also remembered on the user object, which lives exactly as long as the request
+REQUEST_ATTRIBUTE = '_littlelemon_roles'
+SHARED_PREFIX = 'roles'
+SHARED_EPOCH_KEY = f'{SHARED_PREFIX}:epoch'
+
+
+def get_roles(user):
+    # Returns the frozenset of group names for this user, hitting auth_group at most once per TTL
+    if user is None or not user.is_authenticated:
+        return frozenset()
+    roles = getattr(user, REQUEST_ATTRIBUTE, None)
+    if roles is None:
+        version = shared_version(user.pk)
+        roles = cached_roles(user, version)
+        if roles is None:
+            generation = _generation
+            roles = store_roles(user, generation, version, user.groups.values_list('name', flat=True))
+        setattr(user, REQUEST_ATTRIBUTE, roles)
+    return roles
+
+
+async def aget_roles(user):
+    # get_roles for async views
+    if user is None or not user.is_authenticated:
+        return frozenset()
+    roles = getattr(user, REQUEST_ATTRIBUTE, None)
+    if roles is None:
+        version = await ashared_version(user.pk)
+        roles = cached_roles(user, version)
+        if roles is None:
+            generation = _generation
+            names = [name async for name in user.groups.values_list('name', flat=True)]
+            roles = store_roles(user, generation, version, names)
+        setattr(user, REQUEST_ATTRIBUTE, roles)
+    return roles
+
+
+def get_shared_cache():
+    alias = getattr(settings, 'TOKEN_CACHE_ALIAS', 'auth-tokens')
+    return caches[alias] if alias else None
+
+
+def shared_version_keys(user_id):
+    # A user's cached roles are valid while both the global epoch and the user's own version are unchanged
+    return [SHARED_EPOCH_KEY, f'{SHARED_PREFIX}:user:{user_id}']
+
+
+def shared_version(user_id):
+    # The user's current version in the shared tier, or None without one
+    shared = get_shared_cache()
+    if shared is None:
+        return None
+    keys = shared_version_keys(user_id)
+    found = shared.get_many(keys)
+    if len(found) < len(keys):
+        for key in keys:
+            shared.add(key, time.time_ns(), None)
+        found = shared.get_many(keys)
+    return tuple(found.get(key) for key in keys)
+
+
+async def ashared_version(user_id):
+    shared = get_shared_cache()
+    if shared is None:
+        return None
+    keys = shared_version_keys(user_id)
+    found = await shared.aget_many(keys)
+    if len(found) < len(keys):
+        for key in keys:
+            await shared.aadd(key, time.time_ns(), None)
+        found = await shared.aget_many(keys)
+    return tuple(found.get(key) for key in keys)
+
+
+def cached_roles(user, version):
+    entry = _cache.get(user.pk)
+    if entry is not None and entry[0] > time.monotonic() and entry[2] == version:
+        return entry[1]
+    return None
+
+
+def store_roles(user, generation, version, names):
+    # version was read before the roles were, so roles read after a concurrent change carry the old version
+    roles = frozenset(names)
+    with _lock:
+        if generation == _generation:
+            if len(_cache) >= getattr(settings, 'ROLE_CACHE_MAX_ENTRIES', 10000):
+                # Entries are kept in insertion order, so this drops the oldest one
+                _cache.pop(next(iter(_cache)), None)
+            _cache[user.pk] = (time.monotonic() + getattr(settings, 'ROLE_CACHE_TTL', 60), roles, version)
+    return roles
+
+
+def has_role(user, role):
+    return role in get_roles(user)
+
+
+def invalidate_roles(user_ids=None):
+    # Forgets the cached roles for the given user ids, or for everyone when user_ids is None
+    global _generation
+    with _lock:
+        _generation += 1
+        if user_ids is None:
+            _cache.clear()
+        else:
+            for user_id in user_ids:
+                _cache.pop(user_id, None)
+    shared = get_shared_cache()
+    if shared is not None:
+        if user_ids is None:
+            shared.set(SHARED_EPOCH_KEY, time.time_ns(), None)
+        else:
+            shared.set_many({shared_version_keys(user_id)[1]: time.time_ns() for user_id in user_ids}, None)
+
+
+def forget_request_roles(user):
+    # Drops the per-request copy, e.g. when the requesting user's own membership just changed
+    if user is not None and hasattr(user, REQUEST_ATTRIBUTE):
+        delattr(user, REQUEST_ATTRIBUTE)
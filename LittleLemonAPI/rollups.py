@@ -0,0 +1,238 @@
+import datetime
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, IntegerField, Sum, Value, When
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .jobs import enqueue, handler
+from .models import ArchivedOrder, ArchivedOrderItem, DailySales, ItemSales, Job, Order, OrderItem
+
+# Incrementally maintained sales rollups (DailySales and ItemSales). Every change to the orders works out
+# how the counters change, in one query, and enqueues that as a job (jobs.py) in the same transaction:
+# - checkout adds the new order (orders.py),
+# - delivering an order moves it from the open to the delivered counters (dispatch.py, and the Order
+#   pre_save / post_save receivers in signals.py for saves such as PATCH /api/orders/<id>/),
+# - deleting an order subtracts it (the Order pre_delete receiver, while its items still exist).
+# The job worker applies the changes in batches. Every checkout of a day adds to the same DailySales row, so
+# applying them in the request would make concurrent checkouts wait for each other's row locks. The reports
+# lag behind by the worker's poll interval. The handler is atomic (its updates commit with the deletion of
+# its jobs), so a change is applied exactly once.
+# Archiving orders (archive.py) leaves the rollups alone. Bulk writes that bypass all of these (the seeder,
+# raw SQL) are caught up with `manage.py sales_rollups rebuild`; `manage.py sales_rollups verify` compares
+# the rollups with a full recomputation, archive included. Both apply the pending changes first.
+
+# Keys per UPDATE, to keep the CASE expressions to a sensible size
+BATCH_SIZE = 500
+JOB = 'sales_rollups'
+
+
+def change(removed=(), added=()):
+    # removed / added: [(order pk, date, delivered, total), ...]. An order moving from open to delivered is
+    # removed with its old state and added with the new one. Call it inside the transaction changing the orders.
+    orders = {}
+    daily = {}
+    for sign, entries in ((-1, removed), (1, added)):
+        for pk, date, delivered, total in entries:
+            orders.setdefault(pk, []).append((sign, date, delivered))
+            counts = daily.setdefault((date, delivered), [0, Decimal(0)])
+            counts[0] += sign
+            counts[1] += sign * total
+    if not orders:
+        return
+    items = {}
+    for order_id, menuitem_id, quantity, price in OrderItem.objects.filter(order_id__in=orders).values_list(
+            'order_id', 'menuitem_id', 'quantity', 'price'):
+        for sign, date, delivered in orders[order_id]:
+            counts = items.setdefault((date, menuitem_id, delivered), [0, Decimal(0)])
+            counts[0] += sign * quantity
+            counts[1] += sign * price
+    payload = {
+        'daily': [[date.isoformat(), delivered, orders, str(revenue)]
+                  for (date, delivered), (orders, revenue) in daily.items() if orders or revenue],
+        'items': [[date.isoformat(), menuitem_id, delivered, quantity, str(revenue)]
+                  for (date, menuitem_id, delivered), (quantity, revenue) in items.items() if quantity or revenue],
+    }
+    if payload['daily'] or payload['items']:
+        enqueue(JOB, [payload])
+
+
+@handler(JOB, batch_size=500, atomic=True)
+def apply_changes(payloads):
+    # Adds up the changes of a batch, so a busy day's checkouts update each rollup row once
+    daily = {}
+    items = {}
+    for payload in payloads:
+        for date, delivered, orders, revenue in payload['daily']:
+            add(daily, (datetime.date.fromisoformat(date), delivered), (orders, Decimal(revenue)))
+        for date, menuitem_id, delivered, quantity, revenue in payload['items']:
+            add(items, (datetime.date.fromisoformat(date), menuitem_id, delivered), (quantity, Decimal(revenue)))
+    increment(DailySales, ('date', 'delivered'), ('orders', 'revenue'), daily)
+    increment(ItemSales, ('date', 'menuitem_id', 'delivered'), ('quantity', 'revenue'), items)
+
+
+def apply_pending():
+    # Applies the changes still waiting for the worker; returns how many jobs that took. A worker running some
+    # of them at the same time finds its jobs gone and rolls back.
+    with transaction.atomic():
+        jobs = list(Job.objects.select_for_update().filter(name=JOB, failed=False).order_by('pk').values_list(
+            'pk', 'payload'))
+        if jobs:
+            apply_changes([payload for _, payload in jobs])
+            Job.objects.filter(pk__in=[pk for pk, _ in jobs]).delete()
+    return len(jobs)
+
+
+def increment(model, key_fields, value_fields, deltas):
+    # Adds deltas ({key: [value, ...]}) to the rows with those keys, creating missing rows. The new values
+    # are computed by the database from the current ones, so concurrent checkouts on the same day all count.
+    deltas = {key: values for key, values in deltas.items() if any(values)}
+    keys = list(deltas)
+    for start in range(0, len(keys), BATCH_SIZE):
+        batch = keys[start:start + BATCH_SIZE]
+        model.objects.bulk_create([model(**dict(zip(key_fields, key))) for key in batch], ignore_conflicts=True)
+        # The candidate rows are narrowed per key field; the exact keys are matched here
+        filters = {f'{field}__in': {key[i] for key in batch} for i, field in enumerate(key_fields)}
+        pks = {tuple(row[1:]): row[0] for row in model.objects.filter(**filters).values_list('pk', *key_fields)}
+        updates = {}
+        for i, field in enumerate(value_fields):
+            output_field = IntegerField() if i == 0 else DecimalField(max_digits=12, decimal_places=2)
+            updates[field] = F(field) + Case(
+                *(When(pk=pks[key], then=Value(deltas[key][i])) for key in batch),
+                default=Value(0), output_field=output_field,
+            )
+        model.objects.filter(pk__in=[pks[key] for key in batch]).update(**updates)
+
+
+def order_state(order):
+    return order.pk, order.date, order.status, order.total
+
+
+# Full recomputation, for rebuilding and verifying
+
+def recompute(start=None, end=None):
+    # ({(date, delivered): (orders, revenue)}, {(date, menuitem pk, delivered): (quantity, revenue)}) from the
+    # order tables and the order archive (archive.py), for the given dates (inclusive)
+    daily = {}
+    items = {}
+    for order_model, item_model in ((Order, OrderItem), (ArchivedOrder, ArchivedOrderItem)):
+        orders = date_range(order_model.objects.all(), 'date', start, end)
+        for row in orders.values('date', 'status').annotate(orders=Count('pk'), revenue=Sum('total')):
+            add(daily, (row['date'], row['status']), (row['orders'], row['revenue']))
+        order_items = date_range(item_model.objects.all(), 'order__date', start, end)
+        for row in order_items.values('order__date', 'menuitem_id', 'order__status').annotate(
+                quantity=Sum('quantity'), revenue=Sum('price')):
+            add(items, (row['order__date'], row['menuitem_id'], row['order__status']),
+                (row['quantity'], row['revenue']))
+    return daily, items
+
+
+def add(totals, key, values):
+    if key in totals:
+        values = tuple(total + value for total, value in zip(totals[key], values))
+    totals[key] = values
+
+
+def stored(start=None, end=None):
+    # The same from the rollup tables, leaving out rows that went back to zero
+    daily = {(date, delivered): (orders, revenue) for date, delivered, orders, revenue in
+             date_range(DailySales.objects.all(), 'date', start, end).values_list(
+                 'date', 'delivered', 'orders', 'revenue') if orders or revenue}
+    items = {(date, menuitem_id, delivered): (quantity, revenue) for date, menuitem_id, delivered, quantity, revenue in
+             date_range(ItemSales.objects.all(), 'date', start, end).values_list(
+                 'date', 'menuitem_id', 'delivered', 'quantity', 'revenue') if quantity or revenue}
+    return daily, items
+
+
+def rebuild(start=None, end=None, batch_size=5000):
+    # Replaces the rollups for the given dates with a full recomputation; returns the number of rows written.
+    # Runs in one transaction, and the order tables are read inside it.
+    with transaction.atomic():
+        # Pending changes of other dates still have to be applied; those of these dates are recomputed anyway
+        apply_pending()
+        date_range(DailySales.objects.all(), 'date', start, end).delete()
+        date_range(ItemSales.objects.all(), 'date', start, end).delete()
+        daily, items = recompute(start, end)
+        DailySales.objects.bulk_create((
+            DailySales(date=date, delivered=delivered, orders=orders, revenue=revenue)
+            for (date, delivered), (orders, revenue) in daily.items()
+        ), batch_size=batch_size)
+        ItemSales.objects.bulk_create((
+            ItemSales(date=date, menuitem_id=menuitem_id, delivered=delivered, quantity=quantity, revenue=revenue)
+            for (date, menuitem_id, delivered), (quantity, revenue) in items.items()
+        ), batch_size=batch_size)
+    return len(daily) + len(items)
+
+
+def verify(start=None, end=None):
+    # [(table, key, stored, expected), ...] for every rollup that differs from a full recomputation
+    apply_pending()
+    differences = []
+    for table, actual, expected in zip(('daily', 'items'), stored(start, end), recompute(start, end)):
+        for key in sorted(actual.keys() | expected.keys(), key=str):
+            if actual.get(key) != expected.get(key):
+                differences.append((table, key, actual.get(key), expected.get(key)))
+    return differences
+
+
+def date_range(queryset, field, start, end):
+    if start is not None:
+        queryset = queryset.filter(**{f'{field}__gte': start})
+    if end is not None:
+        queryset = queryset.filter(**{f'{field}__lte': end})
+    return queryset
+
+
+# Reports
+
+GROUPINGS = {
+    # group_by -> (rollup model, [(output key, field)], [(output key, summed field)])
+    'day': (DailySales, [('date', 'date')], [('orders', 'orders'), ('revenue', 'revenue')]),
+    'menuitem': (ItemSales, [('menuitem', 'menuitem_id'), ('title', 'menuitem__title')],
+                 [('quantity', 'quantity'), ('revenue', 'revenue')]),
+    'category': (ItemSales, [('category', 'menuitem__category_id'), ('title', 'menuitem__category__title')],
+                 [('quantity', 'quantity'), ('revenue', 'revenue')]),
+}
+STATUSES = {'all': None, 'open': False, 'delivered': True}
+
+
+def sales_report(start, end, group_by, status='all'):
+    # Revenue between start and end (inclusive) by day, menu item or category. Reads only the rollups, so it
+    # costs the same however many orders there are.
+    model, keys, sums = GROUPINGS[group_by]
+    queryset = date_range(model.objects.all(), 'date', start, end)
+    if STATUSES[status] is not None:
+        queryset = queryset.filter(delivered=STATUSES[status])
+    rows = queryset.values(*(field for _, field in keys)).annotate(
+        **{f'total_{name}': Sum(field) for name, field in sums}
+    ).order_by(*(field for _, field in keys))
+    results = []
+    for row in rows:
+        result = {name: row[field] for name, field in keys}
+        result.update({name: row[f'total_{name}'] for name, _ in sums})
+        if any(result[name] for name, _ in sums):
+            results.append(result)
+    if group_by != 'day':
+        results.sort(key=lambda result: -result['revenue'])
+    totals = {name: sum((result[name] for result in results), Decimal(0) if name == 'revenue' else 0)
+              for name, _ in sums}
+    return {'start': start, 'end': end, 'group_by': group_by, 'status': status, 'totals': totals,
+            'results': results}
+
+
+def report_range(query_params, default_days=30):
+    # (start, end) from ?start=&end= (YYYY-MM-DD); the last default_days days by default
+    end = parse_date(query_params, 'end') or timezone.localdate()
+    start = parse_date(query_params, 'start') or end - datetime.timedelta(days=default_days - 1)
+    return start, end
+
+
+def parse_date(query_params, name):
+    value = query_params.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise ValidationError({name: 'Must be a date (YYYY-MM-DD)'})
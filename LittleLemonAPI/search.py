@@ -0,0 +1,420 @@
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from .menu_cache import get_menu_cache, get_menu_version
+from .models import Category, MenuItem
+
+# Menu search and autocomplete from an in-process index over MenuItem.title and Category.title, so a
+# query never scans the menu table with LIKE '%q%'. Titles are split into terms; a query term matches a
+# title term exactly, as a prefix, or as a prefix with one typo (a wrong, missing, extra or swapped
+# character), found through a deletion index instead of comparing against every term.
+#
+# Results are ranked by how well every query term matched (exact < prefix < typo, a category match counts
+# one step worse than a title match), then shorter titles first. Posting lists are kept in that order, so a
+# one-term query (most of autocomplete) just takes the first `limit` candidates. A query with several terms
+# intersects the sorted posting lists by leapfrogging (bisecting each list to the next key the others have)
+# once per total penalty, lowest first, and stops at the first `limit` items; so 'greek s' reads a few dozen
+# keys rather than every item with a word starting with s. A short query term only uses the posting lists of
+# the first MAX_PREFIX_TERMS index terms it is a prefix of.
+#
+# The index is built on first use and then kept up to date by the MenuItem and Category receivers in
+# signals.py, after commit. Writes from other processes, and bulk writes that don't send signals, show up
+# as an unexpected change of the shared menu version (menu_cache.py), which rebuilds the index. With the
+# per-process locmem menu cache that version isn't shared, so the index is also rebuilt once it is
+# SEARCH_INDEX_MAX_AGE seconds old. A rebuild reads the whole menu into a new index outside the lock, so
+# other searches keep answering from the current one until the new one is swapped in.
+
+TOKEN_RE = re.compile(r'\w+')
+# Query terms shorter than this must match exactly or as a prefix; longer ones may contain one typo
+MIN_FUZZY_LENGTH = 4
+# Typos are looked for in the first MAX_FUZZY_LENGTH characters of a term
+MAX_FUZZY_LENGTH = 12
+MAX_QUERY_TERMS = 8
+# Own menu versions remembered between searches; past this the index is rebuilt instead
+MAX_OWN_VERSIONS = 10000
+# Index terms one query term can match as a prefix
+MAX_PREFIX_TERMS = 100
+EXACT, PREFIX, FUZZY = 0, 1, 2
+# A term found in the category title ranks one step below the same match in the item title
+CATEGORY_PENALTY = 1
+
+
+def tokenize(text):
+    # Lowercase terms without accents or apostrophes: "Chef's Crème Brûlée" -> ['chefs', 'creme', 'brulee']
+    text = unicodedata.normalize('NFKD', text.replace("'", '').replace('’', '')).casefold()
+    return TOKEN_RE.findall(''.join(char for char in text if not unicodedata.combining(char)))
+
+
+def deletions(word):
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def fuzzy_keys(term):
+    # The prefixes of term, each with all of its one-character deletions. Two strings are at most one typo
+    # apart when their deletion sets (including themselves) share a string.
+    keys = set()
+    for length in range(MIN_FUZZY_LENGTH - 1, min(len(term), MAX_FUZZY_LENGTH) + 1):
+        prefix = term[:length]
+        keys.add(prefix)
+        if length >= MIN_FUZZY_LENGTH:
+            keys |= deletions(prefix)
+    return keys
+
+
+class SearchIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        # The menu version the index reflects (None: not built yet) and the later versions bumped by this
+        # process's own writes, which the index applies itself
+        self.version = None
+        self.own = set()
+        self.built = None  # time.monotonic() of the last rebuild
+        # While a new index is being built: the changes applied meanwhile, which it may have missed
+        self.replay = None
+        self.clear()
+
+    def clear(self):
+        self.items = {}  # item pk -> (rank key, title, category pk, terms)
+        self.categories = {}  # category pk -> (title, terms)
+        self.postings = {}  # term -> [rank key, ...] of the items with term in their title, sorted
+        self.category_postings = {}  # term -> {category pk, ...}
+        self.category_items = {}  # category pk -> [rank key, ...], sorted
+        self.terms = []  # every term, sorted, for prefix lookups
+        self.references = {}  # term -> number of item and category titles containing it
+        self.fuzzy = {}  # fuzzy key -> {term, ...}
+
+    # Building and updating
+
+    def rebuild(self, version):
+        self.clear()
+        for pk, title in Category.objects.values_list('pk', 'title'):
+            self.add_category(pk, title)
+        for pk, title, category_id in MenuItem.objects.values_list('pk', 'title', 'category_id').iterator(
+                chunk_size=5000):
+            self.add_item(pk, title, category_id, keep_sorted=False)
+        for keys in (*self.postings.values(), *self.category_items.values()):
+            keys.sort()
+        self.terms.sort()
+        self.version = version
+        self.built = time.monotonic()
+
+    def refresh(self):
+        # Rebuilds the index unless every menu change since it was built came from this process
+        version = get_menu_version()
+        with self.lock:
+            if self.version is None:
+                # Nothing to answer from yet
+                self.rebuild(version)
+                return
+            if self.owns(version) and not self.expired():
+                self.advance(version)
+                return
+            if self.replay is not None:
+                # Another thread is rebuilding it
+                return
+            self.replay = []
+        fresh = SearchIndex()
+        try:
+            fresh.rebuild(version)
+        finally:
+            with self.lock:
+                replay, self.replay = self.replay, None
+                if fresh.version is not None:
+                    for apply in replay:
+                        apply(fresh)
+                    self.__dict__.update({name: value for name, value in vars(fresh).items()
+                                          if name not in ('lock', 'own')})
+                    self.advance(fresh.version)
+
+    def owns(self, version):
+        # Whether every version since the index's was bumped by this process's own writes. A write that rolls
+        # back only bumps once, so counting bumps could take another process's bump for the missing one.
+        return self.version <= version <= self.version + len(self.own) and all(
+            own in self.own for own in range(self.version + 1, version + 1))
+
+    def advance(self, version):
+        self.version = version
+        self.own = {own for own in self.own if own > version}
+
+    def bumped(self, version):
+        # menu_changed() callback for the writes the index applies itself (signals.py)
+        with self.lock:
+            if self.version is None or version is None:
+                return
+            self.own.add(version)
+            if len(self.own) > MAX_OWN_VERSIONS:
+                # Not searched for a long time: rebuild on the next search rather than keep them all
+                self.own.clear()
+
+    def expired(self):
+        # Only a per-process menu version misses other processes' writes
+        max_age = getattr(settings, 'SEARCH_INDEX_MAX_AGE', 300)
+        return max_age is not None and isinstance(get_menu_cache(), LocMemCache) \
+            and time.monotonic() - self.built > max_age
+
+    def add_term(self, term, keep_sorted=True):
+        count = self.references.get(term, 0)
+        self.references[term] = count + 1
+        if count:
+            return
+        if keep_sorted:
+            insort(self.terms, term)
+        else:
+            self.terms.append(term)
+        if not term.isdigit():
+            for key in fuzzy_keys(term):
+                self.fuzzy.setdefault(key, set()).add(term)
+
+    def release_term(self, term):
+        self.references[term] -= 1
+        if self.references[term]:
+            return
+        del self.references[term]
+        del self.terms[bisect_left(self.terms, term)]
+        if not term.isdigit():
+            for key in fuzzy_keys(term):
+                self.fuzzy[key].discard(term)
+                if not self.fuzzy[key]:
+                    del self.fuzzy[key]
+
+    def add_item(self, pk, title, category_id, keep_sorted=True):
+        self.remove_item(pk)
+        key = (len(title), title.casefold(), pk)
+        terms = frozenset(tokenize(title))
+        self.items[pk] = (key, title, category_id, terms)
+        for term in (*terms, None):
+            keys = self.postings.setdefault(term, []) if term is not None \
+                else self.category_items.setdefault(category_id, [])
+            if keep_sorted:
+                insort(keys, key)
+            else:
+                keys.append(key)
+        for term in terms:
+            self.add_term(term, keep_sorted)
+
+    def remove_item(self, pk):
+        entry = self.items.pop(pk, None)
+        if entry is None:
+            return
+        key, _, category_id, terms = entry
+        for term in (*terms, None):
+            keys = self.postings[term] if term is not None else self.category_items[category_id]
+            del keys[bisect_left(keys, key)]
+            if term is not None and not keys:
+                del self.postings[term]
+        for term in terms:
+            self.release_term(term)
+
+    def add_category(self, pk, title):
+        self.remove_category(pk)
+        terms = frozenset(tokenize(title))
+        self.categories[pk] = (title, terms)
+        for term in terms:
+            self.category_postings.setdefault(term, set()).add(pk)
+            self.add_term(term)
+
+    def remove_category(self, pk):
+        entry = self.categories.pop(pk, None)
+        if entry is None:
+            return
+        for term in entry[1]:
+            self.category_postings[term].discard(pk)
+            if not self.category_postings[term]:
+                del self.category_postings[term]
+            self.release_term(term)
+
+    def changed(self, apply):
+        # Runs apply(index) (an add_/remove_ method call) after commit. The menu versions bumped for the same
+        # write are recorded by bumped(), so the next refresh() doesn't take them for a foreign change.
+        with self.lock:
+            if self.version is None:
+                return
+
+        def commit():
+            with self.lock:
+                if self.version is not None:
+                    apply(self)
+                    if self.replay is not None:
+                        # Applied again to the index being built, which may have read the menu before it
+                        self.replay.append(apply)
+
+        transaction.on_commit(commit)
+
+    # Querying
+
+    def match(self, token):
+        # {term: EXACT, PREFIX or FUZZY} for one query term
+        matches = {}
+        if len(token) >= MIN_FUZZY_LENGTH and not token.isdigit():
+            token_prefix = token[:MAX_FUZZY_LENGTH]
+            for key in (token_prefix, *deletions(token_prefix)):
+                for term in self.fuzzy.get(key, ()):
+                    matches[term] = FUZZY
+        start = bisect_left(self.terms, token)
+        for i in range(start, min(start + MAX_PREFIX_TERMS, len(self.terms))):
+            term = self.terms[i]
+            if not term.startswith(token):
+                break
+            matches[term] = EXACT if term == token else PREFIX
+        return matches
+
+    def candidate_lists(self, matches, penalty):
+        # The sorted rank key lists of the items matching at exactly this penalty
+        lists = [self.postings[term] for term, tier in matches.items() if tier == penalty and term in self.postings]
+        lists += [self.category_items.get(pk, ()) for term, tier in matches.items()
+                  if tier + CATEGORY_PENALTY == penalty for pk in self.category_postings.get(term, ())]
+        return lists
+
+    def candidates(self, matches, penalty):
+        # The rank keys of the items matching at exactly this penalty, best first (may repeat items)
+        return heapq.merge(*self.candidate_lists(matches, penalty))
+
+    def lowest_penalty(self, matches):
+        # The lowest penalty at which one query term can match any item
+        return min(tier + (0 if term in self.postings else CATEGORY_PENALTY) for term, tier in matches.items())
+
+    def penalty(self, pk, matches):
+        # The lowest penalty at which one query term matches the item, or None
+        _, _, category_id, terms = self.items[pk]
+        best = None
+        for penalty, item_terms in ((0, terms), (CATEGORY_PENALTY, self.categories.get(category_id, ('', ()))[1])):
+            for term in item_terms:
+                tier = matches.get(term)
+                if tier is not None and (best is None or tier + penalty < best):
+                    best = tier + penalty
+        return best
+
+    def search(self, text, limit):
+        # [(pk, title, category title), ...] of the best `limit` items matching every term of text
+        tokens = list(dict.fromkeys(tokenize(text)))[:MAX_QUERY_TERMS]
+        if not tokens:
+            return []
+        with self.lock:
+            matches = [self.match(token) for token in tokens]
+            if not all(matches):
+                return []
+            if len(matches) == 1:
+                return self.results(self.search_term(matches[0], limit))
+            return self.results(self.search_terms(matches, limit))
+
+    def search_term(self, matches, limit):
+        # One term: every candidate matches, so the first `limit` distinct ones, best first, are the answer
+        best, seen = [], set()
+        for level in range(FUZZY + CATEGORY_PENALTY + 1):
+            for key in self.candidates(matches, level):
+                if key[-1] not in seen:
+                    seen.add(key[-1])
+                    best.append((level, key))
+                    if len(best) == limit:
+                        return best
+        return best
+
+    def search_terms(self, matches, limit):
+        # Several terms: the results are found one total penalty at a time, lowest first. For each total, a term
+        # can match at most at the level left after every other term's lowest penalty, so only those of its
+        # posting lists are intersected, in rank key order; the first `limit` items at exactly that total are
+        # the best remaining ones.
+        levels = FUZZY + CATEGORY_PENALTY + 1
+        lowest = [self.lowest_penalty(term_matches) for term_matches in matches]
+        floor = sum(lowest)
+        best, seen = [], set()
+        for total in range(floor, (levels - 1) * len(matches) + 1):
+            lists = [[keys for level in range(min(levels, total - floor + low + 1))
+                      for keys in self.candidate_lists(term_matches, level)]
+                     for term_matches, low in zip(matches, lowest)]
+            # Leapfrogging from the term with the fewest candidates skips the most
+            lists.sort(key=lambda term_lists: sum(map(len, term_lists)))
+            for key in intersect(lists):
+                if key[-1] in seen:
+                    continue
+                if sum(self.penalty(key[-1], term_matches) for term_matches in matches) == total:
+                    seen.add(key[-1])
+                    best.append((total, key))
+                    if len(best) == limit:
+                        return best
+        return best
+
+    def results(self, best):
+        results = []
+        for _, key in best:
+            _, title, category_id, _ = self.items[key[-1]]
+            results.append((key[-1], title, self.categories.get(category_id, ('',))[0]))
+        return results
+
+
+def intersect(lists):
+    # The rank keys in at least one sorted list of every entry of lists, in order
+    first, *rest = lists
+    key = seek(first, ())
+    while key is not None:
+        target = key
+        for term_lists in rest:
+            found = seek(term_lists, key)
+            if found is None:
+                return
+            target = max(target, found)
+        if target == key:
+            yield key
+            # Just past it
+            target = key + (0,)
+        key = seek(first, target)
+
+
+def seek(lists, key):
+    # The smallest rank key >= key in any of the sorted lists, or None
+    found = None
+    for keys in lists:
+        i = bisect_left(keys, key)
+        if i < len(keys) and (found is None or keys[i] < found):
+            found = keys[i]
+    return found
+
+
+index = SearchIndex()
+
+
+def search(text, limit):
+    index.refresh()
+    return index.search(text, limit)
+
+
+def item_saved(instance):
+    index.changed(lambda target: target.add_item(instance.pk, instance.title, instance.category_id))
+
+
+def item_deleted(instance):
+    pk = instance.pk
+    index.changed(lambda target: target.remove_item(pk))
+
+
+def category_saved(instance):
+    index.changed(lambda target: target.add_category(instance.pk, instance.title))
+
+
+def category_deleted(instance):
+    pk = instance.pk
+    index.changed(lambda target: target.remove_category(pk))
+
+
+def search_params(query_params, default_limit, max_limit):
+    # ?q=<text>&limit=<n>
+    query = query_params.get('q', '').strip()
+    if not query:
+        raise ValidationError({'q': 'This parameter is required'})
+    limit = query_params.get('limit', default_limit)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValidationError({'limit': 'Must be a whole number'})
+    if not 1 <= limit <= max_limit:
+        raise ValidationError({'limit': f'Must be between 1 and {max_limit}'})
+    return query, limit
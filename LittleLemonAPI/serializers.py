@@ -1,32 +1,118 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import MenuItem, Cart, Order, OrderItem
+from .cart import MAX_QUANTITY
+from .metrics import measure
+from .models import ArchivedOrder, ArchivedOrderItem, MenuItem, Cart, Order, OrderItem
 
-class UserSerializer(serializers.ModelSerializer):
+
+# The serializers below time their output for the request metrics (metrics.py): TimedModelSerializer
+# for a single object, TimedListSerializer (their Meta.list_serializer_class) for many=True
+class TimedListSerializer(serializers.ListSerializer):
+    @property
+    def data(self):
+        with measure('serialize'):
+            return super().data
+
+
+class TimedModelSerializer(serializers.ModelSerializer):
+    @property
+    def data(self):
+        with measure('serialize'):
+            return super().data
+
+
+class UserSerializer(TimedModelSerializer):
     class Meta:
         model = User
         fields = ['username', 'email']
+        list_serializer_class = TimedListSerializer
 
 
-class MenuItemSerializer(serializers.ModelSerializer):
+class MenuItemSerializer(TimedModelSerializer):
     class Meta:
         model = MenuItem
         fields = '__all__'
+        list_serializer_class = TimedListSerializer
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(TimedModelSerializer):
     menuitem = MenuItemSerializer()
     class Meta:
         model = Cart
         fields = '__all__'
+        list_serializer_class = TimedListSerializer
+
+class CartItemListSerializer(serializers.ListSerializer):
+    def validate(self, attrs):
+        # Entries for the same title are added up
+        quantities = {}
+        for entry in attrs:
+            quantities[entry['menuitem']] = quantities.get(entry['menuitem'], 0) + entry['quantity']
+        if any(quantity > MAX_QUANTITY for quantity in quantities.values()):
+            raise serializers.ValidationError(f'At most {MAX_QUANTITY} of each menu item')
+        return attrs
+
+
+class CartItemInputSerializer(serializers.Serializer):
+    # One {menuitem, quantity} entry of a POST to the cart; menuitem is the menu item title
+    menuitem = serializers.CharField(max_length=255)
+    quantity = serializers.IntegerField(min_value=1, max_value=MAX_QUANTITY)
+
+    class Meta:
+        list_serializer_class = CartItemListSerializer
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(TimedModelSerializer):
     class Meta:
         model = OrderItem
         fields = '__all__'
+        list_serializer_class = TimedListSerializer
 
-class OrderSerializer(serializers.ModelSerializer):
-    order_item = OrderItemSerializer(many=True, read_only=True)
+class OrderSerializer(TimedModelSerializer):
+    # OrderItem has no related_name, so the reverse accessor is orderitem_set
+    order_item = OrderItemSerializer(many=True, read_only=True, source='orderitem_set')
     class Meta:
         model = Order
         fields = '__all__'
+        list_serializer_class = TimedListSerializer
+
+
+# Archived orders (archive.py) are represented exactly like the orders they were
+class ArchivedOrderItemSerializer(TimedModelSerializer):
+    class Meta:
+        model = ArchivedOrderItem
+        fields = ['id', 'quantity', 'unit_price', 'price', 'order', 'menuitem']
+        list_serializer_class = TimedListSerializer
+
+class ArchivedOrderSerializer(TimedModelSerializer):
+    order_item = ArchivedOrderItemSerializer(many=True, read_only=True, source='archivedorderitem_set')
+    class Meta:
+        model = ArchivedOrder
+        fields = ['id', 'order_item', 'user', 'delivery_crew', 'status', 'total', 'date']
+        list_serializer_class = TimedListSerializer
+
+
+class OrderUpdateSerializer(serializers.Serializer):
+    # PUT/PATCH of a single order; fields that aren't sent are left alone
+    delivery_crew = serializers.IntegerField(required=False, allow_null=True)
+    status = serializers.BooleanField(required=False)
+
+class DispatchAssignmentSerializer(serializers.Serializer):
+    # One order of a bulk dispatch. It only applies while the order is assigned to expected_delivery_crew
+    # (null: still unassigned) and, when given, at expected_status.
+    order = serializers.IntegerField()
+    delivery_crew = serializers.IntegerField()
+    status = serializers.BooleanField(required=False, allow_null=True, default=None)
+    expected_delivery_crew = serializers.IntegerField(required=False, allow_null=True, default=None)
+    expected_status = serializers.BooleanField(required=False, allow_null=True, default=None)
+
+class DispatchSerializer(serializers.Serializer):
+    # Either explicit assignments, or auto_assign to balance unassigned orders (the given ones, or the
+    # oldest `limit`) across the Delivery Crew
+    assignments = DispatchAssignmentSerializer(many=True, required=False)
+    auto_assign = serializers.BooleanField(required=False, default=False)
+    orders = serializers.ListField(child=serializers.IntegerField(), required=False, allow_null=True, default=None)
+    limit = serializers.IntegerField(required=False, min_value=1, max_value=1000, default=100)
 
+    def validate(self, data):
+        if data['auto_assign'] == ('assignments' in data):
+            raise serializers.ValidationError('Send either assignments or auto_assign')
+        return data
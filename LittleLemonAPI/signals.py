@@ -0,0 +1,144 @@
+from django.contrib.auth.models import User, Group
+from django.core.signals import setting_changed
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import invalidate_tokens
+from .cart_store import reset_cart_store
+from .events import reset_broker
+from .menu_cache import menu_changed
+from .metrics import record_query
+from .models import Category, MenuItem, Order
+from .rollups import change, order_state
+from .roles import forget_request_roles, invalidate_roles
+from .throttling import reset_store
+from . import search
+
+
+# Group membership changes made through the group endpoints (group.user_set.add/remove) or the admin
+# (user.groups.set) both go through the User.groups m2m table, so one receiver covers all of them
+@receiver(m2m_changed, sender=User.groups.through)
+def group_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # instance is the Group; pk_set holds the user ids (None when the whole group was cleared)
+        invalidate_roles(pk_set)
+        invalidate_tokens(pk_set)
+    else:
+        # instance is the User
+        invalidate_roles([instance.pk])
+        invalidate_tokens([instance.pk])
+        forget_request_roles(instance)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def group_changed(sender, **kwargs):
+    # A renamed or deleted group changes the roles of all of its members
+    invalidate_roles()
+    invalidate_tokens()
+
+
+# The token cache holds a copy of the user, so any change to the user (deactivation, a password change,
+# an edited profile) or to its token (djoser's token logout deletes it) revokes the cached entries
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        # Session logins only touch last_login, which doesn't matter to token authentication
+        return
+    invalidate_tokens([instance.pk])
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    invalidate_tokens([instance.user_id])
+
+
+# Any write to the menu, from the views or the admin, invalidates the cached menu responses. The search
+# index applies these writes itself (below), so it takes the versions they bump as its own.
+@receiver(post_save, sender=MenuItem)
+@receiver(post_delete, sender=MenuItem)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def menu_saved(sender, **kwargs):
+    menu_changed(bumped=search.index.bumped)
+
+
+# The search index applies menu writes itself, after commit
+@receiver(post_save, sender=MenuItem)
+def menu_item_indexed(sender, instance, **kwargs):
+    search.item_saved(instance)
+
+
+@receiver(post_delete, sender=MenuItem)
+def menu_item_unindexed(sender, instance, **kwargs):
+    search.item_deleted(instance)
+
+
+@receiver(post_save, sender=Category)
+def category_indexed(sender, instance, **kwargs):
+    search.category_saved(instance)
+
+
+@receiver(post_delete, sender=Category)
+def category_unindexed(sender, instance, **kwargs):
+    search.category_deleted(instance)
+
+
+# Sales rollups (rollups.py): the changes are enqueued with the order's transaction. New orders are added by
+# checkout itself, once their items exist.
+ROLLUP_FIELDS = {'date', 'status', 'total'}
+
+
+@receiver(pre_save, sender=Order)
+def order_saving(sender, instance, update_fields=None, raw=False, **kwargs):
+    # Remembers the stored state of an order whose status, date or total may change
+    if raw or instance._state.adding or (update_fields is not None and not ROLLUP_FIELDS & set(update_fields)):
+        return
+    stored = Order.objects.filter(pk=instance.pk).values_list('pk', 'date', 'status', 'total').first()
+    instance._rollup_state = stored
+
+
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, created, **kwargs):
+    stored = instance.__dict__.pop('_rollup_state', None)
+    if stored is not None and stored != order_state(instance):
+        change(removed=[stored], added=[order_state(instance)])
+
+
+@receiver(pre_delete, sender=Order)
+def order_deleting(sender, instance, **kwargs):
+    # Before the cascade deletes the order's items, which change() reads
+    change(removed=[order_state(instance)])
+
+
+# Every database connection reports its queries to the request metrics
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+# override_settings (tests) of the rate limits starts from empty buckets in the newly selected store
+@receiver(setting_changed)
+def throttle_setting_changed(sender, setting, **kwargs):
+    if setting.startswith('THROTTLE_'):
+        reset_store()
+
+
+# Likewise for the order event broker
+@receiver(setting_changed)
+def order_events_setting_changed(sender, setting, **kwargs):
+    if setting.startswith('ORDER_EVENTS_'):
+        reset_broker()
+
+
+# And for the cart store
+@receiver(setting_changed)
+def cart_store_setting_changed(sender, setting, **kwargs):
+    if setting.startswith('CART_'):
+        reset_cart_store()
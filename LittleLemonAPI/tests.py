@@ -1,3 +1,2130 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import os
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from importlib import import_module
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User, Group
+from django.core import mail
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.utils import load_backend
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from . import archive, async_views, authentication, cart_store, catalog, compression, events, jobs, metrics, \
+    renderers, replicas, roles, rollups, search, throttling
+from .cart import user_cart
+from .catalog import import_menu_items
+from .menu_cache import bump_menu_version, menu_changed
+from .fast_serializers import fast_serializer
+from .models import ArchivedOrder, ArchivedOrderItem, ArchiveRun, Cart, Category, DailySales, ItemSales, Job, \
+    MenuItem, Order, OrderEvent, OrderItem
+from .orders import checkout
+from .pagination import MenuItemPagination
+from .serializers import CartSerializer, MenuItemSerializer, OrderSerializer
+from .streaming import stream_json_list, streaming_list_response
+from .views import orders_with_items
 
 # Create your tests here.
+
+
+class MenuItemListTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.mains = Category.objects.create(slug='mains', title='Mains')
+        self.desserts = Category.objects.create(slug='desserts', title='Desserts')
+
+    def create_items(self, count, category=None, featured=False):
+        return [
+            MenuItem.objects.create(title=f'Item {i:03}', price=Decimal(10 + i % 5), featured=featured,
+                                    category=category or self.mains)
+            for i in range(count)
+        ]
+
+    def walk(self, url):
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        return seen
+
+    def test_empty_menu_returns_empty_page(self):
+        response = self.client.get('/api/menu-items/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'next': None, 'previous': None, 'results': []})
+
+    def test_pages_cover_every_item_once(self):
+        items = self.create_items(25)
+        self.assertEqual(self.walk('/api/menu-items/?page_size=10'), [item.id for item in items])
+
+    def test_ordering_by_price_is_stable_across_pages(self):
+        items = self.create_items(23)
+        expected = [item.id for item in sorted(items, key=lambda item: (-item.price, -item.id))]
+        self.assertEqual(self.walk('/api/menu-items/?ordering=-price&page_size=4'), expected)
+
+    def test_previous_link_returns_the_previous_page(self):
+        self.create_items(12)
+        first = self.client.get('/api/menu-items/?ordering=title&page_size=5').data
+        second = self.client.get(first['next']).data
+        back = self.client.get(second['previous']).data
+        self.assertEqual(back['results'], first['results'])
+        self.assertIsNone(back['previous'])
+
+    def test_page_query_count_does_not_grow_with_table(self):
+        self.create_items(60)
+        with self.assertNumQueries(1):
+            self.client.get('/api/menu-items/?page_size=10&ordering=price')
+
+    def test_filters(self):
+        self.create_items(5)
+        cake = MenuItem.objects.create(title='Cake', price=Decimal('4.50'), featured=True, category=self.desserts)
+        for query in ('category=Desserts', f'category={self.desserts.id}', 'featured=true', 'max_price=5'):
+            response = self.client.get(f'/api/menu-items/?{query}')
+            self.assertEqual([item['id'] for item in response.data['results']], [cake.id], query)
+        response = self.client.get('/api/menu-items/?min_price=12&max_price=13')
+        self.assertTrue(all(Decimal(item['price']) in (12, 13) for item in response.data['results']))
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get('/api/menu-items/?min_price=cheap').status_code, 400)
+        self.assertEqual(self.client.get('/api/menu-items/?featured=maybe').status_code, 400)
+        self.assertEqual(self.client.get('/api/menu-items/?cursor=garbage').status_code, 404)
+
+
+class OrderListQueryBudgetTests(TestCase):
+    # The number of queries for an order listing must not depend on how many orders there are
+    max_queries = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.manager = User.objects.create_user('manager')
+        cls.crew = User.objects.create_user('crew')
+        cls.customer = User.objects.create_user('customer')
+        Group.objects.create(name='Manager').user_set.add(cls.manager)
+        Group.objects.create(name='Delivery Crew').user_set.add(cls.crew)
+        Group.objects.create(name='Customer').user_set.add(cls.customer)
+        category = Category.objects.create(slug='mains', title='Mains')
+        cls.menu_items = MenuItem.objects.bulk_create(
+            MenuItem(title=f'Item {i}', price=Decimal('5.00'), featured=False, category=category) for i in range(3)
+        )
+
+    def create_orders(self, count):
+        orders = Order.objects.bulk_create(
+            Order(user=self.customer, delivery_crew=self.crew, total=Decimal('10.00'), date=datetime.date(2024, 1, 1))
+            for _ in range(count)
+        )
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, menuitem=menu_item, quantity=1, unit_price=Decimal('5.00'), price=Decimal('5.00'))
+            for order in orders for menu_item in self.menu_items[:2]
+        )
+
+    def count_queries(self, user):
+        # Start every measurement cold so the role lookup is counted each time
+        roles.invalidate_roles()
+        client = APIClient()
+        client.force_authenticate(User.objects.get(pk=user.pk))
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/orders/')
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data
+
+    def assert_constant_queries(self, user):
+        budgets = []
+        created = 0
+        for count in (10, 1000, 10000):
+            self.create_orders(count - created)
+            created = count
+            queries, data = self.count_queries(user)
+            self.assertEqual(len(data), count)
+            self.assertEqual(len(data[0]['order_item']), 2)
+            budgets.append(queries)
+        self.assertEqual(len(set(budgets)), 1, budgets)
+        self.assertLessEqual(budgets[0], self.max_queries)
+
+    def test_manager_listing(self):
+        self.assert_constant_queries(self.manager)
+
+    def test_delivery_crew_listing(self):
+        self.assert_constant_queries(self.crew)
+
+    def test_customer_listing(self):
+        self.assert_constant_queries(self.customer)
+
+
+class RoleCacheTests(TestCase):
+    def setUp(self):
+        roles.invalidate_roles()
+        self.manager = User.objects.create_user('manager')
+        self.customer = User.objects.create_user('customer')
+        self.manager_group = Group.objects.create(name='Manager')
+        self.manager_group.user_set.add(self.manager)
+
+    def request(self, user, method, url, data=None):
+        # A fresh user instance per request, like the authentication backends produce
+        client = APIClient()
+        client.force_authenticate(User.objects.get(pk=user.pk))
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(client, method)(url, data)
+        group_queries = [q for q in queries.captured_queries
+                         if 'auth_user_groups' in q['sql'] and q['sql'].startswith('SELECT "auth_group"."name"')]
+        return response, len(group_queries)
+
+    def test_roles_are_loaded_once_and_then_cached(self):
+        response, group_queries = self.request(self.manager, 'get', '/api/orders/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(group_queries, 1)
+        response, group_queries = self.request(self.manager, 'get', '/api/groups/manager/users')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(group_queries, 0)
+
+    def test_group_endpoints_invalidate_the_cache(self):
+        self.assertEqual(self.request(self.customer, 'get', '/api/groups/manager/users')[0].status_code, 403)
+        response, _ = self.request(self.manager, 'post', '/api/groups/manager/users', {'username': 'customer'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.request(self.customer, 'get', '/api/groups/manager/users')[0].status_code, 200)
+        response, _ = self.request(self.manager, 'delete', f'/api/groups/manager/users/{self.customer.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.request(self.customer, 'get', '/api/groups/manager/users')[0].status_code, 403)
+
+    def test_admin_style_membership_changes_invalidate_the_cache(self):
+        self.assertFalse(roles.has_role(User.objects.get(pk=self.customer.pk), roles.MANAGER))
+        self.customer.groups.set([self.manager_group])
+        self.assertTrue(roles.has_role(User.objects.get(pk=self.customer.pk), roles.MANAGER))
+        self.manager_group.user_set.clear()
+        self.assertFalse(roles.has_role(User.objects.get(pk=self.manager.pk), roles.MANAGER))
+
+    @override_settings(ROLE_CACHE_TTL=0)
+    def test_entries_expire(self):
+        self.assertEqual(self.request(self.manager, 'get', '/api/groups/manager/users')[1], 1)
+        self.assertEqual(self.request(self.manager, 'get', '/api/groups/manager/users')[1], 1)
+
+    @override_settings(TOKEN_CACHE_ALIAS='default')
+    def test_changes_in_another_process_invalidate_the_cache(self):
+        caches['default'].clear()
+        self.assertEqual(self.request(self.manager, 'get', '/api/groups/manager/users')[1], 1)
+        self.assertEqual(self.request(self.manager, 'get', '/api/groups/manager/users')[1], 0)
+        # Another process removed the manager: only the version in the shared tier changes here
+        version_key = roles.shared_version_keys(self.manager.pk)[1]
+        caches['default'].set(version_key, 0, None)
+        self.manager_group.user_set.through.objects.filter(user=self.manager).delete()
+        response, group_queries = self.request(self.manager, 'get', '/api/groups/manager/users')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(group_queries, 1)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific')
+class QueryPlanTests(TestCase):
+    # Every hot lookup must be answered from an index; a SCAN of the table means an index is missing
+    # or no longer matches the query
+    def setUp(self):
+        self.user = User.objects.create_user('customer')
+        self.crew = User.objects.create_user('crew')
+
+    def assertSearches(self, queryset, model, index=None):
+        plan = queryset.explain()
+        table = model._meta.db_table
+        self.assertNotIn(f'SCAN {table}', plan)
+        self.assertIn(f'SEARCH {table}', plan)
+        if index:
+            self.assertIn(f'INDEX {index} ', plan)
+
+    def test_menu_item_and_category_by_title(self):
+        self.assertSearches(MenuItem.objects.filter(title='Pasta'), MenuItem)
+        self.assertSearches(MenuItem.objects.filter(title__in=['Pasta', 'Soup']), MenuItem)
+        self.assertSearches(Category.objects.filter(title='Mains'), Category)
+
+    def test_orders_by_user_and_delivery_crew(self):
+        date = datetime.date(2024, 1, 1)
+        for field, user, index in (('user', self.user, 'order_user_status_date'),
+                                   ('delivery_crew', self.crew, 'order_crew_status_date')):
+            self.assertSearches(orders_with_items(Order.objects.filter(**{field: user})), Order, index)
+            self.assertSearches(Order.objects.filter(**{field: user, 'status': True}), Order, index)
+            self.assertSearches(Order.objects.filter(**{field: user, 'status': False, 'date__gte': date}), Order,
+                                index)
+
+    def test_cart_by_user(self):
+        self.assertSearches(user_cart(self.user), Cart)
+        self.assertSearches(Cart.objects.filter(user=self.user).values_list('pk', 'menuitem_id', 'quantity'), Cart)
+
+    def test_order_items_by_order(self):
+        self.assertSearches(OrderItem.objects.filter(order_id=1), OrderItem)
+        self.assertSearches(OrderItem.objects.filter(order_id__in=[1, 2, 3]).select_related('menuitem'), OrderItem)
+
+
+class DuplicateMenuItemTests(TestCase):
+    def test_duplicate_title_is_rejected_by_the_database(self):
+        manager = User.objects.create_user('manager')
+        Group.objects.create(name='Manager').user_set.add(manager)
+        Category.objects.create(slug='mains', title='Mains')
+        client = APIClient()
+        client.force_authenticate(manager)
+        data = {'title': 'Pasta', 'price': '9.50', 'category': 'Mains'}
+        self.assertEqual(client.post('/api/menu-items/', data).status_code, 201)
+        response = client.post('/api/menu-items/', data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'message': 'Duplicate menu-items are not allowed'})
+        self.assertEqual(MenuItem.objects.filter(title='Pasta').count(), 1)
+
+    def test_migration_renames_duplicates_to_free_titles(self):
+        free_title = import_module('LittleLemonAPI.migrations.0002_lookup_indexes').free_title
+        mains = Category.objects.create(slug='mains', title='Mains')
+        MenuItem.objects.create(title='Pasta (7)', price=Decimal('1.00'), featured=False, category=mains)
+        self.assertEqual(free_title(MenuItem, 'Pasta', 7), 'Pasta (7-2)')
+        # Long titles keep their start
+        long_title = 'Pasta ' + 'x' * 249
+        self.assertEqual(free_title(MenuItem, long_title, 12), long_title[:250] + ' (12)')
+
+
+class TokenCacheTests(TestCase):
+    def setUp(self):
+        authentication.invalidate_tokens()
+        roles.invalidate_roles()
+        self.user = User.objects.create_user('customer', password='old-password-123')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def get(self, url='/api/users/users/me/'):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        token_queries = [q for q in queries.captured_queries if 'authtoken_token' in q['sql']]
+        return response, len(token_queries)
+
+    def test_token_is_looked_up_once(self):
+        response, token_queries = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(token_queries, 1)
+        response, token_queries = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['username'], 'customer')
+        self.assertEqual(token_queries, 0)
+
+    def test_bad_tokens_are_rejected_as_before(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token nope')
+        response, _ = self.get()
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['detail'], 'Invalid token.')
+        self.assertEqual(response['WWW-Authenticate'], 'Token')
+
+    def test_logout_revokes_the_token(self):
+        self.get()
+        self.assertEqual(self.client.post('/api/token/logout/').status_code, 204)
+        response, _ = self.get()
+        self.assertEqual(response.status_code, 401)
+
+    def test_deactivation_revokes_the_token(self):
+        self.get()
+        self.user.is_active = False
+        self.user.save()
+        response, _ = self.get()
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['detail'], 'User inactive or deleted.')
+
+    def test_password_change_drops_the_cached_user(self):
+        self.get()
+        self.user.set_password('new-password-456')
+        self.user.save()
+        response, token_queries = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(token_queries, 1)
+
+    def test_password_is_not_cached(self):
+        self.get()
+        user, _ = authentication.cached_token(self.token.key)
+        self.assertIn('password', user.get_deferred_fields())
+        self.assertTrue(user.check_password('old-password-123'))
+
+    def test_cached_roles_follow_group_changes(self):
+        self.assertEqual(self.get('/api/groups/manager/users')[0].status_code, 403)
+        Group.objects.create(name='Manager').user_set.add(self.user)
+        self.assertEqual(self.get('/api/groups/manager/users')[0].status_code, 200)
+
+    @override_settings(TOKEN_CACHE_ALIAS='default')
+    def test_shared_tier(self):
+        caches['default'].clear()
+        self.get()
+        # Another process: nothing cached locally, so the entry comes from the shared tier
+        authentication._entries.clear()
+        response, token_queries = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(token_queries, 0)
+        # A revocation in another process bumps the user's generation in the shared tier
+        generation_key = authentication.shared_generation_keys(self.user.pk)[1]
+        caches['default'].set(generation_key, 0, None)
+        self.assertIsNone(authentication.cached_token(self.token.key))
+
+
+class MenuCacheTests(TestCase):
+    def setUp(self):
+        caches['menu'].clear()
+        roles.invalidate_roles()
+        self.manager = User.objects.create_user('manager')
+        Group.objects.create(name='Manager').user_set.add(self.manager)
+        self.category = Category.objects.create(slug='mains', title='Mains')
+        self.item = MenuItem.objects.create(title='Soup', price=Decimal('4.00'), featured=False, category=self.category)
+        self.client = APIClient()
+
+    def test_repeated_gets_are_served_from_the_cache(self):
+        first = self.client.get('/api/menu-items/')
+        self.assertIn('ETag', first)
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/menu-items/')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_if_none_match_returns_304(self):
+        etag = self.client.get('/api/menu-items/?ordering=price')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/menu-items/?ordering=price', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get('/api/menu-items/', HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_writes_invalidate_the_listing(self):
+        etag = self.client.get('/api/menu-items/')['ETag']
+        self.client.force_authenticate(self.manager)
+        response = self.client.post('/api/menu-items/', {'title': 'Salad', 'price': '3.00', 'category': 'Mains'})
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get('/api/menu-items/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['title'] for item in response.data['results']], ['Soup', 'Salad'])
+
+    def test_writes_invalidate_a_single_item(self):
+        self.client.force_authenticate(self.manager)
+        etag = self.client.get('/api/menu-items/Soup/')['ETag']
+        self.assertEqual(self.client.patch('/api/menu-items/Soup/', {'price': '5.00'}).status_code, 200)
+        response = self.client.get('/api/menu-items/Soup/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['price'], '5.00')
+
+    def test_file_backend(self):
+        with tempfile.TemporaryDirectory() as location:
+            backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+            with override_settings(CACHES={'default': backend, 'menu': backend}):
+                etag = self.client.get('/api/menu-items/')['ETag']
+                self.assertEqual(self.client.get('/api/menu-items/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+                self.item.delete()
+                self.assertEqual(self.client.get('/api/menu-items/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+def fill_cart(user, count):
+    category, _ = Category.objects.get_or_create(slug='mains', title='Mains')
+    start = MenuItem.objects.count()
+    menu_items = MenuItem.objects.bulk_create(
+        MenuItem(title=f'{user.username} item {i}', price=Decimal('2.50'), featured=False, category=category)
+        for i in range(start, start + count)
+    )
+    Cart.objects.bulk_create(
+        Cart(user=user, menuitem=menu_item, quantity=2, unit_price=Decimal('2.50'), price=Decimal('5.00'))
+        for menu_item in menu_items
+    )
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        self.customer = User.objects.create_user('customer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def test_checkout_moves_the_cart_into_an_order(self):
+        fill_cart(self.customer, 3)
+        response = self.client.post('/api/orders/')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['total'], '15.00')
+        self.assertEqual(len(response.data['order_item']), 3)
+        self.assertFalse(Cart.objects.filter(user=self.customer).exists())
+        order = Order.objects.get(user=self.customer)
+        self.assertEqual(order.orderitem_set.count(), 3)
+        self.assertEqual(order.status, False)
+
+    def test_empty_cart(self):
+        self.assertEqual(self.client.post('/api/orders/').status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        counts = []
+        for size in (1, 10, 150):
+            fill_cart(User.objects.create_user(f'customer{size}'), size)
+            user = User.objects.get(username=f'customer{size}')
+            with CaptureQueriesContext(connection) as queries:
+                self.assertIsNotNone(checkout(user))
+            counts.append(len(queries))
+        self.assertEqual(len(set(counts)), 1, counts)
+
+
+class SalesRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.manager = User.objects.create_user('manager')
+        cls.crew = User.objects.create_user('crew')
+        cls.customer = User.objects.create_user('customer')
+        Group.objects.create(name='Manager').user_set.add(cls.manager)
+        Group.objects.create(name='Delivery Crew').user_set.add(cls.crew)
+
+    def setUp(self):
+        roles.invalidate_roles()
+        self.client = APIClient()
+        self.client.force_authenticate(self.manager)
+
+    def place_order(self, items=3):
+        fill_cart(self.customer, items)
+        order = checkout(self.customer)
+        rollups.apply_pending()
+        return order
+
+    def report(self, **params):
+        # What the job worker would have done by now
+        rollups.apply_pending()
+        response = self.client.get('/api/reports/sales/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_rollups_follow_checkout_delivery_and_deletion(self):
+        first, second = self.place_order(3), self.place_order(2)
+        today = first.date
+        self.assertEqual(rollups.verify(), [])
+        self.assertEqual(self.report(group_by='day')['results'],
+                         [{'date': today, 'orders': 2, 'revenue': Decimal('25.00')}])
+
+        self.client.patch(f'/api/orders/{first.pk}/', {'status': 1, 'delivery_crew': self.crew.pk}, format='json')
+        self.assertEqual(rollups.verify(), [])
+        self.assertEqual(self.report(status='delivered')['totals'], {'orders': 1, 'revenue': Decimal('15.00')})
+        self.client.post('/api/orders/dispatch/', {'assignments': [
+            {'order': second.pk, 'delivery_crew': self.crew.pk, 'status': True}]}, format='json')
+        self.assertEqual(rollups.verify(), [])
+        self.assertEqual(self.report(status='open')['results'], [])
+
+        self.client.delete(f'/api/orders/{first.pk}/')
+        self.assertEqual(rollups.verify(), [])
+        items = self.report(group_by='menuitem')['results']
+        self.assertEqual([(item['title'], item['quantity'], item['revenue']) for item in items],
+                         [('customer item 3', 2, Decimal('5.00')), ('customer item 4', 2, Decimal('5.00'))])
+        self.assertEqual(self.report(group_by='category')['results'],
+                         [{'category': Category.objects.get().pk, 'title': 'Mains', 'quantity': 4,
+                           'revenue': Decimal('10.00')}])
+
+    def test_report_cost_does_not_depend_on_the_number_of_orders(self):
+        self.place_order()
+        counts = []
+        for count in (10, 1000):
+            orders = Order.objects.bulk_create(
+                Order(user=self.customer, total=Decimal('5.00'), date=datetime.date(2024, 1, 1 + i % 28))
+                for i in range(count)
+            )
+            OrderItem.objects.bulk_create(
+                OrderItem(order=order, menuitem=MenuItem.objects.first(), quantity=1, unit_price=Decimal('5.00'),
+                          price=Decimal('5.00')) for order in orders
+            )
+            # Bulk inserts skip the incremental updates, which verify notices and rebuild fixes
+            self.assertNotEqual(rollups.verify(), [])
+            call_command('sales_rollups', 'rebuild', stdout=io.StringIO())
+            call_command('sales_rollups', 'verify', stdout=io.StringIO())
+            for group_by in ('day', 'menuitem', 'category'):
+                self.client.force_authenticate(User.objects.get(pk=self.manager.pk))
+                roles.invalidate_roles()
+                with CaptureQueriesContext(connection) as queries:
+                    self.report(start='2024-01-01', end='2024-01-31', group_by=group_by)
+                counts.append(len(queries))
+        self.assertEqual(counts[:3], counts[3:])
+        self.assertEqual(self.report(start='2024-01-01', end='2024-01-31')['totals']['orders'], 1010)
+
+    def test_checkout_leaves_the_rollups_to_the_worker(self):
+        fill_cart(self.customer, 3)
+        with CaptureQueriesContext(connection) as queries:
+            order = checkout(self.customer)
+        tables = (DailySales._meta.db_table, ItemSales._meta.db_table)
+        self.assertFalse([query for query in queries.captured_queries if any(t in query['sql'] for t in tables)])
+        self.assertFalse(DailySales.objects.exists())
+        self.assertEqual(jobs.queue_stats()[rollups.JOB]['due'], 1)
+        jobs.run_workers(names=[rollups.JOB], burst=True)
+        self.assertFalse(Job.objects.filter(name=rollups.JOB).exists())
+        self.assertEqual(self.report()['totals'], {'orders': 1, 'revenue': order.total})
+
+    def test_a_batch_whose_lease_ran_out_is_not_applied_twice(self):
+        fill_cart(self.customer, 3)
+        checkout(self.customer)
+        worker = jobs.Worker([rollups.JOB])
+        name, token, claimed = worker.claim()
+        # The lease ran out and another worker applied the changes meanwhile
+        rollups.apply_pending()
+        with self.assertLogs('LittleLemonAPI.jobs', 'ERROR'):
+            self.assertFalse(worker.run_batch(name, token, claimed))
+        self.assertEqual(rollups.verify(), [])
+
+    def test_verify_reports_drift(self):
+        self.place_order()
+        DailySales.objects.update(orders=5)
+        with self.assertRaises(CommandError):
+            call_command('sales_rollups', 'verify', stdout=io.StringIO())
+
+    def test_parameters_and_permissions(self):
+        for params in ({'group_by': 'week'}, {'status': 'late'}, {'start': 'yesterday'},
+                       {'start': '2024-02-01', 'end': '2024-01-01'}):
+            self.assertEqual(self.client.get('/api/reports/sales/', params).status_code, 400, params)
+        self.client.force_authenticate(self.customer)
+        self.assertEqual(self.client.get('/api/reports/sales/').status_code, 403)
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    def test_parallel_checkouts_create_one_order_with_every_item(self):
+        customer = User.objects.create_user('customer')
+        fill_cart(customer, 20)
+        start = threading.Barrier(8)
+        results = []
+
+        def submit():
+            try:
+                start.wait()
+                try:
+                    results.append(checkout(User.objects.get(pk=customer.pk)))
+                except OperationalError as e:
+                    # A checkout that could not get the database lock in time fails as a whole
+                    results.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=submit) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every other submit either found the cart already empty or was rolled back
+        self.assertEqual(len(results), 8)
+        orders = [result for result in results if isinstance(result, Order)]
+        self.assertEqual(len(orders), 1, results)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(OrderItem.objects.filter(order=orders[0]).count(), 20)
+        self.assertEqual(orders[0].total, Decimal('100.00'))
+        self.assertFalse(Cart.objects.exists())
+
+
+class CartTests(TestCase):
+    def setUp(self):
+        self.customer = User.objects.create_user('customer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+        category = Category.objects.create(slug='mains', title='Mains')
+        for title, price in (('Soup', '4.00'), ('Salad', '3.50'), ('Bread', '1.25')):
+            MenuItem.objects.create(title=title, price=Decimal(price), featured=False, category=category)
+
+    def test_single_item_keeps_the_original_response(self):
+        response = self.client.post('/api/cart/menu-items/', {'menuitem': 'Soup', 'quantity': 2})
+        self.assertEqual(response.status_code, 201)
+        item = response.data['Cart item created']
+        self.assertEqual((item['menuitem']['title'], item['quantity'], item['price']), ('Soup', 2, '8.00'))
+
+    def test_adding_an_item_twice_increments_it(self):
+        self.client.post('/api/cart/menu-items/', {'menuitem': 'Soup', 'quantity': 2})
+        response = self.client.post('/api/cart/menu-items/', {'menuitem': 'Soup', 'quantity': 1})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['Cart item created']['quantity'], 3)
+        self.assertEqual(response.data['Cart item created']['price'], '12.00')
+
+    def test_batch_returns_the_updated_cart(self):
+        self.client.post('/api/cart/menu-items/', {'menuitem': 'Soup', 'quantity': 1})
+        entries = [{'menuitem': 'Soup', 'quantity': 1}, {'menuitem': 'Salad', 'quantity': 2},
+                   {'menuitem': 'Bread', 'quantity': 4}, {'menuitem': 'Bread', 'quantity': 1}]
+        # Resolving the titles, the savepoint, the INSERT, locking the cart to check its limits, the UPDATE,
+        # releasing the savepoint and reading the cart back
+        with self.assertNumQueries(7):
+            response = self.client.post('/api/cart/menu-items/', entries, format='json')
+        self.assertEqual(response.status_code, 201)
+        cart = {item['menuitem']['title']: (item['quantity'], item['price']) for item in response.data}
+        self.assertEqual(cart, {'Soup': (2, '8.00'), 'Salad': (2, '7.00'), 'Bread': (5, '6.25')})
+
+    def test_unknown_titles_write_nothing(self):
+        entries = [{'menuitem': 'Soup', 'quantity': 1}, {'menuitem': 'Pizza', 'quantity': 1}]
+        response = self.client.post('/api/cart/menu-items/', entries, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['menuitem'], ['Pizza'])
+        self.assertFalse(Cart.objects.exists())
+
+    def test_invalid_quantity(self):
+        response = self.client.post('/api/cart/menu-items/', [{'menuitem': 'Soup', 'quantity': 0}], format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_quantities_and_prices_fit_the_columns(self):
+        # A smallint quantity and numeric(6, 2) prices: beyond them PostgreSQL fails the write
+        entries = [{'menuitem': 'Bread', 'quantity': 20000}, {'menuitem': 'Bread', 'quantity': 20000}]
+        self.assertEqual(self.client.post('/api/cart/menu-items/', entries, format='json').status_code, 400)
+        for store in ('database', 'local'):
+            with self.subTest(store=store), self.settings(CART_STORE=store, CART_FLUSH_INTERVAL=0):
+                self.client.post('/api/cart/menu-items/', {'menuitem': 'Soup', 'quantity': 2000})
+                # 2500 soups would cost 10000.00, as would 2000 soups and 572 salads
+                for entry in ({'menuitem': 'Soup', 'quantity': 500}, {'menuitem': 'Salad', 'quantity': 572}):
+                    response = self.client.post('/api/cart/menu-items/', entry)
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(response.data['message'].code, 'cart_limit')
+                self.assertEqual(self.client.post('/api/cart/menu-items/', {'menuitem': 'Salad', 'quantity': 571})
+                                 .status_code, 201)
+                cart = self.client.get('/api/cart/menu-items/').data
+                self.assertEqual([(item['quantity'], item['price']) for item in cart],
+                                 [(2000, '8000.00'), (571, '1998.50')])
+                self.client.delete('/api/cart/menu-items/')
+        # Past the limit anyway (concurrent additions), the cart isn't ordered
+        for title, quantity in (('Soup', 2000), ('Salad', 1000)):
+            menu_item = MenuItem.objects.get(title=title)
+            Cart.objects.create(user=self.customer, menuitem=menu_item, quantity=quantity, unit_price=menu_item.price,
+                                price=menu_item.price * quantity)
+        self.assertEqual(self.client.post('/api/orders/').status_code, 400)
+        self.assertEqual((Cart.objects.count(), Order.objects.count()), (2, 0))
+
+
+class DispatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.manager = User.objects.create_user('manager')
+        cls.customer = User.objects.create_user('customer')
+        cls.crew = [User.objects.create_user(f'crew{i}') for i in range(3)]
+        Group.objects.create(name='Manager').user_set.add(cls.manager)
+        Group.objects.create(name='Delivery Crew').user_set.add(*cls.crew)
+
+    def setUp(self):
+        roles.invalidate_roles()
+        self.client = APIClient()
+        self.client.force_authenticate(self.manager)
+
+    def create_orders(self, count, **fields):
+        return [order.pk for order in Order.objects.bulk_create(
+            Order(user=self.customer, total=Decimal('10.00'), date=datetime.date(2024, 1, 1), **fields)
+            for _ in range(count)
+        )]
+
+    def post(self, data):
+        return self.client.post('/api/orders/dispatch/', data, format='json')
+
+    def test_assignments_apply_in_a_fixed_number_of_queries(self):
+        counts = []
+        for size in (2, 200):
+            pks = self.create_orders(size)
+            assignments = [{'order': pk, 'delivery_crew': self.crew[pk % 3].pk} for pk in pks]
+            # Start cold, so the role lookup is counted both times
+            roles.invalidate_roles()
+            self.client.force_authenticate(User.objects.get(pk=self.manager.pk))
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post({'assignments': assignments})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['applied']), size)
+            counts.append(len(queries))
+            for pk, crew in Order.objects.filter(pk__in=pks).values_list('pk', 'delivery_crew_id'):
+                self.assertEqual(crew, self.crew[pk % 3].pk)
+        self.assertEqual(counts[0], counts[1], counts)
+
+    def test_changed_orders_are_conflicts_and_not_overwritten(self):
+        free, taken, delivered = self.create_orders(3)
+        Order.objects.filter(pk=taken).update(delivery_crew=self.crew[1])
+        Order.objects.filter(pk=delivered).update(delivery_crew=self.crew[1], status=True)
+        response = self.post({'assignments': [
+            {'order': free, 'delivery_crew': self.crew[0].pk},
+            {'order': taken, 'delivery_crew': self.crew[0].pk},
+            # Reassigning needs the current crew, and the status must still be the expected one
+            {'order': delivered, 'delivery_crew': self.crew[0].pk, 'expected_delivery_crew': self.crew[1].pk,
+             'expected_status': False},
+            {'order': 999999, 'delivery_crew': self.crew[0].pk},
+        ]})
+        self.assertEqual(response.data['applied'], [{'order': free, 'delivery_crew': self.crew[0].pk, 'status': False}])
+        self.assertEqual(response.data['conflicts'], [
+            {'order': taken, 'delivery_crew': self.crew[1].pk, 'status': False},
+            {'order': delivered, 'delivery_crew': self.crew[1].pk, 'status': True},
+        ])
+        self.assertEqual(response.data['not_found'], [999999])
+        self.assertEqual(Order.objects.get(pk=taken).delivery_crew, self.crew[1])
+
+        response = self.post({'assignments': [{'order': taken, 'delivery_crew': self.crew[2].pk, 'status': True,
+                                                'expected_delivery_crew': self.crew[1].pk}]})
+        self.assertEqual(len(response.data['applied']), 1)
+        order = Order.objects.get(pk=taken)
+        self.assertEqual((order.delivery_crew, order.status), (self.crew[2], True))
+
+    def test_auto_assign_balances_by_open_orders(self):
+        self.create_orders(4, delivery_crew=self.crew[0])
+        self.create_orders(1, delivery_crew=self.crew[0], status=True)  # delivered, doesn't count
+        self.create_orders(2, delivery_crew=self.crew[1])
+        pks = self.create_orders(6)
+        response = self.post({'auto_assign': True})
+        self.assertEqual(sorted(entry['order'] for entry in response.data['applied']), pks)
+        open_orders = [Order.objects.filter(delivery_crew=crew, status=False).count() for crew in self.crew]
+        self.assertEqual(open_orders, [4, 4, 4])
+        # Nothing is left to assign
+        self.assertEqual(self.post({'auto_assign': True}).data['applied'], [])
+
+    def test_validation_and_permissions(self):
+        pk, = self.create_orders(1)
+        response = self.post({'assignments': [{'order': pk, 'delivery_crew': self.customer.pk}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post({}).status_code, 400)
+        self.client.force_authenticate(self.crew[0])
+        self.assertEqual(self.post({'auto_assign': True}).status_code, 403)
+        self.assertIsNone(Order.objects.get(pk=pk).delivery_crew)
+
+    def test_single_order_update_is_saved(self):
+        pk, = self.create_orders(1)
+        response = self.client.patch(f'/api/orders/{pk}/', {'delivery_crew': self.crew[0].pk}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Order.objects.get(pk=pk).delivery_crew, self.crew[0])
+        # The assigned crew member can only change the status
+        self.client.force_authenticate(self.crew[0])
+        self.client.patch(f'/api/orders/{pk}/', {'status': 1, 'delivery_crew': self.crew[1].pk}, format='json')
+        order = Order.objects.get(pk=pk)
+        self.assertEqual((order.delivery_crew, order.status), (self.crew[0], True))
+        self.client.force_authenticate(self.crew[1])
+        self.assertEqual(self.client.patch(f'/api/orders/{pk}/', {'status': 0}).status_code, 403)
+
+
+class MenuSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer')
+        desserts = Category.objects.create(slug='desserts', title='Desserts')
+        mains = Category.objects.create(slug='mains', title='Mains')
+        cls.items = {title: MenuItem.objects.create(title=title, price=Decimal('5.00'), featured=False, category=category)
+                     for title, category in [('Lemon Dessert', desserts), ('Hummus', mains), ('Hummus Platter', mains),
+                                             ('Grilled Fish', mains), ('Humble Pie', desserts),
+                                             ('Crème Brûlée', desserts), ("Chef's Bruschetta", mains)]}
+
+    def setUp(self):
+        # Other tests change the menu without committing, so start from a fresh index
+        search.index.version = None
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def titles(self, query, url='/api/menu/autocomplete/'):
+        response = self.client.get(url, {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [item['title'] for item in response.data['results']]
+
+    def test_ranking(self):
+        # Exact term, then prefixes (shorter titles first), then typos
+        self.assertEqual(self.titles('hummus'), ['Hummus', 'Hummus Platter'])
+        self.assertEqual(self.titles('hum'), ['Hummus', 'Humble Pie', 'Hummus Platter'])
+        self.assertEqual(self.titles('humm'), ['Hummus', 'Hummus Platter', 'Humble Pie'])
+        # Every term has to match, in the title or (ranked lower) in the category
+        self.assertEqual(self.titles('hummus pla'), ['Hummus Platter'])
+        self.assertEqual(self.titles('dessert'), ['Lemon Dessert', 'Humble Pie', 'Crème Brûlée'])
+        self.assertEqual(self.titles('pie desserts'), ['Humble Pie'])
+
+    def test_typos_accents_and_apostrophes(self):
+        self.assertEqual(self.titles('humus'), ['Hummus', 'Hummus Platter'])
+        self.assertEqual(self.titles('grliled'), ['Grilled Fish'])
+        self.assertEqual(self.titles('bruchetta'), ["Chef's Bruschetta"])
+        self.assertEqual(self.titles('creme brulee'), ['Crème Brûlée'])
+        self.assertEqual(self.titles('chefs'), ["Chef's Bruschetta"])
+        self.assertEqual(self.titles('xyz'), [])
+
+    def test_search_returns_menu_items(self):
+        response = self.client.get('/api/menu/search/', {'q': 'fish', 'limit': 5})
+        self.assertEqual(response.data['results'], [MenuItemSerializer(self.items['Grilled Fish']).data])
+        self.assertEqual(self.client.get('/api/menu/search/').status_code, 400)
+        self.assertEqual(self.client.get('/api/menu/search/', {'q': 'fish', 'limit': 0}).status_code, 400)
+
+    def test_menu_items_titled_like_the_menu_routes(self):
+        # Only managers can fetch a single menu item
+        roles.invalidate_roles()
+        manager = User.objects.create_user('manager')
+        Group.objects.create(name='Manager').user_set.add(manager)
+        self.client.force_authenticate(manager)
+        for title in ('import', 'export', 'search', 'autocomplete'):
+            MenuItem.objects.create(title=title, price=Decimal('1.00'), featured=False,
+                                    category=Category.objects.get(title='Mains'))
+            self.assertEqual(self.client.get(f'/api/menu-items/{title}/').data['title'], title)
+
+    def test_autocomplete_is_answered_from_the_index(self):
+        self.titles('warm up')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.titles('lem'), ['Lemon Dessert'])
+
+    def test_writes_update_the_index_after_commit(self):
+        self.titles('warm up')
+        with self.captureOnCommitCallbacks(execute=True):
+            lemonade = MenuItem.objects.create(title='Lemonade', price=Decimal('3.00'), featured=False,
+                                               category=Category.objects.get(title='Mains'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.titles('lemo'), ['Lemonade', 'Lemon Dessert'])
+        with self.captureOnCommitCallbacks(execute=True):
+            lemonade.title = 'Orange Juice'
+            lemonade.save()
+            self.items['Lemon Dessert'].delete()
+            Category.objects.get(title='Mains').save()
+        self.assertEqual(self.titles('lemo'), [])
+        self.assertEqual(self.titles('orange'), ['Orange Juice'])
+
+    def test_changes_without_signals_rebuild_the_index(self):
+        self.titles('warm up')
+        MenuItem.objects.bulk_create([MenuItem(title='Lemon Tart', price=Decimal('4.00'), featured=False,
+                                               category=Category.objects.get(title='Desserts'))])
+        menu_changed()
+        self.assertEqual(self.titles('lemon'), ['Lemon Tart', 'Lemon Dessert'])
+
+    def test_rolled_back_writes_dont_hide_other_processes_changes(self):
+        self.titles('warm up')
+        # Bumps the menu version once, the bump after commit never comes
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            MenuItem.objects.create(title='Lemonade', price=Decimal('3.00'), featured=False,
+                                    category=Category.objects.get(title='Mains'))
+            MenuItem.objects.create(title='Lemonade', price=Decimal('3.00'), featured=False,
+                                    category=Category.objects.get(title='Mains'))
+        # Another process adds an item and bumps the version once more
+        MenuItem.objects.bulk_create([MenuItem(title='Lemon Tart', price=Decimal('4.00'), featured=False,
+                                               category=Category.objects.get(title='Desserts'))])
+        bump_menu_version()
+        self.assertEqual(self.titles('lemon'), ['Lemon Tart', 'Lemon Dessert'])
+
+    def test_searches_use_the_old_index_during_a_rebuild(self):
+        self.titles('warm up')
+        MenuItem.objects.bulk_create([MenuItem(title='Lemon Tart', price=Decimal('4.00'), featured=False,
+                                               category=Category.objects.get(title='Desserts'))])
+        menu_changed()
+        rebuild = search.SearchIndex.rebuild
+
+        def rebuild_elsewhere(index, version):
+            self.assertIsNot(index, search.index)
+            rebuild(index, version)
+            self.assertEqual([title for _, title, _ in search.index.search('lemon', 10)], ['Lemon Dessert'])
+            # A change committed after the new index read the menu
+            with self.captureOnCommitCallbacks(execute=True):
+                self.items['Lemon Dessert'].delete()
+            self.assertEqual(search.index.search('lemon', 10), [])
+
+        with mock.patch.object(search.SearchIndex, 'rebuild', rebuild_elsewhere):
+            self.assertEqual(self.titles('lemon'), ['Lemon Tart'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.titles('lemon'), ['Lemon Tart'])
+
+    def test_many_short_terms_stay_fast(self):
+        # Every item matches each one-letter term through a different title term, 30 per letter
+        index = search.SearchIndex()
+        index.add_category(1, 'Mains')
+        for pk in range(180):
+            index.add_item(pk, f'{pk:03d} ' + ' '.join(f'{letter}{pk % 30:02d}' for letter in 'abcdef'), 1)
+        started = time.monotonic()
+        results = index.search('a b c d e f', 10)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual([pk for pk, _, _ in results], list(range(10)))
+
+    def test_per_process_index_expires(self):
+        # Another process's write doesn't change this process's locmem menu version
+        self.enterContext(override_settings(MENU_CACHE_ALIAS='default'))
+        self.titles('warm up')
+        MenuItem.objects.bulk_create([MenuItem(title='Lemon Tart', price=Decimal('4.00'), featured=False,
+                                               category=Category.objects.get(title='Desserts'))])
+        with override_settings(SEARCH_INDEX_MAX_AGE=60):
+            self.assertEqual(self.titles('lemon'), ['Lemon Dessert'])
+            search.index.built -= 61
+            self.assertEqual(self.titles('lemon'), ['Lemon Tart', 'Lemon Dessert'])
+        with override_settings(SEARCH_INDEX_MAX_AGE=None):
+            search.index.built -= 3600
+            with self.assertNumQueries(0):
+                self.titles('lemon')
+
+
+class CatalogImportExportTests(TestCase):
+    def setUp(self):
+        roles.invalidate_roles()
+        self.manager = User.objects.create_user('manager')
+        Group.objects.create(name='Manager').user_set.add(self.manager)
+        self.client = APIClient()
+        self.client.force_authenticate(self.manager)
+        Category.objects.create(slug='mains', title='Mains')
+        MenuItem.objects.create(title='Soup', price=Decimal('4.00'), featured=False, category_id=Category.objects.get().pk)
+
+    def post(self, body, content_type):
+        return self.client.generic('POST', '/api/menu/import/', body, content_type=content_type)
+
+    def test_ndjson_import_upserts_by_title(self):
+        body = '\n'.join(json.dumps(row) for row in [
+            {'title': 'Soup', 'price': '4.50', 'featured': True, 'category': 'Mains'},
+            {'title': 'Cake', 'price': '3', 'featured': False, 'category': 'Desserts'},
+            {'title': '', 'price': '1', 'category': 'Mains'},
+        ])
+        response = self.post(body + '\nnot json\n', 'application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created'], response.data['updated']), (1, 1))
+        self.assertEqual([error['line'] for error in response.data['errors']], [3, 4])
+        soup = MenuItem.objects.get(title='Soup')
+        self.assertEqual((soup.price, soup.featured), (Decimal('4.50'), True))
+        self.assertEqual(MenuItem.objects.get(title='Cake').category.title, 'Desserts')
+
+    def test_csv_import_in_chunks(self):
+        lines = ['title,price,featured,category'] + [f'Item {i},{i}.99,false,Mains' for i in range(25)]
+        report = import_menu_items([line + '\n' for line in lines], 'csv', chunk_size=10)
+        self.assertEqual((report['created'], report['updated'], report['error_count']), (25, 0, 0))
+        self.assertEqual(MenuItem.objects.get(title='Item 7').price, Decimal('7.99'))
+
+    def test_titles_created_during_the_import_are_updated(self):
+        lines = ['title,price,featured,category\n', 'Cake,3.00,false,Mains\n', 'Pie,2.00,false,Mains\n']
+        MenuItem.objects.create(title='Cake', price=Decimal('1.00'), featured=False, category=Category.objects.get())
+        # Another request created Cake after the first lookup of the chunk
+        with mock.patch.object(catalog, 'existing_items', side_effect=[{}, catalog.existing_items(['Cake', 'Pie'])]):
+            report = import_menu_items(lines, 'csv')
+        self.assertEqual((report['created'], report['updated'], report['error_count']), (1, 1, 0))
+        self.assertEqual(MenuItem.objects.get(title='Cake').price, Decimal('3.00'))
+
+    def test_chunks_that_keep_conflicting_are_reported(self):
+        lines = ['title,price,featured,category\n', 'Cake,3.00,false,Mains\n', 'Pie,2.00,false,Mains\n']
+        with mock.patch.object(MenuItem.objects, 'bulk_create', side_effect=IntegrityError('UNIQUE constraint')):
+            report = import_menu_items(lines, 'csv', chunk_size=1)
+        self.assertEqual((report['created'], report['error_count']), (0, 2))
+        self.assertEqual([error['line'] for error in report['errors']], [2, 3])
+
+    def test_every_rejected_row_is_counted(self):
+        lines = ['title,price,featured,category'] + [f'Item {i},free,false,Mains' for i in range(150)]
+        report = import_menu_items([line + '\n' for line in lines], 'csv')
+        self.assertEqual(report['error_count'], 150)
+        self.assertEqual(len(report['errors']), 100)
+
+    def test_import_requires_a_manager_and_a_known_format(self):
+        self.assertEqual(self.post('{}', 'application/json').status_code, 415)
+        self.client.force_authenticate(User.objects.create_user('customer'))
+        self.assertEqual(self.post('{}', 'application/x-ndjson').status_code, 403)
+
+    def test_export_round_trips_through_the_command(self):
+        response = self.client.get('/api/menu/export/?type=csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        body = b''.join(response.streaming_content).decode()
+        self.assertEqual(body.splitlines(), ['title,price,featured,category', 'Soup,4.00,false,Mains'])
+
+        output = io.StringIO()
+        call_command('export_menu', stdout=output)
+        self.assertEqual(json.loads(output.getvalue()),
+                         {'title': 'Soup', 'price': '4.00', 'featured': False, 'category': 'Mains'})
+
+    def test_import_invalidates_the_menu_cache(self):
+        etag = self.client.get('/api/menu-items/')['ETag']
+        self.post('{"title": "Cake", "price": "3", "category": "Mains"}', 'application/x-ndjson')
+        self.assertEqual(self.client.get('/api/menu-items/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class SeedDataTests(TestCase):
+    def seed(self, **options):
+        output = io.StringIO()
+        call_command('seed_data', '--json', stdout=output, **options)
+        return json.loads(output.getvalue())
+
+    def test_seeds_every_table_and_tops_up_on_rerun(self):
+        scale = {'managers': 1, 'delivery_crew': 2, 'customers': 5, 'categories': 3, 'menu_items': 40, 'orders': 12,
+                 'cart_items': 2, 'batch_size': 7}
+        seeded = self.seed(**scale)
+        self.assertEqual(seeded['counts'], {'users': 8, 'categories': 3, 'menu_items': 40, 'orders': 12,
+                                            'order_items': 36, 'cart_items': 10})
+        self.assertEqual([len(seeded['tokens'][role]) for role in (roles.MANAGER, roles.DELIVERY_CREW, roles.CUSTOMER)],
+                         [1, 2, 5])
+        self.assertEqual(User.objects.filter(groups__name=roles.DELIVERY_CREW).count(), 2)
+        for order in Order.objects.all():
+            self.assertEqual(order.total, sum(item.price for item in order.orderitem_set.all()))
+
+        seeded = self.seed(**{**scale, 'orders': 20})
+        self.assertEqual(seeded['counts']['menu_items'], 40)
+        self.assertEqual(seeded['counts']['orders'], 20)
+        self.assertEqual(seeded['counts']['cart_items'], 10)
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        roles.invalidate_roles()
+        self.customer = User.objects.create_user('customer')
+        fill_cart(self.customer, 2)
+        checkout(self.customer)
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def server_timing(self, response):
+        return {
+            name: dict(param.split('=', 1) for param in params)
+            for name, *params in (metric.split(';') for metric in response['Server-Timing'].split(', '))
+        }
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/orders/')
+        self.assertEqual(response.status_code, 200)
+        timing = self.server_timing(response)
+        self.assertEqual(timing['db']['desc'], f'"{len(queries)} queries"')
+        self.assertGreater(float(timing['serialize']['dur']), 0)
+        self.assertGreater(float(timing['render']['dur']), 0)
+        self.assertGreaterEqual(float(timing['total']['dur']), float(timing['db']['dur']))
+
+    @override_settings(METRICS_TOKEN='scraper-token')
+    def test_metrics_endpoint_has_per_route_histograms(self):
+        self.client.get('/api/orders/')
+        self.client.get('/api/orders/')
+        self.client.get(f'/api/orders/{Order.objects.get().pk}/')
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scraper-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('littlelemon_request_duration_seconds_count{route="/api/orders/",method="GET"} 2', text)
+        self.assertIn('littlelemon_request_queries_count{route="/api/orders/<int:orderId>/",method="GET"} 1', text)
+        self.assertIn('littlelemon_request_duration_seconds_bucket{route="/api/orders/",method="GET",le="+Inf"} 2',
+                      text)
+        self.assertIn('littlelemon_responses_total{route="/api/orders/",method="GET",status="200"} 2', text)
+        # The scrape itself isn't recorded
+        self.assertNotIn('route="/metrics"', text)
+
+    def test_metrics_endpoint_needs_the_token(self):
+        # Not served at all until a token is set
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with override_settings(METRICS_TOKEN='scraper-token'):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual((response.status_code, response['WWW-Authenticate']), (401, 'Bearer'))
+
+    @override_settings(SLOW_REQUEST_MS=0)
+    def test_slow_request_log_has_the_sql(self):
+        with self.assertLogs('LittleLemonAPI.slow_requests', 'WARNING') as logs:
+            self.client.get('/api/orders/')
+        self.assertIn('Slow request: GET /api/orders/ -> 200', logs.output[0])
+        self.assertIn('FROM "LittleLemonAPI_order"', logs.output[0])
+
+    @override_settings(METRICS_ENABLED=False, METRICS_TOKEN='scraper-token')
+    def test_can_be_turned_off(self):
+        response = self.client.get('/api/orders/')
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scraper-token').status_code, 404)
+
+
+class FastSerializerTests(TestCase):
+    # The fast path must render exactly the bytes the serializers render
+    def setUp(self):
+        self.customer = User.objects.create_user('customer')
+        self.crew = User.objects.create_user('crew')
+        fill_cart(self.customer, 3)
+        checkout(self.customer)
+        fill_cart(self.customer, 2)
+        checkout(self.customer)
+        Order.objects.filter(pk=Order.objects.first().pk).update(delivery_crew=self.crew, status=True)
+        # An order without items and a cart that stays filled
+        Order.objects.create(user=self.customer, total=Decimal('0.00'), date=datetime.date(2024, 2, 29))
+        fill_cart(self.customer, 2)
+        MenuItem.objects.filter(pk=MenuItem.objects.first().pk).update(price=Decimal('1234.50'), featured=True)
+
+    def assertSameJSON(self, queryset, serializer_class):
+        renderer = JSONRenderer()
+        expected = renderer.render(serializer_class(queryset, many=True).data)
+        self.assertEqual(renderer.render(fast_serializer(serializer_class).serialize(queryset)), expected)
+        self.assertEqual(renderer.render(async_to_sync(fast_serializer(serializer_class).aserialize)(queryset)),
+                         expected)
+
+    def test_menu_items(self):
+        self.assertSameJSON(MenuItem.objects.order_by('pk'), MenuItemSerializer)
+
+    def test_cart(self):
+        self.assertSameJSON(user_cart(self.customer), CartSerializer)
+
+    def test_orders(self):
+        self.assertSameJSON(orders_with_items(Order.objects.order_by('pk')), OrderSerializer)
+
+    def test_empty_list(self):
+        self.assertSameJSON(Order.objects.none(), OrderSerializer)
+
+    def test_paginated_menu_matches(self):
+        caches['menu'].clear()
+        for ordering in ('price', '-title'):
+            query = {'ordering': ordering, 'page_size': 2}
+            response = self.client.get('/api/menu-items/', query)
+            paginator = MenuItemPagination()
+            page = paginator.paginate_queryset(MenuItem.objects.all(), Request(APIRequestFactory().get(
+                '/api/menu-items/', query)))
+            expected = paginator.get_paginated_response(MenuItemSerializer(page, many=True).data).data
+            self.assertEqual(response.json(), json.loads(json.dumps(expected)))
+            self.assertIsNotNone(response.json()['next'])
+
+
+class StreamingListTests(TestCase):
+    def setUp(self):
+        roles.invalidate_roles()
+        self.manager = User.objects.create_user('manager')
+        Group.objects.create(name='Manager').user_set.add(self.manager)
+        self.customer = User.objects.create_user('customer')
+        fill_cart(self.customer, 3)
+        for _ in range(3):
+            checkout(self.customer)
+            fill_cart(self.customer, 1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.manager)
+
+    def stream(self, url):
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertTrue(response.streaming)
+        return json.loads(b''.join(response.streaming_content))
+
+    def test_streamed_orders_match_the_regular_response(self):
+        regular = self.client.get('/api/orders/', HTTP_ACCEPT='application/json')
+        self.assertEqual(self.stream('/api/orders/?stream=true'), json.loads(regular.content))
+
+    def test_streams_in_chunks(self):
+        chunks = list(stream_json_list(Order.objects.order_by('pk'), OrderSerializer, chunk_size=2))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(len(json.loads(b''.join(chunks))), 3)
+        self.assertEqual(b''.join(stream_json_list(Order.objects.none(), OrderSerializer)), b'[]')
+
+    def test_streamed_menu_items_are_filtered_and_ordered(self):
+        items = self.stream('/api/menu-items/?stream=true&ordering=-title&category=Mains')
+        titles = sorted(MenuItem.objects.values_list('title', flat=True), reverse=True)
+        self.assertEqual([item['title'] for item in items], titles)
+
+    def test_streams_asynchronously_under_asgi(self):
+        # Django would buffer a sync iterator under ASGI
+        request = Request(AsyncRequestFactory().get('/api/orders/?stream=true'))
+        request.accepted_renderer = JSONRenderer()
+        response = streaming_list_response(request, Order.objects.order_by('pk'), OrderSerializer, chunk_size=2)
+        self.assertTrue(response.is_async)
+
+        async def read():
+            return [chunk async for chunk in response.streaming_content]
+
+        chunks = async_to_sync(read)()
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(len(json.loads(b''.join(chunks))), 3)
+
+    def test_browsable_api_is_not_streamed(self):
+        response = self.client.get('/api/orders/?stream=true', HTTP_ACCEPT='text/html')
+        self.assertFalse(response.streaming)
+
+
+class AsyncReadViewTests(TestCase):
+    # The async views must answer exactly like the sync views they stand in for
+    def setUp(self):
+        caches['menu'].clear()
+        roles.invalidate_roles()
+        self.manager = User.objects.create_user('manager', email='manager@example.com')
+        Group.objects.create(name='Manager').user_set.add(self.manager)
+        self.customer = User.objects.create_user('customer', email='customer@example.com')
+        self.tokens = {user: Token.objects.create(user=user).key for user in (self.manager, self.customer)}
+        fill_cart(self.customer, 2)
+        checkout(self.customer)
+        fill_cart(self.customer, 1)
+
+    def compare(self, view, path, user=None, status_code=200, **kwargs):
+        headers = {'Accept': 'application/json'}
+        if user:
+            headers['Authorization'] = f'Token {self.tokens[user]}'
+        response = async_to_sync(view)(AsyncRequestFactory().get(path, headers=headers), **kwargs)
+        expected = self.client.get(path, headers=headers)
+        self.assertEqual(response.status_code, status_code)
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(json.loads(response.content), json.loads(expected.content))
+        return response
+
+    def test_menu_items(self):
+        self.compare(async_views.get_post_menu_items, '/api/menu-items/?ordering=-price&page_size=2')
+        self.compare(async_views.get_post_menu_items, '/api/menu-items/?min_price=x', status_code=400)
+
+    def test_single_menu_item(self):
+        title = MenuItem.objects.first().title
+        response = self.compare(async_views.edit_single_menu_item, f'/api/menu-items/{title}/', self.manager,
+                                menu_item=title)
+        self.assertIn('ETag', response)
+        self.compare(async_views.edit_single_menu_item, '/api/menu-items/nothing/', self.manager, status_code=404,
+                     menu_item='nothing')
+        self.compare(async_views.edit_single_menu_item, f'/api/menu-items/{title}/', self.customer, status_code=403,
+                     menu_item=title)
+        response = self.compare(async_views.edit_single_menu_item, f'/api/menu-items/{title}/', status_code=401,
+                                menu_item=title)
+        self.assertEqual(response['WWW-Authenticate'], 'Token')
+
+    def test_cart_orders_and_user(self):
+        for user in (self.manager, self.customer):
+            self.compare(async_views.edit_cart, '/api/cart/menu-items/', user)
+            self.compare(async_views.manage_orders, '/api/orders/', user)
+            self.compare(async_views.return_user, '/api/users/users/me/', user)
+
+    def test_bad_token(self):
+        request = AsyncRequestFactory().get('/api/orders/', headers={'Authorization': 'Token nope'})
+        response = async_to_sync(async_views.manage_orders)(request)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(json.loads(response.content), {'detail': 'Invalid token.'})
+
+
+TEST_RATES = {
+    'anonymous': {'*': '0.001/2'},
+    'Customer': {'*': '0.001/5', '/api/orders/': '0.001/2'},
+    'Manager': {'*': '0.001/4'},
+}
+
+
+@override_settings(THROTTLE_RATES=TEST_RATES)
+class ThrottleTests(TestCase):
+    def setUp(self):
+        self.customer = User.objects.create_user('customer')
+        self.manager = User.objects.create_user('manager')
+        Group.objects.create(name='Manager').user_set.add(self.manager)
+        Group.objects.create(name='Customer').user_set.add(self.manager)
+        roles.invalidate_roles()
+        self.client = APIClient()
+
+    def statuses(self, path, count):
+        return [self.client.get(path).status_code for _ in range(count)]
+
+    def test_routes_have_their_own_buckets(self):
+        self.client.force_authenticate(self.customer)
+        self.assertEqual(self.statuses('/api/orders/', 3), [200, 200, 429])
+        response = self.client.get('/api/orders/')
+        self.assertEqual(int(response['Retry-After']), 1000)
+        # Every other route shares the '*' bucket
+        self.assertEqual(self.statuses('/api/cart/menu-items/', 3) + self.statuses('/api/menu-items/', 3),
+                         [200, 200, 200, 200, 200, 429])
+
+    def test_clients_are_limited_separately(self):
+        self.client.force_authenticate(self.customer)
+        self.assertEqual(self.statuses('/api/orders/', 3)[-1], 429)
+        other = User.objects.create_user('other')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.statuses('/api/orders/', 2), [200, 200])
+
+    def test_highest_role_applies(self):
+        # The manager is a customer too, but gets the managers' limits
+        self.client.force_authenticate(self.manager)
+        self.assertEqual(self.statuses('/api/orders/', 5), [200, 200, 200, 200, 429])
+
+    def test_anonymous_clients_by_address(self):
+        self.assertEqual(self.statuses('/api/menu-items/', 3), [200, 200, 429])
+        self.assertEqual(self.client.get('/api/menu-items/', REMOTE_ADDR='10.0.0.2').status_code, 200)
+
+    def test_unlisted_roles_are_not_limited(self):
+        crew = User.objects.create_user('crew')
+        Group.objects.create(name='Delivery Crew').user_set.add(crew)
+        self.client.force_authenticate(crew)
+        self.assertEqual(set(self.statuses('/api/orders/', 10)), {200})
+
+    @override_settings(THROTTLE_ENABLED=False)
+    def test_disabled(self):
+        self.assertEqual(set(self.statuses('/api/menu-items/', 5)), {200})
+
+    def test_async_views(self):
+        token = Token.objects.create(user=self.customer).key
+        headers = {'Accept': 'application/json', 'Authorization': f'Token {token}'}
+        statuses = [async_to_sync(async_views.manage_orders)(AsyncRequestFactory().get('/api/orders/',
+                                                                                      headers=headers)).status_code
+                    for _ in range(6)]
+        # Requests built without URL resolution count against the '*' bucket
+        self.assertEqual(statuses, [200] * 5 + [429])
+
+    def test_async_views_take_from_blocking_stores_off_the_event_loop(self):
+        token = Token.objects.create(user=self.customer).key
+        request = AsyncRequestFactory().get('/api/orders/', headers={'Accept': 'application/json',
+                                                                     'Authorization': f'Token {token}'})
+
+        async def view():
+            response = await async_views.manage_orders(request)
+            return threading.get_ident(), response.status_code
+
+        for store, on_loop in ((throttling.LocalStore(), True), (throttling.SQLiteStore(':memory:'), False)):
+            threads = []
+            take = store.take
+
+            def recording_take(*args):
+                threads.append(threading.get_ident())
+                return take(*args)
+
+            throttling._store = store
+            try:
+                with mock.patch.object(store, 'take', recording_take):
+                    loop_thread, status = async_to_sync(view)()
+            finally:
+                throttling._store = None
+            self.assertEqual(status, 200)
+            self.assertEqual(len(threads), 1)
+            self.assertEqual(threads[0] == loop_thread, on_loop)
+
+    def test_buckets_refill(self):
+        for store in (throttling.LocalStore(), throttling.SQLiteStore(':memory:')):
+            take = [store.take('key', 2, 3, now)[0] for now in (0, 0, 0, 0, 0.4, 0.6, 10, 10, 10, 10)]
+            self.assertEqual(take, [True, True, True, False, False, True, True, True, True, False])
+            # The empty bucket gets its next token in half a second
+            self.assertEqual(store.take('key', 2, 3, 10)[1], 0.5)
+
+    def test_sqlite_store_is_shared(self):
+        # Two stores on one file stand for two worker processes
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/throttle.sqlite3'
+            first, second = throttling.SQLiteStore(path), throttling.SQLiteStore(path)
+            taken = [store.take('key', 0.001, 3, 100)[0] for store in (first, second, first, second)]
+            self.assertEqual(taken, [True, True, True, False])
+
+    def test_failing_store_lets_requests_through(self):
+        class BrokenStore:
+            def take(self, *args):
+                raise OperationalError('database is locked')
+
+        self.client.force_authenticate(self.customer)
+        throttling._store = BrokenStore()
+        try:
+            self.assertEqual(set(self.statuses('/api/orders/', 5)), {200})
+        finally:
+            throttling._store = None
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.customer = User.objects.create_user('customer', email='customer@example.com')
+        self.manager = User.objects.create_user('manager')
+        self.crew = User.objects.create_user('crew', email='crew@example.com')
+        Group.objects.create(name='Manager').user_set.add(self.manager)
+        Group.objects.create(name='Delivery Crew').user_set.add(self.crew)
+        roles.invalidate_roles()
+        self.client = APIClient()
+        self.calls = []
+
+    def register(self, name, function=None, batch_size=None):
+        jobs.handler(name, batch_size)(function or self.calls.append)
+        self.addCleanup(jobs.HANDLERS.pop, name)
+
+    def expire(self):
+        # Makes every queued job due now, as if the lease or backoff had run out
+        Job.objects.update(run_at=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+
+    def test_checkout_emails_from_the_worker(self):
+        fill_cart(self.customer, 2)
+        self.client.force_authenticate(self.customer)
+        self.assertEqual(self.client.post('/api/orders/').status_code, 201)
+        self.assertEqual(sorted(Job.objects.values_list('name', flat=True)), ['order_notifications', rollups.JOB])
+        self.assertEqual(mail.outbox, [])
+        call_command('run_jobs', '--burst')
+        self.assertEqual([message.subject for message in mail.outbox], [f'Order #{Order.objects.get().pk} received'])
+        self.assertFalse(Job.objects.exists())
+
+    def test_empty_checkout_enqueues_nothing(self):
+        self.client.force_authenticate(self.customer)
+        self.client.post('/api/orders/')
+        self.assertFalse(Job.objects.exists())
+
+    def test_order_updates(self):
+        order = Order.objects.create(user=self.customer, total=Decimal('5.00'), date=datetime.date(2024, 1, 1))
+        self.client.force_authenticate(self.manager)
+        self.client.patch(f'/api/orders/{order.pk}/', {'delivery_crew': self.crew.pk})
+        self.client.force_authenticate(self.crew)
+        self.client.patch(f'/api/orders/{order.pk}/', {'status': True})
+        # Saving the same state again notifies nobody
+        self.client.patch(f'/api/orders/{order.pk}/', {'status': True})
+        call_command('run_jobs', '--burst')
+        self.assertEqual([(message.to, message.subject) for message in mail.outbox], [
+            (['crew@example.com'], f'Order #{order.pk} assigned to you'),
+            (['customer@example.com'], f'Order #{order.pk} delivered'),
+        ])
+
+    def test_batches(self):
+        self.register('test', batch_size=2)
+        jobs.enqueue('test', [{'n': n} for n in range(5)])
+        jobs.run_workers(burst=True)
+        self.assertEqual(self.calls, [[{'n': 0}, {'n': 1}], [{'n': 2}, {'n': 3}], [{'n': 4}]])
+
+    def test_ctrl_c_lets_the_batch_finish(self):
+        def interrupted(payloads):
+            os.kill(os.getpid(), signal.SIGINT)
+            self.calls.append(payloads)
+
+        self.register('interrupted', interrupted, batch_size=1)
+        jobs.enqueue('interrupted', [{'n': n} for n in range(3)])
+        stderr = io.StringIO()
+        previous = signal.getsignal(signal.SIGINT)
+        # Without --burst, only the signal stops the command
+        call_command('run_jobs', stderr=stderr)
+        self.assertEqual(self.calls, [[{'n': 0}]])
+        self.assertEqual(Job.objects.count(), 2)
+        self.assertIn('Stopping after the running batches', stderr.getvalue())
+        self.assertIs(signal.getsignal(signal.SIGINT), previous)
+
+    @override_settings(JOB_MAX_ATTEMPTS=2)
+    def test_retries_with_backoff_then_fails(self):
+        def fail(payloads):
+            raise RuntimeError('mail server down')
+
+        self.register('test', fail)
+        jobs.enqueue('test', [{}])
+        worker = jobs.Worker()
+        with self.assertLogs('LittleLemonAPI.jobs', 'ERROR'):
+            self.assertEqual(worker.run_once(), 1)
+        job = Job.objects.get()
+        self.assertEqual((job.attempts, job.failed), (1, False))
+        self.assertIn('mail server down', job.last_error)
+        # Not due again until the backoff has passed
+        self.assertEqual(worker.run_once(), 0)
+        self.expire()
+        with self.assertLogs('LittleLemonAPI.jobs', 'ERROR'):
+            worker.run_once()
+        job.refresh_from_db()
+        self.assertEqual((job.attempts, job.failed), (2, True))
+        self.expire()
+        self.assertEqual(worker.run_once(), 0)
+
+    def test_expired_claims_run_again(self):
+        # A worker that dies after claiming leaves its jobs to whoever comes after the lease
+        self.register('test')
+        jobs.enqueue('test', [{'n': 1}])
+        first = jobs.Worker()
+        name, token, claimed = first.claim()
+        self.assertEqual(jobs.Worker().run_once(), 0)
+        self.expire()
+        self.assertEqual(jobs.Worker().run_once(), 1)
+        self.assertEqual(self.calls, [[{'n': 1}]])
+        self.assertFalse(Job.objects.exists())
+        # The late first worker's result no longer touches the jobs
+        first.retry(token, claimed, 'late')
+        self.assertFalse(Job.objects.exists())
+
+    def test_unknown_jobs_fail_without_retrying(self):
+        self.register('test')
+        jobs.enqueue('test', [{}])
+        jobs.HANDLERS.pop('test')
+        with self.assertLogs('LittleLemonAPI.jobs', 'ERROR'):
+            jobs.Worker().run_once()
+        self.assertTrue(Job.objects.get().failed)
+        with self.assertRaises(ValueError):
+            jobs.enqueue('test', [{}])
+        jobs.handler('test')(self.calls.append)
+
+    def test_concurrent_workers_claim_each_job_once(self):
+        self.register('test', batch_size=1)
+        jobs.enqueue('test', [{'n': n} for n in range(20)])
+        workers = [jobs.Worker() for _ in range(3)]
+        while any([worker.run_once() for worker in workers]):
+            pass
+        self.assertEqual(sorted(call[0]['n'] for call in self.calls), list(range(20)))
+
+
+class RendererTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user('manager')
+        Group.objects.create(name='Manager').user_set.add(self.manager)
+        roles.invalidate_roles()
+        self.client = APIClient()
+        self.client.force_authenticate(self.manager)
+        fill_cart(self.manager, 40)
+
+    def test_fast_json_matches_drf(self):
+        data = {
+            'price': Decimal('12.50'),
+            'when': datetime.datetime(2024, 1, 2, 3, 4, 5, 678901, tzinfo=datetime.timezone.utc),
+            'day': datetime.date(2024, 1, 2), 'text': 'Crème brûlée \u2028', 1: [None, True, 1.5, (1, 2)],
+        }
+        expected = JSONRenderer().render(data)
+        self.assertEqual(renderers.FastJSONRenderer().render(data), expected)
+        self.assertEqual(renderers.FastJSONRenderer().render(data, 'application/json; indent=2'),
+                         JSONRenderer().render(data, 'application/json; indent=2'))
+        self.assertEqual(renderers.FastJSONRenderer().render(2 ** 70), b'1180591620717411303424')
+
+    def test_fast_json_parser(self):
+        parser = renderers.FastJSONParser()
+        self.assertEqual(parser.parse(io.BytesIO('{"title": "Crème"}'.encode())), {'title': 'Crème'})
+        for body in (b'{"a": ', b'NaN'):
+            with self.assertRaises(ParseError):
+                parser.parse(io.BytesIO(body))
+
+    def test_posts_json(self):
+        response = self.client.post('/api/cart/menu-items/', [{'menuitem': 'manager item 0', 'quantity': 1}],
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_gzip_above_the_threshold(self):
+        plain = self.client.get('/api/cart/menu-items/', HTTP_ACCEPT='application/json')
+        response = self.client.get('/api/cart/menu-items/', HTTP_ACCEPT='application/json',
+                                   HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertLess(len(response.content), len(plain.content))
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+
+    @skipUnless(compression.brotli is not None, 'brotli is not installed')
+    def test_brotli(self):
+        plain = self.client.get('/api/cart/menu-items/', HTTP_ACCEPT='application/json')
+        response = self.client.get('/api/cart/menu-items/', HTTP_ACCEPT='application/json',
+                                   HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(compression.brotli.decompress(response.content), plain.content)
+        streamed = self.client.get('/api/menu-items/?stream=true', HTTP_ACCEPT='application/json',
+                                   HTTP_ACCEPT_ENCODING='br')
+        self.assertEqual(len(json.loads(compression.brotli.decompress(b''.join(streamed.streaming_content)))), 40)
+
+    def test_small_and_refused_responses_are_not_compressed(self):
+        response = self.client.get('/api/users/users/me/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        response = self.client.get('/api/cart/menu-items/', HTTP_ACCEPT='application/json',
+                                   HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_streamed_responses(self):
+        plain = self.client.get('/api/cart/menu-items/', HTTP_ACCEPT='application/json')
+        response = self.client.get('/api/menu-items/?stream=true', HTTP_ACCEPT='application/json',
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        items = json.loads(gzip.decompress(b''.join(response.streaming_content)))
+        self.assertEqual(len(items), 40)
+        self.assertEqual(len(json.loads(plain.content)), 40)
+
+    def test_compressed_etags_are_weak(self):
+        caches['menu'].clear()
+        headers = {'HTTP_ACCEPT': 'application/json', 'HTTP_ACCEPT_ENCODING': 'gzip'}
+        response = self.client.get('/api/menu-items/?page_size=40', **headers)
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        response = self.client.get('/api/menu-items/?page_size=40', HTTP_IF_NONE_MATCH=response['ETag'], **headers)
+        self.assertEqual(response.status_code, 304)
+
+    def test_choose_encoding(self):
+        br = 'br' if compression.brotli is not None else 'gzip'
+        self.assertEqual(compression.choose_encoding('gzip, deflate, br'), br)
+        self.assertEqual(compression.choose_encoding('br;q=0.5, gzip'), 'gzip')
+        self.assertEqual(compression.choose_encoding('*'), br)
+        self.assertIsNone(compression.choose_encoding('identity'))
+        self.assertIsNone(compression.choose_encoding('*;q=0'))
+        self.assertIsNone(compression.choose_encoding(''))
+
+    @skipUnless(renderers.msgpack is not None, 'msgpack is not installed')
+    def test_msgpack(self):
+        plain = self.client.get('/api/orders/', HTTP_ACCEPT='application/json')
+        response = self.client.get('/api/orders/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(renderers.msgpack.unpackb(response.content), json.loads(plain.content))
+        body = renderers.msgpack.packb([{'menuitem': 'manager item 0', 'quantity': 1}])
+        response = self.client.post('/api/cart/menu-items/', body, content_type='application/msgpack',
+                                    HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, 201)
+
+    def test_async_views_negotiate(self):
+        token = Token.objects.create(user=self.manager).key
+        request = AsyncRequestFactory().get('/api/orders/', headers={'Authorization': f'Token {token}',
+                                                                     'Accept': 'application/xml'})
+        response = async_to_sync(async_views.manage_orders)(request)
+        self.assertEqual(response.status_code, 406)
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+
+def parse_sse(chunks):
+    # [(event, data), ...] from a text/event-stream body; comments and retry: lines are left out
+    messages = []
+    for block in b''.join(chunks).decode().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n') if ': ' in line and not line.startswith(':'))
+        if 'event' in fields:
+            messages.append((fields['event'], json.loads(fields['data'])))
+    return messages
+
+
+@override_settings(ORDER_EVENTS_HEARTBEAT=0.05)
+class OrderEventTests(TestCase):
+    def setUp(self):
+        roles.invalidate_roles()
+        events.reset_broker()
+        self.customer = User.objects.create_user('customer')
+        self.other = User.objects.create_user('other')
+        self.manager = User.objects.create_user('manager')
+        self.crew = User.objects.create_user('crew')
+        Group.objects.create(name='Manager').user_set.add(self.manager)
+        Group.objects.create(name='Delivery Crew').user_set.add(self.crew)
+        self.tokens = {user: Token.objects.create(user=user).key
+                       for user in (self.customer, self.other, self.manager, self.crew)}
+
+    def place_order(self):
+        fill_cart(self.customer, 2)
+        self.client.force_login(self.customer)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post('/api/orders/').status_code, 201)
+        return Order.objects.latest('pk')
+
+    def update_order(self, user, order, data):
+        self.client.force_login(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/orders/{order.pk}/', data, content_type='application/json')
+
+    def open_stream(self, user, last_event_id=None):
+        headers = {'Authorization': f'Token {self.tokens[user]}'}
+        if last_event_id is not None:
+            headers['Last-Event-ID'] = str(last_event_id)
+        return async_views.order_events(AsyncRequestFactory().get('/api/orders/events/', headers=headers))
+
+    async def read(self, stream, count):
+        return [await anext(stream) for _ in range(count)]
+
+    def test_live_events_per_role(self):
+        async def run():
+            responses = {user: await self.open_stream(user)
+                         for user in (self.customer, self.other, self.manager, self.crew)}
+            self.assertEqual(responses[self.customer]['Content-Type'], 'text/event-stream')
+            streams = {user: aiter(response.streaming_content) for user, response in responses.items()}
+            for stream in streams.values():
+                self.assertTrue((await anext(stream)).startswith(b'retry: '))
+            order = await sync_to_async(self.place_order)()
+            await sync_to_async(self.update_order)(self.manager, order, {'delivery_crew': self.crew.pk})
+            await sync_to_async(self.update_order)(self.crew, order, {'status': True})
+            received = {user: parse_sse(await self.read(stream, 3)) for user, stream in streams.items()}
+            for response in responses.values():
+                await response.streaming_content.aclose()
+            return order, received
+
+        order, received = async_to_sync(run)()
+        everything = ['order.placed', 'order.assigned', 'order.delivered']
+        self.assertEqual([event for event, data in received[self.customer]], everything)
+        self.assertEqual([event for event, data in received[self.manager]], everything)
+        # The crew member only sees the order from its assignment, the other customer only keepalives
+        self.assertEqual([event for event, data in received[self.crew]], everything[1:])
+        self.assertEqual(received[self.other], [])
+        self.assertEqual(received[self.customer][-1][1], {
+            'order': order.pk, 'status': True, 'delivery_crew': self.crew.pk, 'total': str(order.total),
+            'date': order.date.isoformat()})
+        self.assertEqual(events.get_broker().subscriber_count(), 0)
+
+    def resume(self, user, last_event_id, count):
+        async def run():
+            response = await self.open_stream(user, last_event_id)
+            chunks = await self.read(aiter(response.streaming_content), count)
+            await response.streaming_content.aclose()
+            return parse_sse(chunks)
+        return async_to_sync(run)()
+
+    def test_resume_from_last_event_id(self):
+        broker = events.get_broker()
+        self.place_order()
+        first = broker.buffer[-1].id
+        order = self.place_order()
+        self.update_order(self.manager, order, {'delivery_crew': self.crew.pk})
+        # retry, then the two missed events
+        self.assertEqual([event for event, data in self.resume(self.customer, first, 3)],
+                         ['order.placed', 'order.assigned'])
+        self.assertEqual([event for event, data in self.resume(self.crew, first, 2)], ['order.assigned'])
+        # Ids the broker doesn't know (from before a restart, or from the future) start with a reset
+        self.assertEqual([event for event, data in self.resume(self.customer, first - 10 ** 9, 5)],
+                         ['reset', 'order.placed', 'order.placed', 'order.assigned'])
+        self.assertEqual(self.resume(self.customer, broker.next_id + 5, 2), [('reset', {})])
+
+    def test_requires_authentication(self):
+        request = AsyncRequestFactory().get('/api/orders/events/')
+        response = async_to_sync(async_views.order_events)(request)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Token')
+
+    def test_needs_asgi(self):
+        # Under WSGI the stream would never be sent; a response that is never read subscribes to nothing
+        headers = {'Authorization': f'Token {self.tokens[self.manager]}'}
+        request = RequestFactory().get('/api/orders/events/', headers=headers)
+        self.assertEqual(async_to_sync(async_views.order_events)(request).status_code, 501)
+        async def open_stream():
+            return await self.open_stream(self.manager)
+
+        response = async_to_sync(open_stream)()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(events.get_broker().subscriber_count(), 0)
+
+    def test_subscribers_on_closed_loops_are_dropped(self):
+        async def subscribe():
+            return events.get_broker().subscribe(self.manager.pk, manager=True)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(subscribe())
+        loop.close()
+        self.place_order()
+        self.assertEqual(events.get_broker().subscriber_count(), 0)
+
+    @override_settings(ORDER_EVENTS_BROKER='database')
+    def test_database_broker(self):
+        order = self.place_order()
+        self.update_order(self.manager, order, {'delivery_crew': self.crew.pk})
+        self.assertEqual(list(OrderEvent.objects.values_list('kind', flat=True)), ['placed', 'assigned'])
+        first = OrderEvent.objects.earliest('pk').pk
+
+        # Another process: resumes from the table and picks up new events by polling it
+        other = events.DatabaseBroker()
+
+        async def run():
+            subscription = other.subscribe(self.crew.pk, crew=True)
+            backlog, complete = await other.backlog(subscription, first - 1)
+            other.cursor = first
+            await other.poll_once()
+            await asyncio.sleep(0)
+            other.unsubscribe(subscription)
+            return [event.kind for event in backlog], complete, [event.kind for event in subscription.pending]
+
+        self.assertEqual(async_to_sync(run)(), (['assigned'], True, ['assigned']))
+        self.assertEqual(self.resume(self.customer, first - 1, 3)[:2], [('order.placed', {
+            'order': order.pk, 'status': False, 'delivery_crew': None, 'total': str(order.total),
+            'date': order.date.isoformat()}), ('order.assigned', self.resume(self.customer, first, 2)[0][1])])
+
+    def test_slow_reader_is_reset(self):
+        async def run():
+            response = await self.open_stream(self.manager)
+            stream = aiter(response.streaming_content)
+            await anext(stream)
+            for _ in range(3):
+                await sync_to_async(self.place_order)()
+            chunks = await self.read(stream, 1)
+            with self.assertRaises(StopAsyncIteration):
+                await anext(stream)
+            return parse_sse(chunks)
+
+        with override_settings(ORDER_EVENTS_MAX_PENDING=2):
+            self.assertEqual(async_to_sync(run)(), [('reset', {})])
+
+
+@contextmanager
+def sqlite_replicas(count):
+    # Read-only SQLite replicas of the test database for the duration of a test, as DATABASE_REPLICAS.
+    # They hold what was committed when they were made; replicas.sync_sqlite_replicas() catches them up.
+    # Their connections are made here rather than declared in DATABASES, which the test runner would set up.
+    with tempfile.TemporaryDirectory() as directory:
+        aliases = [f'test_replica{number}' for number in range(1, count + 1)]
+        for alias in aliases:
+            path = os.path.join(directory, f'{alias}.sqlite3')
+            sqlite3.connect(path).close()
+            settings_dict = connections.configure_settings({
+                'default': {**connections['default'].settings_dict},
+                alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': f'file:{path}?mode=ro',
+                        'OPTIONS': {'uri': True}},
+            })[alias]
+            connections[alias] = load_backend(settings_dict['ENGINE']).DatabaseWrapper(settings_dict, alias)
+        replicas.health.reset()
+        try:
+            with override_settings(DATABASE_REPLICAS=aliases):
+                replicas.sync_sqlite_replicas()
+                yield aliases
+        finally:
+            for alias in aliases:
+                connections[alias].close()
+                del connections[alias]
+            replicas.health.reset()
+
+
+# Replicas are copied from the committed test database, hence TransactionTestCase
+class ReplicaTests(TransactionTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        caches['replica-pins'].clear()
+        caches['menu'].clear()
+        roles.invalidate_roles()
+        self.manager = User.objects.create_user('manager')
+        Group.objects.create(name='Manager').user_set.add(self.manager)
+        self.customer = User.objects.create_user('customer')
+        Category.objects.create(slug='mains', title='Mains')
+        MenuItem.objects.create(title='Soup', price=Decimal('2.50'), featured=False, category=Category.objects.get())
+        fill_cart(self.customer, 1)
+        checkout(self.customer)
+        self.client = APIClient()
+
+    def get(self, user, path):
+        self.client.force_authenticate(user)
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_reads_round_robin_over_the_replicas(self):
+        with sqlite_replicas(2) as aliases:
+            with CaptureQueriesContext(connections[aliases[0]]) as first, \
+                    CaptureQueriesContext(connections[aliases[1]]) as second, \
+                    CaptureQueriesContext(connection) as primary:
+                for _ in range(4):
+                    self.assertEqual(len(self.get(self.manager, '/api/orders/')), 1)
+            self.assertEqual((len(first) > 0, len(second) > 0), (True, True))
+            self.assertEqual(len(first), len(second))
+            # The primary only answered for the user, token and roles
+            self.assertFalse([query for query in primary if 'LittleLemonAPI_' in query['sql']])
+            # Writes, and reads outside of a request, stay on the primary
+            self.assertIsNone(replicas.ReplicaRouter().db_for_read(Order))
+            self.assertEqual(replicas.ReplicaRouter().db_for_write(Order), 'default')
+
+    def test_read_your_writes(self):
+        with sqlite_replicas(1):
+            self.client.force_authenticate(self.customer)
+            response = self.client.post('/api/cart/menu-items/', {'menuitem': 'Soup', 'quantity': 2})
+            self.assertEqual(response.status_code, 201)
+            # The replica doesn't have the new cart row yet, but the customer reads from the primary
+            self.assertEqual(len(self.get(self.customer, '/api/cart/menu-items/')), 1)
+            self.assertEqual(len(self.get(self.manager, '/api/orders/')), 1)
+            # Once the pin has expired, the customer reads the (lagging) replica again
+            caches['replica-pins'].clear()
+            self.assertEqual(self.get(self.customer, '/api/cart/menu-items/'), [])
+            replicas.sync_sqlite_replicas()
+            self.assertEqual(len(self.get(self.customer, '/api/cart/menu-items/')), 1)
+
+    @override_settings(DATABASE_REPLICAS=['replica1'], REPLICA_PIN_CACHE_ALIAS='default')
+    def test_pins_need_a_shared_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            replicas.pin(self.customer.pk)
+
+    def test_menu_writes_pin_menu_reads(self):
+        with sqlite_replicas(1):
+            self.client.force_authenticate(self.manager)
+            response = self.client.post('/api/menu-items/', {'title': 'Salad', 'price': '3.00', 'category': 'Mains'})
+            self.assertEqual(response.status_code, 201)
+            # Anyone's next menu read comes from the primary, not the replica without the new item
+            self.assertEqual(len(self.get(None, '/api/menu-items/')['results']), MenuItem.objects.count())
+
+    def test_unhealthy_replica_is_skipped(self):
+        with sqlite_replicas(2) as aliases:
+            connections[aliases[0]].settings_dict['NAME'] = 'file:/nonexistent/replica.sqlite3?mode=ro'
+            with CaptureQueriesContext(connection) as primary, self.assertLogs('LittleLemonAPI.replicas', 'WARNING'):
+                for _ in range(3):
+                    self.assertEqual(len(self.get(self.manager, '/api/orders/')), 1)
+            # All three went to the healthy replica
+            self.assertFalse([query for query in primary if 'LittleLemonAPI_' in query['sql']])
+            self.assertIsNone(connections[aliases[0]].connection)
+            connections[aliases[1]].settings_dict['NAME'] = 'file:/nonexistent/replica.sqlite3?mode=ro'
+            connections[aliases[1]].close()
+            replicas.health.reset()
+            with self.assertLogs('LittleLemonAPI.replicas', 'WARNING'):
+                # No replica left: the primary answers
+                self.assertEqual(len(self.get(self.manager, '/api/orders/')), 1)
+
+
+class ArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.manager = User.objects.create_user('manager')
+        cls.crew = User.objects.create_user('crew')
+        cls.customer = User.objects.create_user('customer')
+        cls.other = User.objects.create_user('other')
+        Group.objects.create(name='Manager').user_set.add(cls.manager)
+        Group.objects.create(name='Delivery Crew').user_set.add(cls.crew)
+
+    def setUp(self):
+        roles.invalidate_roles()
+        metrics.reset()
+        self.client = APIClient()
+        self.today = datetime.date.today()
+        self.old = self.today - datetime.timedelta(days=400)
+
+    def place_order(self, date, delivered=True, items=2):
+        fill_cart(self.customer, items)
+        order = checkout(self.customer)
+        self.client.force_authenticate(self.manager)
+        self.client.patch(f'/api/orders/{order.pk}/', {'status': int(delivered), 'delivery_crew': self.crew.pk},
+                          format='json')
+        # Backdating skips the rollup signals: rebuild them for the new date
+        Order.objects.filter(pk=order.pk).update(date=date)
+        rollups.rebuild()
+        return order
+
+    def get(self, user, path, **params):
+        self.client.force_authenticate(user)
+        return self.client.get(path, params)
+
+    def test_archives_old_delivered_orders(self):
+        old, old_open, recent = self.place_order(self.old), self.place_order(self.old, False), \
+            self.place_order(self.today)
+        report = self.get(self.manager, '/api/reports/sales/').data
+        before = {user: self.get(user, '/api/orders/', start=self.old.isoformat()).json()
+                  for user in (self.manager, self.crew, self.customer)}
+        detail = self.get(self.customer, f'/api/orders/{old.pk}/').json()
+
+        with self.settings(ORDER_ARCHIVE_AFTER_DAYS=365):
+            self.assertEqual(archive.archive_orders(), {'orders': 1, 'items': 2, 'batches': 1})
+        self.assertEqual(list(Order.objects.order_by('pk').values_list('pk', flat=True)), [old_open.pk, recent.pk])
+        self.assertEqual(list(ArchivedOrder.objects.values_list('pk', flat=True)), [old.pk])
+        self.assertFalse(OrderItem.objects.filter(order_id=old.pk).exists())
+        self.assertEqual(ArchivedOrderItem.objects.filter(order_id=old.pk).count(), 2)
+        # Archived sales still count
+        self.assertEqual(rollups.verify(), [])
+        self.assertEqual(self.get(self.manager, '/api/reports/sales/').data, report)
+
+        # Reads: date ranges and order lookups look the same as before, the plain listing only has hot orders
+        for user, orders in before.items():
+            self.assertEqual(self.get(user, '/api/orders/', start=self.old.isoformat()).json(), orders)
+        self.assertEqual([order['id'] for order in self.get(self.customer, '/api/orders/').json()],
+                         [old_open.pk, recent.pk])
+        self.assertEqual(self.get(self.customer, '/api/orders/', end=self.today.isoformat(),
+                                  start=self.today.isoformat()).json()[0]['id'], recent.pk)
+        self.assertEqual(self.get(self.customer, f'/api/orders/{old.pk}/').json(), detail)
+        self.assertEqual(self.get(self.other, f'/api/orders/{old.pk}/').status_code, 404)
+        self.client.force_authenticate(self.manager)
+        self.assertEqual(self.client.patch(f'/api/orders/{old.pk}/', {'status': 0}, format='json').status_code, 404)
+
+        self.assertGreater(metrics.counter('littlelemon_archive_reads_total'), 0)
+        # Read from the run record, without counting the archive tables
+        with CaptureQueriesContext(connection) as queries:
+            exported = metrics.export()
+        self.assertNotIn('COUNT(', ' '.join(query['sql'] for query in queries))
+        self.assertIn('littlelemon_archived_orders_total 1\n', exported)
+        self.assertIn('littlelemon_archived_order_items_total 2\n', exported)
+        self.assertIn('littlelemon_archive_last_run_orders 1\n', exported)
+
+    def test_batches(self):
+        orders = [self.place_order(self.old, items=1) for _ in range(5)]
+        self.assertEqual(archive.archive_orders(days=30, batch_size=2, max_batches=2),
+                         {'orders': 4, 'items': 4, 'batches': 2})
+        self.assertEqual(list(Order.objects.values_list('pk', flat=True)), [orders[-1].pk])
+        out = io.StringIO()
+        call_command('archive_orders', '--days', '30', '--dry-run', stdout=out)
+        self.assertIn('1 delivered orders', out.getvalue())
+        call_command('archive_orders', '--days', '30', '--batch-size', '2', stdout=out)
+        self.assertEqual(archive.table_sizes(), {'orders': 0, 'order_items': 0, 'archived_orders': 5,
+                                                 'archived_order_items': 5})
+        # Running totals across runs, and what each run moved
+        self.assertEqual(list(ArchiveRun.objects.order_by('pk').values_list(
+            'orders', 'archived_orders', 'archived_order_items')), [(4, 4, 4), (1, 5, 5)])
+        self.assertEqual(rollups.verify(), [])
+
+
+class CartStoreTests(TestCase):
+    def setUp(self):
+        caches['menu'].clear()
+        self.customer = User.objects.create_user('customer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+        category = Category.objects.create(slug='mains', title='Mains')
+        for title, price in (('Soup', '4.00'), ('Salad', '3.50'), ('Bread', '1.25')):
+            MenuItem.objects.create(title=title, price=Decimal(price), featured=False, category=category)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.stores = {'local': {}, 'sqlite': {'CART_SQLITE_PATH': os.path.join(directory.name, 'carts.sqlite3')}}
+
+    def store(self, name):
+        # CART_FLUSH_INTERVAL = 0: no flusher thread, the tests flush themselves
+        return self.settings(CART_STORE=name, CART_FLUSH_INTERVAL=0, **self.stores.get(name, {}))
+
+    def post(self, data):
+        response = self.client.post('/api/cart/menu-items/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def cart(self):
+        response = self.client.get('/api/cart/menu-items/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def session(self):
+        # The same requests against every store; the responses without the cart ids
+        def strip(data):
+            if isinstance(data, list):
+                return [strip(item) for item in data]
+            return {key: strip(value) if key == 'Cart item created' else value for key, value in data.items()
+                    if key != 'id'}
+
+        responses = [self.post({'menuitem': 'Soup', 'quantity': 2}),
+                     self.post([{'menuitem': 'Bread', 'quantity': 1}, {'menuitem': 'Soup', 'quantity': 1}]),
+                     self.cart()]
+        self.client.delete('/api/cart/menu-items/')
+        return [strip(response) for response in responses] + [self.cart()]
+
+    def test_responses_match_the_cart_table(self):
+        expected = self.session()
+        for name in self.stores:
+            with self.subTest(store=name), self.store(name):
+                self.assertEqual(self.session(), expected)
+                # The emptied cart is only deleted from the Cart table by a flush
+                self.assertEqual(cart_store.flush_carts(), 1)
+                self.assertFalse(Cart.objects.exists())
+
+    def test_reads_take_no_queries_and_adds_one(self):
+        for name in self.stores:
+            with self.subTest(store=name), self.store(name):
+                self.post({'menuitem': 'Soup', 'quantity': 1})
+                with self.assertNumQueries(1):
+                    self.post([{'menuitem': 'Soup', 'quantity': 1}, {'menuitem': 'Bread', 'quantity': 1}])
+                with self.assertNumQueries(0):
+                    self.assertEqual([item['quantity'] for item in self.cart()], [2, 1])
+                self.assertFalse(Cart.objects.exists())
+                response = self.client.post('/api/cart/menu-items/', [{'menuitem': 'Pizza', 'quantity': 1}],
+                                            format='json')
+                self.assertEqual((response.status_code, response.data['menuitem']), (404, ['Pizza']))
+                self.client.delete('/api/cart/menu-items/')
+
+    def test_async_view_reads_the_store(self):
+        headers = {'Accept': 'application/json', 'Authorization': f'Token {Token.objects.create(user=self.customer)}'}
+        for name in self.stores:
+            with self.subTest(store=name), self.store(name):
+                cart = self.post([{'menuitem': 'Soup', 'quantity': 2}])
+                request = AsyncRequestFactory().get('/api/cart/menu-items/', headers=headers)
+                self.assertEqual(json.loads(async_to_sync(async_views.edit_cart)(request).content), cart)
+                self.client.delete('/api/cart/menu-items/')
+
+    def test_flush_and_reload(self):
+        for name in self.stores:
+            with self.subTest(store=name), self.store(name):
+                cart = self.post([{'menuitem': 'Soup', 'quantity': 2}, {'menuitem': 'Salad', 'quantity': 1}])
+                self.assertEqual(cart_store.flush_carts(), 1)
+                self.assertEqual(cart_store.flush_carts(), 0)
+                self.assertEqual(sorted(Cart.objects.values_list('menuitem__title', 'quantity', 'price')),
+                                 [('Salad', 1, Decimal('3.50')), ('Soup', 2, Decimal('8.00'))])
+                # Losing the store (a restart of the local one) loses nothing flushed
+                cart_store.get_cart_store().reset()
+                self.assertEqual([item['menuitem'] for item in self.cart()], [item['menuitem'] for item in cart])
+                # A menu write is seen by the next add, even one bypassing the menu cache's version
+                MenuItem.objects.filter(title='Soup').update(price=Decimal('5.00'))
+                self.assertEqual(self.post({'menuitem': 'Soup', 'quantity': 1})['Cart item created']['price'], '15.00')
+                self.client.delete('/api/cart/menu-items/')
+                cart_store.flush_carts()
+                MenuItem.objects.filter(title='Soup').update(price=Decimal('4.00'))
+
+    def test_cart_forgotten_before_the_update_is_reloaded(self):
+        for name in self.stores:
+            with self.subTest(store=name), self.store(name):
+                self.post({'menuitem': 'Soup', 'quantity': 2})
+                cart_store.flush_carts()
+                store = cart_store.get_cart_store()
+                update = store.update
+                calls = []
+
+                def forget_then_update(user_id, function):
+                    # The flusher forgets the clean cart right after the add loaded it
+                    if not calls:
+                        store.forget_idle(time.time() + 1)
+                    calls.append(user_id)
+                    return update(user_id, function)
+
+                with mock.patch.object(store, 'update', forget_then_update):
+                    self.assertEqual(self.post({'menuitem': 'Soup', 'quantity': 1})['Cart item created']['quantity'],
+                                     3)
+                self.assertEqual(len(calls), 2)
+                self.client.delete('/api/cart/menu-items/')
+                cart_store.flush_carts()
+
+    def test_checkout_orders_the_stored_cart(self):
+        for name in self.stores:
+            with self.subTest(store=name), self.store(name):
+                self.post([{'menuitem': 'Soup', 'quantity': 2}, {'menuitem': 'Bread', 'quantity': 4}])
+                cart_store.flush_carts()
+                response = self.client.post('/api/orders/')
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(response.data['total'], '13.00')
+                self.assertEqual(sorted((item['quantity'], item['price']) for item in response.data['order_item']),
+                                 [(2, '8.00'), (4, '5.00')])
+                self.assertEqual(self.cart(), [])
+                self.assertFalse(Cart.objects.exists())
+                self.assertEqual(self.client.post('/api/orders/').status_code, 400)
+                self.assertEqual(rollups.verify(), [])
+
+    def test_flush_doesnt_bring_back_a_cart_checked_out_meanwhile(self):
+        for name in self.stores:
+            with self.subTest(store=name), self.store(name):
+                self.post({'menuitem': 'Soup', 'quantity': 2})
+                store = cart_store.get_cart_store()
+                dirty = store.dirty
+
+                def checkout_after_reading(limit):
+                    # The flusher reads the cart, then the customer checks out before it writes
+                    carts = dirty(limit)
+                    if carts:
+                        self.assertIsNotNone(checkout(self.customer))
+                    return carts
+
+                with mock.patch.object(store, 'dirty', checkout_after_reading):
+                    cart_store.flush_carts()
+                self.assertFalse(Cart.objects.exists())
+                self.assertEqual(cart_store.flush_carts(), 1)
+                self.assertFalse(Cart.objects.exists())
+
+    def test_failed_checkout_keeps_the_cart(self):
+        with self.store('local'):
+            self.post({'menuitem': 'Soup', 'quantity': 2})
+            with mock.patch('LittleLemonAPI.orders.place_order', side_effect=OperationalError), \
+                    self.assertRaises(OperationalError):
+                checkout(self.customer)
+            self.assertEqual([(item['menuitem']['title'], item['quantity']) for item in self.cart()], [('Soup', 2)])
@@ -0,0 +1,240 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.exceptions import Throttled
+from rest_framework.throttling import BaseThrottle
+
+from .metrics import route_of
+from .roles import CUSTOMER, DELIVERY_CREW, MANAGER, aget_roles, get_roles
+
+# Token bucket rate limiting per role and route. Each client (user, or IP address when anonymous) has one
+# bucket per route listed for its role in THROTTLE_RATES and one shared by all its other routes. A bucket
+# holds up to `burst` requests and refills at `rate` requests per second, so short bursts pass and only a
+# sustained excess gets 429 Too Many Requests with a Retry-After header.
+#
+# The buckets live in THROTTLE_STORE:
+# - sqlite (default): one small SQLite file shared by the workers on a machine, updated with a single UPSERT.
+# - local: a dict per process. Fastest, but with N workers a client gets N times the limit.
+# - redis: any Redis-compatible server shared by every machine, updated with a Lua script (needs redis-py).
+# A store that fails lets requests through: rate limiting must never take the API down with it.
+
+ANONYMOUS = 'anonymous'
+# The role whose limits apply to a user with several roles; users without a group are treated as customers
+ROLE_ORDER = (MANAGER, DELIVERY_CREW, CUSTOMER)
+# A route without limits of its own shares this bucket
+DEFAULT_ROUTE = '*'
+
+
+def parse_rate(rate):
+    # 'rate/burst' in requests per second and requests, e.g. '5/20'
+    per_second, burst = rate.split('/')
+    return float(per_second), int(burst)
+
+
+class LocalStore:
+    def __init__(self, max_entries=100000):
+        self.buckets = {}  # key -> (tokens, updated)
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+
+    def take(self, key, rate, burst, now):
+        # Returns (allowed, seconds until the next token)
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if key not in self.buckets and len(self.buckets) >= self.max_entries:
+                self.purge(now)
+            self.buckets[key] = (tokens, now)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def purge(self, now):
+        # Buckets idle for an hour are full again, so forgetting them changes nothing
+        self.buckets = {key: state for key, state in self.buckets.items() if state[1] > now - 3600}
+        if len(self.buckets) >= self.max_entries:
+            self.buckets.clear()
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class SQLiteStore:
+    # The whole token bucket update is one statement: the UPSERT only writes when a token is available and
+    # RETURNING tells whether it did. Every worker process opens the file itself; WAL lets them share it.
+    TAKE = '''
+        INSERT INTO buckets (key, tokens, updated) VALUES (:key, :burst - 1, :now)
+        ON CONFLICT (key) DO UPDATE SET tokens = min(:burst, tokens + (:now - updated) * :rate) - 1, updated = :now
+        WHERE min(:burst, tokens + (:now - updated) * :rate) >= 1
+        RETURNING tokens
+    '''
+    # Deleting buckets after this many takes keeps the file small
+    PURGE_EVERY = 10000
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.local = threading.local()
+        self.takes = 0
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=0.1, isolation_level=None, check_same_thread=False)
+            # The counters don't need to survive a crash, so nothing is synced to disk
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                               'updated REAL NOT NULL) WITHOUT ROWID')
+            self.local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst, now):
+        connection = self.connection()
+        self.takes += 1
+        if self.takes % self.PURGE_EVERY == 0:
+            connection.execute('DELETE FROM buckets WHERE updated < ?', (now - 3600,))
+        if connection.execute(self.TAKE, {'key': key, 'rate': rate, 'burst': burst, 'now': now}).fetchone():
+            return True, 0.0
+        tokens, updated = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+        return False, (1 - min(burst, tokens + (now - updated) * rate)) / rate
+
+    def reset(self):
+        self.connection().execute('DELETE FROM buckets')
+
+
+class RedisStore:
+    TAKE = '''
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or burst
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return {allowed, tostring(tokens)}
+    '''
+
+    def __init__(self, url, prefix='throttle:'):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured('THROTTLE_STORE = "redis" needs redis-py: pip install redis')
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.TAKE)
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, now):
+        # The clock is the caller's, so the web servers' clocks should agree to within a token or so
+        allowed, tokens = self.script(keys=[self.prefix + key], args=[rate, burst, now])
+        return bool(allowed), 0.0 if allowed else (1 - float(tokens)) / rate
+
+    def reset(self):
+        for key in self.client.scan_iter(f'{self.prefix}*'):
+            self.client.delete(key)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_store(getattr(settings, 'THROTTLE_STORE', 'sqlite'))
+    return _store
+
+
+def create_store(name):
+    if name == 'local':
+        return LocalStore()
+    if name == 'sqlite':
+        return SQLiteStore(settings.THROTTLE_SQLITE_PATH)
+    if name == 'redis':
+        return RedisStore(settings.THROTTLE_REDIS_URL)
+    raise ImproperlyConfigured(f'Unknown THROTTLE_STORE {name!r}: use local, sqlite or redis')
+
+
+def reset_store():
+    # Drops every bucket, and the store itself so a changed THROTTLE_STORE takes effect
+    global _store
+    if _store is not None:
+        _store.reset()
+    _store = None
+
+
+def role_of(user, roles):
+    if user is None or not user.is_authenticated:
+        return ANONYMOUS
+    for role in ROLE_ORDER:
+        if role in roles:
+            return role
+    return CUSTOMER
+
+
+def limit_for(role, route):
+    # (bucket name, rate, burst) for the role on route, or None when it isn't limited
+    rates = getattr(settings, 'THROTTLE_RATES', {}).get(role, {})
+    bucket = route if route in rates else DEFAULT_ROUTE
+    rate = rates.get(bucket)
+    if rate is None:
+        return None
+    return (bucket, *parse_rate(rate))
+
+
+class TokenBucketThrottle(BaseThrottle):
+    # REST_FRAMEWORK's DEFAULT_THROTTLE_CLASSES; async_views.py calls athrottle() instead
+    def allow_request(self, request, view):
+        user = getattr(request, 'user', None)
+        return self.take(request, role_of(user, get_roles(user) if user is not None else ()))
+
+    def take(self, request, role):
+        self.retry_after = None
+        if not getattr(settings, 'THROTTLE_ENABLED', True):
+            return True
+        limit = limit_for(role, route_of(request))
+        if limit is None:
+            return True
+        bucket, rate, burst = limit
+        client = f'user:{request.user.pk}' if role != ANONYMOUS else f'ip:{self.get_ident(request)}'
+        try:
+            allowed, wait = get_store().take(f'{client}|{bucket}', rate, burst, time.time())
+        except Exception:
+            # Fail open, see above
+            return True
+        if not allowed:
+            self.retry_after = wait
+        return allowed
+
+    def wait(self):
+        # DRF rounds Retry-After to whole seconds; never tell a client to retry right away
+        return None if self.retry_after is None else max(1, math.ceil(self.retry_after))
+
+
+async def athrottle(request):
+    # Raises Throttled like DRF's check_throttles, for the async views
+    throttle = TokenBucketThrottle()
+    role = role_of(request.user, await aget_roles(request.user))
+    # The local store is a dict behind a lock; the SQLite and Redis ones may block, off the event loop
+    if isinstance(_store, LocalStore):
+        allowed = throttle.take(request, role)
+    else:
+        allowed = await sync_to_async(throttle.take)(request, role)
+    if not allowed:
+        raise Throttled(throttle.wait())
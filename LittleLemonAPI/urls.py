@@ -1,7 +1,14 @@
+from django.conf import settings
 from django.urls import path
+from .async_views import order_events
 from .views import return_user, get_managers, remove_manager, \
     get_delivery_crew, remove_delivery_crew, get_post_menu_items, edit_single_menu_item, \
-    edit_cart, manage_orders, manage_specific_order
+    edit_cart, manage_orders, manage_specific_order, import_menu_items_view, export_menu_items_view, \
+    dispatch_orders, search_menu_items, autocomplete_menu_items, sales_report_view
+
+if settings.ASYNC_READ_VIEWS:
+    # Same URLs, but GETs of the hot read endpoints are answered by native async views
+    from .async_views import return_user, get_post_menu_items, edit_single_menu_item, edit_cart, manage_orders
 
 urlpatterns = [
     path('users/users/me/', return_user),
@@ -11,7 +18,15 @@ urlpatterns = [
     path('groups/delivery-crew/users/<int:userId>/', remove_delivery_crew),
     path('menu-items/', get_post_menu_items),
     path('menu-items/<menu_item>/', edit_single_menu_item),
+    # Under menu/ so they can't be taken for, or hide, menu items titled like them
+    path('menu/import/', import_menu_items_view),
+    path('menu/export/', export_menu_items_view),
+    path('menu/search/', search_menu_items),
+    path('menu/autocomplete/', autocomplete_menu_items),
     path('cart/menu-items/', edit_cart),
     path('orders/', manage_orders),
-    path('orders/<int:orderId>/', manage_specific_order)
+    path('orders/dispatch/', dispatch_orders),
+    path('orders/events/', order_events),
+    path('orders/<int:orderId>/', manage_specific_order),
+    path('reports/sales/', sales_report_view),
 ]
\ No newline at end of file
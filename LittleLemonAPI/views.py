@@ -1,14 +1,33 @@
-from django.shortcuts import render, get_list_or_404
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+from django.shortcuts import render
 from django.core import serializers
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.decorators import api_view, permission_classes, throttle_classes, authentication_classes
 from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 from .models import MenuItem, OrderItem, Category, Cart, Order
 from rest_framework import generics, status, permissions
 from django.contrib.auth.models import User, Group
+from .fast_serializers import paginated_list, serialize_list
+from .filters import filter_menu_items
+from .archive import archived_order_items, archived_orders
+from .authentication import CachedTokenAuthentication
+from .cart import add_items, user_cart
+from .cart_store import add_to_cart, cart_items, empty_cart, get_cart_store
+from .dispatch import balance, crew_members, dispatch
+from .catalog import CONTENT_TYPES, export_menu_items, format_for_content_type, import_menu_items
+from .menu_cache import cache_menu_response
+from .notifications import notify, order_events
+from .orders import checkout
+from .pagination import MenuItemPagination
+from .rollups import GROUPINGS, STATUSES, date_range, parse_date, report_range, sales_report
+from .search import search, search_params
 from .permissions import IsManager, IsDeliveryCrew, IsCustomer
-from .serializers import UserSerializer, MenuItemSerializer, CartSerializer, OrderSerializer, OrderItemSerializer
+from .roles import MANAGER, DELIVERY_CREW, has_role
+from .serializers import UserSerializer, MenuItemSerializer, CartSerializer, CartItemInputSerializer, OrderSerializer, \
+    OrderItemSerializer, OrderUpdateSerializer, DispatchSerializer
+from .streaming import streaming_list_response, wants_streaming
 
 # Displays only the current user
 @api_view(['GET'])
@@ -20,7 +39,7 @@ def return_user(request):
 @api_view(['GET', 'POST'])
 @permission_classes([IsManager])
 def get_managers(request):
-    manager_group = Group.objects.get(name="Manager")
+    manager_group = Group.objects.get(name=MANAGER)
     if request.method == "GET":
         # Returns all managers
         managers = manager_group.user_set.all()
@@ -43,7 +62,7 @@ def remove_manager(request, userId):
         # Removes this particular user from the manager group and returns 200 – Success if everything is okay.
         # If the user is not found, returns 404 – Not found
         user = get_object_or_404(User, pk=userId)
-        manager_group = Group.objects.get(name="Manager")
+        manager_group = Group.objects.get(name=MANAGER)
         manager_group.user_set.remove(user)
         return Response({"message": f"Removed Manager {user}"}, status=status.HTTP_200_OK)
     return Response({"message": f"Could not find User"}, status=status.HTTP_404_NOT_FOUND)
@@ -52,7 +71,7 @@ def remove_manager(request, userId):
 @api_view(['GET', 'POST'])
 @permission_classes([IsManager])
 def get_delivery_crew(request):
-    delivery_group = Group.objects.get(name="Delivery Crew")
+    delivery_group = Group.objects.get(name=DELIVERY_CREW)
     if request.method == "GET":
         # Returns all delivery crew
         delivery = delivery_group.user_set.all()
@@ -73,7 +92,7 @@ def remove_delivery_crew(request, userId):
         # Removes this user from the manager group and returns 200 – Success if everything is okay.
         # If the user is not found, returns  404 – Not found
         user = get_object_or_404(User, pk=userId)
-        delivery_group = Group.objects.get(name="Delivery Crew")
+        delivery_group = Group.objects.get(name=DELIVERY_CREW)
         delivery_group.user_set.remove(user)
         return Response({"message": f"Removed Delivery Crew Member {user}"}, status=status.HTTP_200_OK)
     return Response({"message": f"Could not find User"}, status=status.HTTP_404_NOT_FOUND)
@@ -82,33 +101,63 @@ def remove_delivery_crew(request, userId):
 # Menu-items endpoints
 
 @api_view(['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
-@authentication_classes([TokenAuthentication])  # Use TokenAuthentication to ensure only managers can make changes
+@authentication_classes([CachedTokenAuthentication])  # Use token authentication to ensure only managers can make changes
+@cache_menu_response  # GETs are served from the versioned menu cache with ETag / 304 support
 def get_post_menu_items(request):
     if request.method == "GET":
-        # Lists all menu items. Return a 200 – Ok HTTP status code
-        queryset = get_list_or_404(MenuItem)
-        serializer = MenuItemSerializer(queryset, many=True)
-        return Response(serializer.data)
+        # Lists menu items one page at a time. Return a 200 – Ok HTTP status code
+        # Supports ?category=, ?featured=, ?min_price=, ?max_price=, ?ordering=id|price|title (prefix - for descending),
+        # ?page_size= and the ?cursor= links returned as next/previous. An empty menu returns an empty page.
+        queryset = filter_menu_items(MenuItem.objects.all(), request.query_params)
+        paginator = MenuItemPagination()
+        if wants_streaming(request):
+            # ?stream=true returns every matching item as one streamed JSON array instead of a page
+            ordering = paginator.get_ordering(request)
+            return streaming_list_response(request, queryset.order_by(ordering, 'pk'), MenuItemSerializer)
+        return paginated_list(paginator, queryset, request, MenuItemSerializer)
     elif request.method != "GET" and request.method == "POST":
         # Creates a new menu item and returns 201 - Created
         user = request.user
-        if user.groups.filter(name="Manager").exists():
+        if has_role(user, MANAGER):
             title = request.data['title']
-            title_in_database = MenuItem.objects.filter(title=title).first()
-            if title_in_database:
-                return Response({"message": "Duplicate menu-items are not allowed"}, status=status.HTTP_400_BAD_REQUEST)
             price = request.data['price']
             featured = bool(request.data.get('featured')) #featured variable isn't working properly
             category_name = request.data['category']
             category = get_object_or_404(Category, title=category_name)
-            MenuItem.objects.create(title=title, price=price, featured=featured, category=category)
+            try:
+                # The unique index on title rejects duplicates, also when two requests race
+                with transaction.atomic():
+                    MenuItem.objects.create(title=title, price=price, featured=featured, category=category)
+            except IntegrityError:
+                return Response({"message": "Duplicate menu-items are not allowed"}, status=status.HTTP_400_BAD_REQUEST)
             return Response({"message": f"Added new menu-item: {title}"}, status=status.HTTP_201_CREATED)
 
         return Response({"message": "Non-Manager cannot edit menu_items"}, status=status.HTTP_403_FORBIDDEN)
 
 
+@api_view(['GET'])
+def search_menu_items(request):
+    # Ranked search over menu item and category titles, tolerating typos: ?q=<text>&limit=<n, default 20>.
+    # Returns the matching menu items, best match first.
+    query, limit = search_params(request.query_params, 20, 100)
+    pks = [pk for pk, _, _ in search(query, limit)]
+    items = {item['id']: item for item in serialize_list(MenuItem.objects.filter(pk__in=pks), MenuItemSerializer)}
+    return Response({'results': [items[pk] for pk in pks if pk in items]})
+
+
+@api_view(['GET'])
+def autocomplete_menu_items(request):
+    # Title suggestions while typing: ?q=<text>&limit=<n, default 10>. Answered from the search index alone,
+    # without a database query.
+    query, limit = search_params(request.query_params, 10, 50)
+    return Response({'results': [
+        {'id': pk, 'title': title, 'category': category} for pk, title, category in search(query, limit)
+    ]})
+
+
 @api_view(['GET', 'PUT', 'PATCH', 'DELETE'])
 @permission_classes([IsManager])
+@cache_menu_response
 def edit_single_menu_item(request, menu_item):
     menu_item_object = get_object_or_404(MenuItem, title=menu_item)
     if request.method == "GET":
@@ -129,31 +178,58 @@ def edit_single_menu_item(request, menu_item):
         menu_item_object.delete()
         return Response({"message": f"removed {removed_menu_item}"})
 
+@api_view(['POST'])
+@permission_classes([IsManager])
+def import_menu_items_view(request):
+    # Creates or updates (by title) menu items from an NDJSON or CSV request body, which is read as a stream.
+    # Send Content-Type: application/x-ndjson or text/csv. Returns how many items were created and updated.
+    format = format_for_content_type(request.content_type)
+    if format is None:
+        return Response({"message": "Content-Type must be application/x-ndjson or text/csv"},
+                        status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    report = import_menu_items(request.stream or [], format)
+    return Response(report, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsManager])
+def export_menu_items_view(request):
+    # Streams the whole menu as NDJSON (default) or CSV (?type=csv) without loading it into memory
+    format = 'csv' if request.query_params.get('type') == 'csv' else 'ndjson'
+    response = StreamingHttpResponse(export_menu_items(format), content_type=CONTENT_TYPES[format])
+    response['Content-Disposition'] = f'attachment; filename="menu-items.{format}"'
+    return response
+
+
 # Cart management endpoints
 @api_view(['GET', 'POST', 'DELETE'])
 def edit_cart(request):
     try:
         user = request.user
+        store = get_cart_store()
+        if store is not None:
+            # Carts kept in the cart store (CART_STORE, cart_store.py), with the same responses
+            return edit_stored_cart(request, user, store)
         if request.method == "GET":
             # Returns current items in the cart for the current user token
-            cart = Cart.objects.filter(user=user)
-            serializer = CartSerializer(cart, many=True)
-            return Response(serializer.data)
+            return Response(serialize_list(user_cart(user), CartSerializer))
         elif request.method == "POST":
-            # Adds the menu item to the cart. Sets the authenticated user as the user id for these cart items
-            menu_item_title = request.data.get('menuitem')
-            menu_item_object = MenuItem.objects.get(title=menu_item_title)
-            quantity = int(request.data.get('quantity'))
-            unit_price = menu_item_object.price
-            price = unit_price * quantity
-            cart_item = Cart.objects.create(
-                user=user,
-                menuitem=menu_item_object,
-                quantity=quantity,
-                unit_price=unit_price,
-                price=price
-            )
-            serializer = CartSerializer(cart_item)
+            # Adds menu items to the cart. Sets the authenticated user as the user id for these cart items.
+            # Accepts one {menuitem, quantity} object or a list of them; adding an item that is already
+            # in the cart increases its quantity.
+            cart = user_cart(user)
+            many = isinstance(request.data, list)
+            input_serializer = CartItemInputSerializer(data=request.data, many=many)
+            if not input_serializer.is_valid():
+                return Response(input_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            entries = input_serializer.validated_data if many else [input_serializer.validated_data]
+            unknown = add_items(user, entries)
+            if unknown:
+                return Response({"message": "Menu items not found", "menuitem": unknown}, status=status.HTTP_404_NOT_FOUND)
+            if many:
+                # Returns the whole updated cart
+                return Response(serialize_list(cart, CartSerializer), status=status.HTTP_201_CREATED)
+            serializer = CartSerializer(cart.get(menuitem__title=entries[0]['menuitem']))
             return Response({"Cart item created": serializer.data}, status=status.HTTP_201_CREATED)
         elif request.method == "DELETE":
             # Deletes all menu items created by the current user token
@@ -163,33 +239,75 @@ def edit_cart(request):
     except TypeError as e:
         return Response({'message': f'Missing authentication token: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
 
+
+def edit_stored_cart(request, user, store):
+    if request.method == "GET":
+        return Response(cart_items(store, user))
+    elif request.method == "POST":
+        many = isinstance(request.data, list)
+        input_serializer = CartItemInputSerializer(data=request.data, many=many)
+        if not input_serializer.is_valid():
+            return Response(input_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        entries = input_serializer.validated_data if many else [input_serializer.validated_data]
+        unknown, cart = add_to_cart(store, user, entries)
+        if unknown:
+            return Response({"message": "Menu items not found", "menuitem": unknown}, status=status.HTTP_404_NOT_FOUND)
+        if many:
+            return Response(cart, status=status.HTTP_201_CREATED)
+        item = next(item for item in cart if item['menuitem']['title'] == entries[0]['menuitem'])
+        return Response({"Cart item created": item}, status=status.HTTP_201_CREATED)
+    elif request.method == "DELETE":
+        empty_cart(store, user)
+        return Response({"message": "Emptied Cart"})
+
+
 # Order management endpoints
+def orders_with_items(queryset):
+    # Loads the orders, their users, order items and menu items in a fixed number of queries
+    # (one for the orders, one for all of their items) instead of one per order
+    return queryset.select_related('user', 'delivery_crew').prefetch_related(
+        Prefetch('orderitem_set', queryset=OrderItem.objects.select_related('menuitem').order_by('pk'))
+    )
+
+
+def visible_orders(user):
+    # The filter for the orders user may list
+    if has_role(user, MANAGER):
+        # All orders by all users
+        return {}
+    if has_role(user, DELIVERY_CREW):
+        # The orders assigned to the delivery crew
+        return {'delivery_crew': user}
+    # The orders created by this user
+    return {'user': user}
+
+
 @api_view(['GET', 'POST'])
 def manage_orders(request):
     user = request.user
     if request.method == "GET":
-        if user.groups.filter(name="Manager").exists():
-            # Returns all orders with order items by all users
-            order = Order.objects.all()
-            serializer = OrderSerializer(order, many=True)
-            return Response(serializer.data)
-        elif user.groups.filter(name="Delivery Crew").exists():
-            # Returns all orders with order items assigned to the delivery crew
-            order = Order.objects.filter(delivery_crew=user)
-            serializer = OrderSerializer(order, many=True)
-            return Response(serializer.data)
-        else:
-            # Returns all orders with order items created by this user
-            order = Order.objects.filter(user=user)
-            #order_item = OrderItem.objects.filter(order=order)
-            serializer = OrderSerializer(order, many=True)
-            return Response(serializer.data)
+        # Returns the orders with their order items. ?start= and ?end= (YYYY-MM-DD) narrow them to a date range,
+        # which includes the archived order history of those dates (archive.py).
+        visible = visible_orders(user)
+        order = orders_with_items(Order.objects.filter(**visible))
+        start, end = parse_date(request.query_params, 'start'), parse_date(request.query_params, 'end')
+        if start is not None or end is not None:
+            data = serialize_list(date_range(order, 'date', start, end).order_by('pk'), OrderSerializer)
+            data += archived_orders(start, end, **visible)
+            return Response(sorted(data, key=lambda row: row['id']))
+        if wants_streaming(request):
+            # ?stream=true streams the same JSON array in batches, so memory doesn't grow with the number of orders
+            return streaming_list_response(request, order.order_by('pk'), OrderSerializer)
+        return Response(serialize_list(order.order_by('pk'), OrderSerializer))
     elif request.method == "POST":
         # Creates a new order item for the current user.
         # Gets current cart items from the cart endpoints and adds those items to the order items table.
-        # Then deletes all items from the cart for this user.
-        cart = Cart.objects.filter(user=user)
-        order = Order.objects.filter(user=user)
+        # Then deletes all items from the cart for this user. All of it happens in one transaction.
+        order = checkout(user)
+        if order is None:
+            return Response({"message": "Cart is empty"}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = OrderSerializer(order)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 @api_view(['GET', 'PUT', 'PATCH', 'DELETE'])
 def manage_specific_order(request, orderId):
@@ -200,7 +318,11 @@ def manage_specific_order(request, orderId):
         try:
             order = Order.objects.get(pk=orderId, user=user)
         except Order.DoesNotExist:
-            return Response({'error': 'Order not found or does not belong to the current user'}, status=status.HTTP_404_NOT_FOUND)
+            # Older orders may have been archived
+            order_items = archived_order_items(orderId, user=user)
+            if order_items is None:
+                return Response({'error': 'Order not found or does not belong to the current user'}, status=status.HTTP_404_NOT_FOUND)
+            return Response(order_items)
         order_items = OrderItem.objects.filter(order=order)
         serializer = OrderItemSerializer(order_items, many=True)
         return Response(serializer.data)
@@ -209,10 +331,28 @@ def manage_specific_order(request, orderId):
         # If a delivery crew is assigned to this order and the status = 0, it means the order is out for delivery.
         # If a delivery crew is assigned to this order and the status = 1, it means the order has been delivered.
         order = get_object_or_404(Order, pk=orderId)
-        delivery_crew = request.data.get('delivery_crew')
-        status = request.data.get('status')
-        order.delivery_crew = delivery_crew
-        order.status = status
+        if has_role(user, MANAGER):
+            fields = {'delivery_crew': 'delivery_crew_id', 'status': 'status'}
+        elif has_role(user, DELIVERY_CREW) and order.delivery_crew_id == user.pk:
+            # Delivery crew can only mark their own orders as delivered (or not)
+            fields = {'status': 'status'}
+        else:
+            return Response({"message": "Cannot update this order"}, status=status.HTTP_403_FORBIDDEN)
+        serializer = OrderUpdateSerializer(data=request.data, partial=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        updates = {field: serializer.validated_data[name] for name, field in fields.items()
+                   if name in serializer.validated_data}
+        if updates.get('delivery_crew_id') is not None and not crew_members([updates['delivery_crew_id']]):
+            return Response({"message": "delivery_crew must be a Delivery Crew member"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        old_crew, old_status = order.delivery_crew_id, order.status
+        for field, value in updates.items():
+            setattr(order, field, value)
+        with transaction.atomic():
+            order.save(update_fields=list(updates))
+            # Emails to the crew member / customer are sent by the job worker after commit
+            notify(order_events(order.pk, old_crew, order.delivery_crew_id, old_status, order.status))
         return Response({"message": "Updated the order"})
     elif request.method == "DELETE":
         # Deletes this order
@@ -221,13 +361,42 @@ def manage_specific_order(request, orderId):
         return Response({"message": f"Order with orderId: {orderId} was deleted"})
 
 
+@api_view(['POST'])
+@permission_classes([IsManager])
+def dispatch_orders(request):
+    # Assigns many orders to delivery crew at once, either from explicit assignments or by balancing unassigned
+    # orders across the Delivery Crew (auto_assign). Orders that changed since the manager saw them are not
+    # overwritten but returned as conflicts. Returns {applied, conflicts, not_found}.
+    serializer = DispatchSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    data = serializer.validated_data
+    if data['auto_assign']:
+        report = balance(data['orders'], data['limit'])
+        if report is None:
+            return Response({"message": "There is no Delivery Crew to dispatch to"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(report)
+    assignments = data['assignments']
+    requested = {assignment['delivery_crew'] for assignment in assignments}
+    unknown = sorted(requested - crew_members(requested))
+    if unknown:
+        return Response({"message": "Not Delivery Crew members", "delivery_crew": unknown},
+                        status=status.HTTP_400_BAD_REQUEST)
+    return Response(dispatch(assignments))
 
 
-
-
-
-
-
-
-
-
+# Reporting endpoints
+@api_view(['GET'])
+@permission_classes([IsManager])
+def sales_report_view(request):
+    # Revenue from the sales rollups: ?start=&end= (YYYY-MM-DD, the last 30 days by default),
+    # ?group_by=day|menuitem|category (default day) and ?status=all|open|delivered (default all)
+    start, end = report_range(request.query_params)
+    if start > end:
+        return Response({"message": "start must not be after end"}, status=status.HTTP_400_BAD_REQUEST)
+    group_by = request.query_params.get('group_by', 'day')
+    order_status = request.query_params.get('status', 'all')
+    if group_by not in GROUPINGS or order_status not in STATUSES:
+        return Response({"message": f"group_by must be one of {', '.join(GROUPINGS)} and status one of "
+                                    f"{', '.join(STATUSES)}"}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(sales_report(start, end, group_by, order_status))